@@ -119,7 +119,8 @@ AWS_SQS = {
         'VISIBILITY_TIMEOUT': 60,
         'MESSAGE_GATHER_SIZE': 10,
         'VALIDATE_SNS_SIGNATURE': True,
-        'EVENT_COUNT_PRUNE_AFTER_DAY': 2,
+        'EVENT_BUFFER_WINDOW': int(os.getenv(
+            'SQS_ENROLLMENT_BUFFER_WINDOW', 0)),
         'VALIDATE_BODY_SIGNATURE': False,
     },
     'INSTRUCTOR_ADD': {
@@ -129,7 +130,6 @@ AWS_SQS = {
         'VISIBILITY_TIMEOUT': 60,
         'MESSAGE_GATHER_SIZE': 10,
         'VALIDATE_SNS_SIGNATURE': True,
-        'EVENT_COUNT_PRUNE_AFTER_DAY': 2,
         'VALIDATE_BODY_SIGNATURE': False,
     },
     'INSTRUCTOR_DROP': {
@@ -139,7 +139,6 @@ AWS_SQS = {
         'VISIBILITY_TIMEOUT': 60,
         'MESSAGE_GATHER_SIZE': 10,
         'VALIDATE_SNS_SIGNATURE': True,
-        'EVENT_COUNT_PRUNE_AFTER_DAY': 2,
         'VALIDATE_BODY_SIGNATURE': False,
     },
     'GROUP': {
@@ -149,7 +148,6 @@ AWS_SQS = {
         'VISIBILITY_TIMEOUT': 60,
         'MESSAGE_GATHER_SIZE': 10,
         'VALIDATE_SNS_SIGNATURE': True,
-        'EVENT_COUNT_PRUNE_AFTER_DAY': 2,
         'VALIDATE_BODY_SIGNATURE': True,
         'BODY_DECRYPT_KEYS': {
             'iamcrypt1': os.getenv('SQS_GROUP_DECRYPT_KEY', ''),
@@ -162,7 +160,6 @@ AWS_SQS = {
         'VISIBILITY_TIMEOUT': 60,
         'MESSAGE_GATHER_SIZE': 10,
         'VALIDATE_SNS_SIGNATURE': True,
-        'EVENT_COUNT_PRUNE_AFTER_DAY': 2,
         'VALIDATE_BODY_SIGNATURE': False,
     },
 }
@@ -277,6 +274,30 @@ SIS_IMPORT_LIMIT = {
     },
 }
 
+SIS_IMPORT_CSV_SPILL_LIMIT = int(os.getenv('SIS_IMPORT_CSV_SPILL_LIMIT', 0))
+SIS_IMPORT_FINGERPRINT_DAYS = int(os.getenv('SIS_IMPORT_FINGERPRINT_DAYS', 7))
+SIS_IMPORT_SHARD_ROWS = int(os.getenv('SIS_IMPORT_SHARD_ROWS', 0))
+SIS_IMPORT_DEDUP_MINUTES = int(os.getenv('SIS_IMPORT_DEDUP_MINUTES', 10))
+SIS_IMPORT_COALESCE_ROWS = int(os.getenv('SIS_IMPORT_COALESCE_ROWS', 0))
+SIS_IMPORT_DIFFING_CHANGE_THRESHOLD = int(os.getenv(
+    'SIS_IMPORT_DIFFING_CHANGE_THRESHOLD', 10))
+SIS_IMPORT_CSV_STAGING_DIR = os.getenv('SIS_IMPORT_CSV_STAGING_DIR', None)
+SIS_IMPORT_CSV_UPLOAD_ATTEMPTS = int(os.getenv(
+    'SIS_IMPORT_CSV_UPLOAD_ATTEMPTS', 3))
+SIS_IMPORT_SECTION_PREFETCH_THREADS = int(os.getenv(
+    'SIS_IMPORT_SECTION_PREFETCH_THREADS', 8))
+SIS_IMPORT_SNAPSHOT_HOURS = int(os.getenv('SIS_IMPORT_SNAPSHOT_HOURS', 24))
+SIS_IMPORT_REGISTRATION_PREFETCH_THREADS = int(os.getenv(
+    'SIS_IMPORT_REGISTRATION_PREFETCH_THREADS', 8))
+SIS_IMPORT_CURRICULUM_HARVEST_SECTIONS = int(os.getenv(
+    'SIS_IMPORT_CURRICULUM_HARVEST_SECTIONS', 25))
+SIS_IMPORT_CANVAS_SECTION_INDEX_MINUTES = int(os.getenv(
+    'SIS_IMPORT_CANVAS_SECTION_INDEX_MINUTES', 60))
+SIS_IMPORT_COURSE_TERM_PROCESSES = int(os.getenv(
+    'SIS_IMPORT_COURSE_TERM_PROCESSES', 2))
+SIS_IMPORT_PERSON_PREFETCH_THREADS = int(os.getenv(
+    'SIS_IMPORT_PERSON_PREFETCH_THREADS', 8))
+
 NONPERSONAL_NETID_EXCEPTION_GROUP = 'u_acadev_canvas_nonpersonal_netids'
 ASTRA_ADMIN_EXCEPTIONS = [
     'a_atomic_canvas_int',
@@ -311,6 +332,15 @@ ADMIN_IMPORT_STATUS_FREQ = 30
 
 REMOVED_ADMIN_RETENTION_DAYS = 90
 ENROLLMENT_EVENT_RETENTION_DAYS = 180
+RETENTION_POLICIES = {
+    'enrollment': {'days': ENROLLMENT_EVENT_RETENTION_DAYS},
+    'invalid_enrollment': {'days': 365},
+    'group_member_group': {'days': 0},
+    'event_log': {'days': 2},
+    'import': {'days': 90},
+}
+RETENTION_CHUNK_SIZE = int(os.getenv('RETENTION_CHUNK_SIZE', 1000))
+RETENTION_CHUNK_PAUSE = float(os.getenv('RETENTION_CHUNK_PAUSE', 0.5))
 
 INVALID_ENROLLMENT_GRACE_DAYS = 90
 ENROLLMENT_TYPES_INVALID_CHECK = [
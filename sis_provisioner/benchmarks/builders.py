@@ -0,0 +1,90 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Timings of the builder prefetch pools against a latency-injecting SWS.
+These are not part of the test suite, run them with:
+
+    python manage.py test sis_provisioner.benchmarks.builders
+"""
+
+from django.test import TestCase
+from uw_sws.util import fdao_sws_override
+from uw_pws.util import fdao_pws_override
+from sis_provisioner.builders import Builder
+from sis_provisioner.builders.courses import CourseBuilder
+from sis_provisioner.dao.course import get_registrations_by_section
+from sis_provisioner.models.course import Course
+from restclients_core.exceptions import DataFailureException
+from logging import getLogger
+import copy
+import time
+import mock
+
+logger = getLogger(__name__)
+
+# Injected latency of each SWS request, in seconds
+LATENCY = 0.05
+
+
+class CourseBuilderBenchmark(TestCase):
+    @mock.patch('sis_provisioner.builders.get_section_by_id')
+    def test_prefetch_sections(self, mock_get_section):
+        def slow_get_section(section_id):
+            time.sleep(LATENCY)
+            raise DataFailureException(section_id, 404, 'Not Found')
+
+        mock_get_section.side_effect = slow_get_section
+        courses = [Course(course_id='2013-spring-TRAIN-{}-A'.format(i),
+                          course_type=Course.SDB_TYPE) for i in range(16)]
+
+        elapsed = {}
+        for pool_size in [0, 1, 8]:
+            with self.settings(SIS_IMPORT_SECTION_PREFETCH_THREADS=pool_size):
+                start = time.perf_counter()
+                CourseBuilder(courses).build()
+                elapsed[pool_size] = time.perf_counter() - start
+
+        logger.info(
+            'Build of {} sections: sequential {:.3f}s, 1 thread {:.3f}s, '
+            '8 threads {:.3f}s'.format(
+                len(courses), elapsed[0], elapsed[1], elapsed[8]))
+
+
+@fdao_sws_override
+@fdao_pws_override
+class BuilderBenchmark(TestCase):
+    @mock.patch('sis_provisioner.builders.get_registrations_by_section')
+    def test_prefetch_registrations(self, mock_get_registrations):
+        section = Builder().get_section_resource_by_id(
+            '2013-winter-DROP_T-100-B')
+        registrations = get_registrations_by_section(section)
+
+        def slow_get_registrations(section):
+            # Registrations from the resource files
+            time.sleep(LATENCY)
+            section_registrations = copy.deepcopy(registrations)
+            for registration in section_registrations:
+                registration.section = section
+            return section_registrations
+
+        mock_get_registrations.side_effect = slow_get_registrations
+        sections = []
+        for i in range(16):
+            sections.append(copy.deepcopy(section))
+            sections[-1].section_id = 'B{}'.format(i)
+
+        elapsed = {}
+        for pool_size in [0, 8]:
+            with self.settings(
+                    SIS_IMPORT_REGISTRATION_PREFETCH_THREADS=pool_size):
+                builder = Builder()
+                start = time.perf_counter()
+                builder.prefetch_registrations(sections)
+                for s in sections:
+                    builder.add_registrations_by_section(s)
+                elapsed[pool_size] = time.perf_counter() - start
+
+        logger.info(
+            'Registrations of {} sections: sequential {:.3f}s, '
+            '8 threads {:.3f}s'.format(len(sections), elapsed[0], elapsed[8]))
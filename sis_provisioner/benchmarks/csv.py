@@ -0,0 +1,62 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Timings of batched csv serialization against the previous per-row
+serialization. These are not part of the test suite, run them with:
+
+    python manage.py test sis_provisioner.benchmarks.csv
+"""
+
+from django.test import TestCase
+from sis_provisioner.models.account import Curriculum
+from sis_provisioner.csv.format import (
+    AccountCSV, SectionCSV, XlistCSV, CSVWriter)
+from logging import getLogger
+import time
+import csv
+import io
+
+logger = getLogger(__name__)
+
+
+class CSVWriterBenchmark(TestCase):
+    def test_writer(self):
+        def per_row(rows):
+            # Previous per-row serialization
+            f = io.StringIO()
+            for row in rows:
+                csv.register_dialect('unix_newline', lineterminator='\n')
+                s = io.BytesIO()
+                try:
+                    csv.writer(s, dialect='unix_newline').writerow(row.data)
+                except TypeError:
+                    s = io.StringIO()
+                    csv.writer(s, dialect='unix_newline').writerow(row.data)
+                f.write(s.getvalue())
+            return f.getvalue()
+
+        def batched(rows):
+            f = io.StringIO()
+            CSVWriter(f).write(rows)
+            return f.getvalue()
+
+        context = Curriculum(full_name='CSV Test')
+        rows = []
+        for i in range(10000):
+            rows.append(AccountCSV('account-{}'.format(i), 'def', context))
+            rows.append(SectionCSV(
+                section_id='section-{}'.format(i), course_id='course',
+                name='Name, "{}"'.format(i), status='active'))
+            rows.append(XlistCSV('xlist', 'section-{}'.format(i)))
+
+        rates = {}
+        for serializer in [per_row, batched]:
+            start = time.perf_counter()
+            serializer(rows)
+            rates[serializer.__name__] = len(rows) / (
+                time.perf_counter() - start)
+
+        logger.info((
+            'CSV serialization rows/sec, per_row: {:.0f}, '
+            'batched: {:.0f}').format(rates['per_row'], rates['batched']))
@@ -2,7 +2,8 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-from sis_provisioner.models.course import Course
+from sis_provisioner.models import ImportResource
+from sis_provisioner.models.course import CourseBatch
 from sis_provisioner.models.user import User
 from sis_provisioner.csv.data import Collector
 from sis_provisioner.csv.format import UserCSV, EnrollmentCSV
@@ -14,14 +15,26 @@ from sis_provisioner.exceptions import (
     UserPolicyException, CoursePolicyException, InvalidLoginIdException)
 from restclients_core.exceptions import DataFailureException
 from uw_pws import PWS
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
 
 class Builder(object):
+    # Omit user, course and section rows unchanged since a recent import
+    suppress_unchanged = False
+
     def __init__(self, items=[]):
-        self.data = Collector()
+        self.data = Collector(suppress_unchanged=self.suppress_unchanged)
         self.queue_id = None
         self.invalid_users = {}
+        self.sections = SectionMemo()
+        self.courses = CourseBatch()
+        self.registration_errors = 0
+        self.registrations = {}
+        self.users = {}
+        self.new_users = {}
+        self.updated_users = {}
         self.items = items
         self.logger = getLogger(__name__)
 
@@ -37,7 +50,17 @@ class Builder(object):
     def build(self, **kwargs):
         self._init_build(**kwargs)
         for item in self.items:
+            # Rows for immediate priority items are always imported
+            self.data.force = (getattr(item, 'priority', None) ==
+                               ImportResource.PRIORITY_IMMEDIATE)
             self._process(item)
+        self.data.force = False
+        self.save_users()
+        self.courses.flush()
+
+        if self.sections.hits or self.sections.misses:
+            self.logger.info('Section memo: {} hits, {} misses'.format(
+                self.sections.hits, self.sections.misses))
         return self._write()
 
     def add_user_data_for_person(self, person, force=False):
@@ -58,6 +81,17 @@ class Builder(object):
 
         if force is True:
             self.data.add(UserCSV(person))
+        elif person.uwregid in self.users:
+            # Resolved users are saved at the end of the build
+            user = self.users[person.uwregid]
+            if user.pk is None:
+                self.new_users[person.uwregid] = user
+
+            if user.provisioned_date is None:
+                if (self.data.add(UserCSV(person)) and user.queue_id is None):
+                    user.queue_id = self.queue_id
+                    if user.pk is not None:
+                        self.updated_users[person.uwregid] = user
         else:
             user = User.objects.get_user(person)
             if user.provisioned_date is None:
@@ -66,6 +100,32 @@ class Builder(object):
                     user.save()
         return True
 
+    def resolve_users(self, persons, batch_size=1000):
+        """
+        Loads the User models for the passed persons in batches, for
+        add_user_data_for_person.
+        """
+        persons = list(dict((p.uwregid, p) for p in persons if (
+            p is not None and p.uwregid not in self.users)).values())
+        for i in range(0, len(persons), batch_size):
+            self.users.update(User.objects.get_users(
+                persons[i:i + batch_size]))
+
+    def save_users(self):
+        """
+        Creates and updates the resolved User models added to the build.
+        """
+        if len(self.new_users):
+            User.objects.bulk_create(
+                self.new_users.values(), batch_size=500,
+                ignore_conflicts=True)
+            self.new_users = {}
+
+        if len(self.updated_users):
+            User.objects.bulk_update(
+                self.updated_users.values(), ['queue_id'], batch_size=500)
+            self.updated_users = {}
+
     def add_teacher_enrollment_data(self, section, person, status='active'):
         """
         Generates one teacher enrollment for the passed section and person.
@@ -83,6 +143,7 @@ class Builder(object):
                 registration.person = PWS().get_person_by_regid(
                     registration.regid)
             except DataFailureException as ex:
+                self.registration_errors += 1
                 self.logger.info(
                     f"Skip registration person {registration.regid}: {ex}")
 
@@ -107,23 +168,151 @@ class Builder(object):
 
     def add_registrations_by_section(self, section):
         try:
-            for registration in get_registrations_by_section(section):
+            registrations = self.registrations.pop(
+                section.section_label(), None)
+            if registrations is None:
+                registrations = get_registrations_by_section(section)
+            elif isinstance(registrations, Exception):
+                raise registrations
+
+            for registration in registrations:
                 self.add_student_enrollment_data(registration)
 
         except DataFailureException as ex:
+            self.registration_errors += 1
             self.logger.info("Skip enrollments for section {}: {}".format(
                 section.section_label(), ex))
 
+    def prefetch_sections(self, section_ids):
+        """
+        Fetches the section resources for the passed section IDs through a
+        pool of SIS_IMPORT_SECTION_PREFETCH_THREADS threads. Fetched sections,
+        and fetch exceptions, are added to the section memo.
+        """
+        pool_size = getattr(settings, 'SIS_IMPORT_SECTION_PREFETCH_THREADS', 8)
+        section_ids = [s for s in dict.fromkeys(section_ids) if (
+            s is not None and s not in self.sections)]
+        if not pool_size or not len(section_ids):
+            return
+
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            for section_id, section in zip(section_ids, executor.map(
+                    _fetch_section, section_ids)):
+                self.sections.add(section_id, section)
+
+    def prefetch_registrations(self, sections):
+        """
+        Fetches the registrations for the passed sections through a pool of
+        SIS_IMPORT_REGISTRATION_PREFETCH_THREADS threads. Fetched
+        registrations, and fetch exceptions, are held for
+        add_registrations_by_section, which adds them in processing order.
+        """
+        pool_size = getattr(
+            settings, 'SIS_IMPORT_REGISTRATION_PREFETCH_THREADS', 8)
+        sections = list(dict(
+            (s.section_label(), s) for s in sections if (
+                s.section_label() not in self.registrations)).values())
+        if not pool_size or not len(sections):
+            return
+
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            self.registrations.update(zip(
+                [s.section_label() for s in sections],
+                executor.map(_fetch_registrations, sections)))
+
+    def get_section(self, section_id):
+        """
+        Returns the section resource for the passed section ID, from the
+        section memo if it has been fetched.
+        """
+        return self.sections.get(
+            section_id, lambda: get_section_by_id(section_id))
+
     def get_section_resource_by_id(self, section_id):
         """
         Fetch the section resource for the passed section ID, and add to queue.
         """
         try:
-            section = get_section_by_id(section_id)
-            Course.objects.add_to_queue(section, self.queue_id)
+            section = self.get_section(section_id)
+            self.courses.add_to_queue(section, self.queue_id)
             return section
 
         except (ValueError, CoursePolicyException, DataFailureException) as ex:
-            Course.objects.remove_from_queue(section_id, ex)
+            self.courses.remove_from_queue(section_id, ex)
             self.logger.info("Skip section {}: {}".format(section_id, ex))
             raise
+
+
+class SectionMemo(object):
+    """
+    Build-scoped identity map of fetched section resources, and fetch
+    exceptions, with hit and miss counts.
+    """
+    def __init__(self):
+        self.sections = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.sections
+
+    def __len__(self):
+        return len(self.sections)
+
+    def keys(self):
+        return self.sections.keys()
+
+    def items(self):
+        return self.sections.items()
+
+    def values(self):
+        return self.sections.values()
+
+    def add(self, key, section):
+        """
+        Adds a fetched section, or fetch exception, for the passed key.
+        """
+        self.misses += 1
+        self.sections[key] = section
+
+    def get(self, key, fetch):
+        """
+        Returns the section for the passed key, calling fetch() on the first
+        request for the key. A fetch exception is raised for each request.
+        """
+        if key in self.sections:
+            self.hits += 1
+        else:
+            try:
+                section = fetch()
+            except Exception as ex:
+                section = ex
+            self.add(key, section)
+
+        section = self.sections[key]
+        if isinstance(section, Exception):
+            raise section
+        return section
+
+
+def _fetch_section(section_id):
+    try:
+        return get_section_by_id(section_id)
+    except Exception as ex:
+        return ex
+
+
+def _fetch_registrations(section):
+    try:
+        registrations = get_registrations_by_section(section)
+    except Exception as ex:
+        return ex
+
+    for registration in registrations:
+        if registration.person is None:
+            try:
+                registration.person = PWS().get_person_by_regid(
+                    registration.regid)
+            except DataFailureException:
+                pass
+    return registrations
@@ -6,14 +6,22 @@ from sis_provisioner.builders import Builder
 from sis_provisioner.csv.format import CourseCSV, SectionCSV, TermCSV, XlistCSV
 from sis_provisioner.dao.course import (
     is_active_section, get_section_by_url, canvas_xlist_id, section_short_name,
-    section_id_from_url)
+    section_id_from_url, get_registrations_by_section,
+    get_registrations_by_curriculum)
 from sis_provisioner.dao.canvas import (
     get_section_by_sis_id, get_sis_sections_for_course, get_course_report_data,
-    get_unused_course_report_data)
-from sis_provisioner.models.course import Course
+    get_unused_course_report_data, ReportFailureException)
+from sis_provisioner.models import ImportResource, SectionSnapshot
+from sis_provisioner.models.course import Course, CanvasSectionIndex
+from sis_provisioner.models.account import Curriculum
 from sis_provisioner.exceptions import CoursePolicyException
 from restclients_core.exceptions import DataFailureException
 from uw_sws.exceptions import InvalidCanvasIndependentStudyCourse
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import hashlib
+import json
 import csv
 import re
 
@@ -22,8 +30,187 @@ class CourseBuilder(Builder):
     """
     Generates import data for Course models.
     """
+    suppress_unchanged = True
+
     def _init_build(self, **kwargs):
         self.include_enrollment = kwargs.get('include_enrollment', True)
+        self.data.diffing = kwargs.get('diffing', False)
+        self.defer_enrollment = (
+            kwargs.get('defer_enrollment', False) and
+            self.include_enrollment and not self.data.diffing)
+        self.deferred_sections = []
+        self.deferred_snapshots = []
+        self.linked_course_ids = {}
+        self.joint_course_ids = {}
+        self.canvas_indexes = {}
+        self._resolve_section_graph()
+        self.courses.preload([key for key in self.sections.keys() if (
+            isinstance(key, str))], courses=self.items)
+        if self.include_enrollment and not self.defer_enrollment:
+            self._prefetch_registrations()
+        self._find_unchanged_sections()
+        self._resolve_users()
+
+    def _resolve_section_graph(self):
+        """
+        Resolves the closure of the primary sections of the queued courses,
+        their linked and joint sections, and the linked and joint courses in
+        the Course table. Each level of the graph is fetched in one prefetch
+        wave, and its Course table relations in one pair of queries.
+        """
+        level = [course.primary_id or course.course_id for course in (
+            self.items)]
+        while len(level):
+            self.prefetch_sections(level)
+
+            primary_ids = []
+            related_ids = []
+            for section_id in dict.fromkeys(level):
+                try:
+                    section = self.get_section(section_id)
+                except Exception:
+                    continue
+
+                if (section.is_primary_section and
+                        not section.is_independent_study):
+                    primary_ids.append(section_id)
+                    for url in chain(section.linked_section_urls,
+                                     section.joint_section_urls):
+                        related_ids.append(section_id_from_url(url))
+
+            linked, joint = Course.objects.get_related_course_ids(primary_ids)
+            self.linked_course_ids.update(linked)
+            self.joint_course_ids.update(joint)
+
+            level = [s for s in chain(
+                related_ids, *linked.values(), *joint.values()) if (
+                    s is not None and s not in self.sections)]
+
+    def _find_unchanged_sections(self):
+        """
+        Computes the digests of the primary sections of the queued courses,
+        and finds the sections unchanged since a recent successful import.
+        Diffing builds are complete term data, and always include every
+        section.
+        """
+        self.section_digests = {}
+        for course in self.items:
+            section_id = course.primary_id or course.course_id
+            digest = self._section_digest(section_id)
+            if digest is not None:
+                self.section_digests[section_id] = digest
+
+        if self.data.diffing:
+            self.unchanged_sections = set()
+        else:
+            self.unchanged_sections = SectionSnapshot.objects.find_unchanged(
+                self.section_digests)
+
+    def _prefetch_registrations(self):
+        """
+        Prefetches the registrations of the resolved sections that are
+        enrolled from registrations. Independent study registrations depend
+        on the instructor, and are fetched as the sections are processed.
+        """
+        sections = [section for section in list(self.sections.values()) if (
+            not isinstance(section, Exception) and
+            not section.is_independent_study and
+            _is_registration_section(section))]
+
+        sections = self._harvest_registrations(sections)
+        self.prefetch_registrations(sections)
+
+    def _harvest_registrations(self, sections):
+        """
+        Fetches the registrations for the passed sections by curriculum, for
+        each curriculum with at least SIS_IMPORT_CURRICULUM_HARVEST_SECTIONS
+        sections in the build. Returns the sections still to be fetched
+        individually, including those of any curriculum that failed.
+        """
+        harvest_min = getattr(
+            settings, 'SIS_IMPORT_CURRICULUM_HARVEST_SECTIONS', 25)
+        pool_size = getattr(
+            settings, 'SIS_IMPORT_REGISTRATION_PREFETCH_THREADS', 8)
+        if not harvest_min or not pool_size:
+            return sections
+
+        curricula = Curriculum.objects.accounts_by_curricula()
+        groups = {}
+        for section in sections:
+            if (section.section_label() not in self.registrations and
+                    section.curriculum_abbr in curricula):
+                groups.setdefault((
+                    section.curriculum_abbr, section.term.year,
+                    section.term.quarter), []).append(section)
+
+        groups = [g for g in groups.values() if len(g) >= harvest_min]
+        if not len(groups):
+            return sections
+
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            for group, registrations in zip(groups, executor.map(
+                    _harvest_registrations, groups)):
+                if isinstance(registrations, Exception):
+                    self.logger.info(
+                        'Registration harvest for {} {} failed: {}'.format(
+                            group[0].curriculum_abbr,
+                            group[0].term.canvas_sis_id(), registrations))
+                else:
+                    self.registrations.update(registrations)
+
+        return [s for s in sections if (
+            s.section_label() not in self.registrations)]
+
+    def _resolve_users(self):
+        """
+        Loads the User models for the instructors of the resolved sections,
+        and the prefetched registrants.
+        """
+        persons = []
+        for section in list(self.sections.values()):
+            if not isinstance(section, Exception):
+                persons.extend(section.get_instructors())
+
+        for registrations in self.registrations.values():
+            if not isinstance(registrations, Exception):
+                persons.extend(r.person for r in registrations)
+
+        self.resolve_users(persons)
+
+    def _section_digest(self, section_id):
+        """
+        Returns a digest of the memoized section data for the passed primary
+        section ID, including its linked and joint sections and the
+        prefetched registrations of those enrolled from registrations. Returns
+        None if any of the sections or registrations are unavailable, or the
+        registrations are not prefetched.
+        """
+        try:
+            section = self.get_section(section_id)
+            sections = [section] + [self.get_section(
+                section_id_from_url(url)) for url in chain(
+                    section.linked_section_urls, section.joint_section_urls)]
+        except Exception:
+            return
+
+        data = []
+        for s in sections:
+            registrations = []
+            if s.is_independent_study:
+                return
+            elif _is_registration_section(s):
+                registrations = self.registrations.get(s.section_label())
+                if (registrations is None or
+                        isinstance(registrations, Exception)):
+                    return
+
+            data.append([s.json_data(), s.delete_flag, s.linked_section_urls,
+                         s.joint_section_urls, sorted(
+                             i.uwregid for i in s.get_instructors()),
+                         sorted(_registration_fingerprint(r) for r in (
+                             registrations))])
+        return hashlib.sha256(json.dumps(
+            data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
     def _process(self, course):
         if course.queue_id is not None:
@@ -35,20 +222,94 @@ class CourseBuilder(Builder):
         else:
             section_id = course.course_id
 
+        if (section_id in self.unchanged_sections and
+                course.priority != ImportResource.PRIORITY_IMMEDIATE):
+            self.logger.info(f"Skip unchanged section '{section_id}'")
+            self.courses.mark_provisioned(course)
+            return
+
         try:
             section = self.get_section_resource_by_id(section_id)
         except Exception as err:
             self.logger.info(f"ERROR in get_section for '{section_id}': {err}")
+            self._incomplete_data()
             return
 
+        registration_errors = self.registration_errors
+        deferred_count = len(self.deferred_sections)
+        self._process_section(section, course)
+
+        # Snapshot sections whose import data is complete
+        if self.defer_enrollment:
+            self.deferred_snapshots.append((
+                section_id, deferred_count, len(self.deferred_sections)))
+        elif (self.include_enrollment and
+                section_id in self.section_digests and
+                registration_errors == self.registration_errors):
+            self.data.snapshots[section_id] = self.section_digests[section_id]
+
+    def _incomplete_data(self):
+        """
+        Marks the term data incomplete, so it is imported without diffing.
+        A diffing data set missing rows would delete them in Canvas.
+        """
+        self.data.diffing = False
+
+    def _write(self):
+        if self.registration_errors:
+            self._incomplete_data()
+        return super(CourseBuilder, self)._write()
+
+    def build_enrollments(self):
+        """
+        Generates the student enrollment data deferred by a build with
+        defer_enrollment, for an import following the course and section
+        import. Returns a path to the csv files, or None.
+        """
+        sections = [section for section, force in self.deferred_sections]
+        self.prefetch_registrations(self._harvest_registrations([
+            s for s in sections if not s.is_independent_study]))
+        self._resolve_users()
+
+        # Digests include the registrations, which are consumed as added
+        digests = dict((section_id, self._section_digest(section_id)) for (
+            section_id, start, end) in self.deferred_snapshots)
+
+        errors = []
+        for section, force in self.deferred_sections:
+            registration_errors = self.registration_errors
+            self.data.force = force
+            self.add_registrations_by_section(section)
+            errors.append(registration_errors != self.registration_errors)
+        self.data.force = False
+
+        for section_id, start, end in self.deferred_snapshots:
+            if digests[section_id] is not None and not any(errors[start:end]):
+                self.data.snapshots[section_id] = digests[section_id]
+
+        self.deferred_sections = []
+        self.deferred_snapshots = []
+        self.save_users()
+        return self._write()
+
+    def _add_registrations(self, section):
+        """
+        Generates the student enrollments for the passed section, or defers
+        them to build_enrollments.
+        """
+        if self.defer_enrollment:
+            self.deferred_sections.append((section, self.data.force))
+        elif self.include_enrollment:
+            self.add_registrations_by_section(section)
+
+    def _process_section(self, section, course):
         if section.is_independent_study:
             self._process_independent_study_section(section)
 
             # This handles ind. study sections that were initially created
             # in the sdb without the ind. study flag set
             if section.is_withdrawn():
-                course.priority = course.PRIORITY_NONE
-                course.save()
+                self.courses.update(course, priority=course.PRIORITY_NONE)
         else:
             self._process_primary_section(section)
 
@@ -69,15 +330,14 @@ class CourseBuilder(Builder):
             return
 
         self.data.add(TermCSV(section))
-        Course.objects.update_status(section)
+        self.courses.update_status(section)
 
         course_id = section.canvas_course_sis_id()
         primary_instructors = section.get_instructors()
 
         if len(section.linked_section_urls):
             dummy_section_id = '{}--'.format(course_id)
-            try:
-                canvas_section = get_section_by_sis_id(dummy_section_id)
+            if self.has_canvas_section(section, dummy_section_id):
                 # Section has linked sections, but was originally
                 # provisioned with a dummy section, which will be removed
                 self.logger.info(
@@ -87,8 +347,6 @@ class CourseBuilder(Builder):
                     course_id=course_id,
                     name=section_short_name(section),
                     status='deleted'))
-            except DataFailureException as ex:
-                pass
 
             for url in section.linked_section_urls:
                 try:
@@ -98,7 +356,9 @@ class CourseBuilder(Builder):
                     # Add primary section instructors to each linked section
                     self._process_linked_section(linked_section,
                                                  primary_instructors)
-                except (DataFailureException, CoursePolicyException):
+                except DataFailureException:
+                    self._incomplete_data()
+                except CoursePolicyException:
                     pass
 
         else:
@@ -108,18 +368,19 @@ class CourseBuilder(Builder):
                 for instructor in primary_instructors:
                     self.add_teacher_enrollment_data(section, instructor)
 
-                if self.include_enrollment:
-                    self.add_registrations_by_section(section)
+                self._add_registrations(section)
 
         # Check for linked sections already in the Course table
-        for linked_course_id in Course.objects.get_linked_course_ids(
-                course_id):
+        for linked_course_id in self.linked_course_ids.get(
+                course_id, Course.objects.get_linked_course_ids(course_id)):
             try:
                 linked_section = self.get_section_resource_by_id(
                     linked_course_id)
                 self._process_linked_section(linked_section,
                                              primary_instructors)
-            except (DataFailureException, CoursePolicyException):
+            except DataFailureException:
+                self._incomplete_data()
+            except CoursePolicyException:
                 pass
 
         # Iterate over joint sections
@@ -129,17 +390,22 @@ class CourseBuilder(Builder):
                 joint_section = self.get_section_resource_by_id(
                     joint_course_id)
                 self._process_primary_section(joint_section)
-            except (DataFailureException, CoursePolicyException,
+            except DataFailureException:
+                self._incomplete_data()
+            except (CoursePolicyException,
                     InvalidCanvasIndependentStudyCourse):
                 pass
 
         # Joint sections already joined to this section in the Course table
-        for joint_course_id in Course.objects.get_joint_course_ids(course_id):
+        for joint_course_id in self.joint_course_ids.get(
+                course_id, Course.objects.get_joint_course_ids(course_id)):
             try:
                 joint_section = self.get_section_resource_by_id(
                     joint_course_id)
                 self._process_primary_section(joint_section)
-            except (DataFailureException, CoursePolicyException,
+            except DataFailureException:
+                self._incomplete_data()
+            except (CoursePolicyException,
                     InvalidCanvasIndependentStudyCourse):
                 pass
 
@@ -147,19 +413,73 @@ class CourseBuilder(Builder):
 
         # Find any sections that are manually cross-listed to this course,
         # so we can update enrollments for those
+        canvas_section_ids = self.get_canvas_section_ids(section)
+        if canvas_section_ids is None:
+            try:
+                canvas_section_ids = [s.sis_section_id for s in (
+                    get_sis_sections_for_course(course_id))]
+            except DataFailureException:
+                canvas_section_ids = []
+
+        for section_sis_id in canvas_section_ids:
+            course = self.courses.get(re.sub(r'--$', '', section_sis_id))
+            if course is not None and course.queue_id is None:
+                self._process(course)
+
+    def get_canvas_section_index(self, term_id):
+        """
+        Returns the Canvas section index for the passed term, or None if the
+        index is disabled or the report fails.
+        """
+        if term_id not in self.canvas_indexes:
+            try:
+                self.canvas_indexes[term_id] = (
+                    CanvasSectionIndex.objects.get_index(term_id))
+            except (DataFailureException, ReportFailureException) as ex:
+                self.logger.info(
+                    'Canvas section index for {} failed: {}'.format(
+                        term_id, ex))
+                self.canvas_indexes[term_id] = None
+        return self.canvas_indexes[term_id]
+
+    def get_canvas_section_ids(self, section):
+        """
+        Returns the SIS IDs of the Canvas sections in the course of the
+        passed section from the term's Canvas section index, or None if the
+        course is not in the index. Immediate priority courses are always
+        looked up in Canvas.
+        """
+        if self.data.force:
+            return
+
+        index = self.get_canvas_section_index(section.term.canvas_sis_id())
+        if index is not None:
+            return index.get(section.canvas_course_sis_id())
+
+    def has_canvas_section(self, section, section_sis_id):
+        """
+        Returns True if the Canvas course of the passed section contains a
+        section with the passed SIS ID, from the term's Canvas section index
+        if the course is indexed.
+        """
+        canvas_section_ids = self.get_canvas_section_ids(section)
+        if canvas_section_ids is not None:
+            return section_sis_id in canvas_section_ids
+
         try:
-            canvas_sections = get_sis_sections_for_course(course_id)
+            self.sections.get(('canvas', section_sis_id),
+                              lambda: get_section_by_sis_id(section_sis_id))
+            return True
         except DataFailureException:
-            canvas_sections = []
+            return False
 
-        for s in canvas_sections:
-            try:
-                course_model_id = re.sub(r'--$', '', s.sis_section_id)
-                course = Course.objects.get(course_id=course_model_id,
-                                            queue_id__isnull=True)
-                self._process(course)
-            except Course.DoesNotExist:
-                pass
+    def get_section_by_url(self, url):
+        """
+        Returns the section resource for the passed url, from the section
+        memo if it has been fetched.
+        """
+        return self.sections.get(section_id_from_url(url) or url,
+                                 lambda: get_section_by_url(url))
 
     def _process_linked_section(self, section, primary_instructors=[]):
         """
@@ -180,10 +500,9 @@ class CourseBuilder(Builder):
                 for instructor in instructors:
                     self.add_teacher_enrollment_data(section, instructor)
 
-                if self.include_enrollment:
-                    self.add_registrations_by_section(section)
+                self._add_registrations(section)
 
-            Course.objects.update_status(section)
+            self.courses.update_status(section)
 
     def _process_independent_study_section(self, section):
         """
@@ -212,13 +531,12 @@ class CourseBuilder(Builder):
             self.data.add(TermCSV(section))
             self.data.add(SectionCSV(section=section))
 
-            Course.objects.update_status(section)
+            self.courses.update_status(section)
 
             if is_active_section(section):
                 self.add_teacher_enrollment_data(section, instructor)
 
-                if self.include_enrollment:
-                    self.add_registrations_by_section(section)
+                self._add_registrations(section)
 
     def _process_xlists_for_section(self, section):
         """
@@ -230,9 +548,8 @@ class CourseBuilder(Builder):
 
         course_id = section.canvas_course_sis_id()
 
-        try:
-            model = Course.objects.get(course_id=course_id)
-        except Course.DoesNotExist:
+        model = self.courses.get(course_id)
+        if model is None:
             return
 
         existing_xlist_id = model.xlist_id
@@ -242,7 +559,7 @@ class CourseBuilder(Builder):
             joint_sections = [section]
             for url in section.joint_section_urls:
                 try:
-                    joint_sections.append(get_section_by_url(url))
+                    joint_sections.append(self.get_section_by_url(url))
                 except Exception as err:
                     self.logger.info("Unable to xlist section {}: {}".format(
                         url, err))
@@ -258,13 +575,12 @@ class CourseBuilder(Builder):
             return
 
         if existing_xlist_id != new_xlist_id:
-            model.xlist_id = new_xlist_id
-            model.save()
+            self.courses.update(model, xlist_id=new_xlist_id)
 
         linked_section_ids = []
         for url in section.linked_section_urls:
             try:
-                linked_section = get_section_by_url(url)
+                linked_section = self.get_section_by_url(url)
                 linked_section_ids.append(
                     linked_section.canvas_section_sis_id())
             except DataFailureException:
@@ -285,6 +601,35 @@ class CourseBuilder(Builder):
                                        status='active'))
 
 
+def _harvest_registrations(sections):
+    try:
+        registration_data = get_registrations_by_curriculum(
+            sections[0].curriculum_abbr, sections[0].term)
+
+        return dict((section.section_label(), get_registrations_by_section(
+            section, registration_data.get(section.section_label(), [])))
+            for section in sections)
+    except Exception as ex:
+        return ex
+
+
+def _is_registration_section(section):
+    """
+    Returns True if the passed section is enrolled from its registrations:
+    an active primary section without linked sections, or an active linked
+    section.
+    """
+    return is_active_section(section) and (
+        not section.is_primary_section or
+        not len(section.linked_section_urls))
+
+
+def _registration_fingerprint(registration):
+    return [registration.person.uwregid, registration.is_active,
+            registration.request_status, registration.request_date,
+            registration.duplicate_code]
+
+
 class UnusedCourseBuilder(Builder):
     def _init_build(self, **kwargs):
         self.queue_id = kwargs.get('queue_id')
@@ -14,6 +14,7 @@ from uw_sws.exceptions import InvalidCanvasIndependentStudyCourse
 from restclients_core.exceptions import DataFailureException
 from datetime import datetime, timedelta, timezone
 from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
 
 
 class EnrollmentBuilder(Builder):
@@ -25,13 +26,9 @@ class EnrollmentBuilder(Builder):
             self.queue_id = enrollment.queue_id
 
         try:
-            enrollment.person = get_person_by_regid(enrollment.reg_id)
-
-            course_id = enrollment.course_id
-            if enrollment.instructor_reg_id is not None:
-                course_id += '-' + enrollment.instructor_reg_id
-
-            section = self.get_section_resource_by_id(course_id)
+            enrollment.person = self.get_person(enrollment.reg_id)
+            section = self.get_section_resource_by_id(
+                _section_id(enrollment))
 
             if not is_active_section(section):
                 return
@@ -130,6 +127,62 @@ class EnrollmentBuilder(Builder):
         now = datetime.now(timezone.utc)
         timeout = getattr(settings, 'MISSING_LOGIN_ID_RETRY_TIMEOUT', 48)
         self.retry_missing_id = now - timedelta(hours=timeout)
+        self.persons = {}
+
+        # Each distinct section and person is fetched once for the build
+        self.items = list(self.items)
+        self.prefetch_sections([_section_id(e) for e in self.items])
+        self.prefetch_persons([e.reg_id for e in self.items])
+        self.resolve_users([p for p in self.persons.values() if (
+            not isinstance(p, Exception))])
+
+        if len(self.items):
+            self.logger.info(
+                'Prefetched {} sections and {} persons for {} '
+                'enrollments'.format(len(self.sections), len(self.persons),
+                                     len(self.items)))
+
+    def prefetch_persons(self, reg_ids):
+        """
+        Fetches the persons for the passed regids through a pool of
+        SIS_IMPORT_PERSON_PREFETCH_THREADS threads. Fetched persons, and
+        fetch exceptions, are held for get_person.
+        """
+        pool_size = getattr(settings, 'SIS_IMPORT_PERSON_PREFETCH_THREADS', 8)
+        reg_ids = [r for r in dict.fromkeys(reg_ids) if (
+            r not in self.persons)]
+        if not pool_size or not len(reg_ids):
+            return
+
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            self.persons.update(zip(
+                reg_ids, executor.map(_fetch_person, reg_ids)))
+
+    def get_person(self, reg_id):
+        """
+        Returns the person for the passed regid, fetching it on the first
+        request. A fetch exception is raised for each request.
+        """
+        if reg_id not in self.persons:
+            self.persons[reg_id] = _fetch_person(reg_id)
+
+        person = self.persons[reg_id]
+        if isinstance(person, Exception):
+            raise person
+        return person
+
+
+def _section_id(enrollment):
+    if enrollment.instructor_reg_id is not None:
+        return enrollment.course_id + '-' + enrollment.instructor_reg_id
+    return enrollment.course_id
+
+
+def _fetch_person(reg_id):
+    try:
+        return get_person_by_regid(reg_id)
+    except Exception as ex:
+        return ex
 
 
 class InvalidEnrollmentBuilder(Builder):
@@ -13,6 +13,8 @@ class UserBuilder(Builder):
     """
     Generates the import data for the passed list of User models.
     """
+    suppress_unchanged = True
+
     def _process(self, user):
         if user.priority == user.PRIORITY_IMMEDIATE:
             RestClientsCache().delete_cached_person(user.net_id)
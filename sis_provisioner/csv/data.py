@@ -7,16 +7,93 @@ from django.core.files.storage import default_storage
 from sis_provisioner.csv.format import (
     UserHeader, AccountHeader, AdminHeader, TermHeader, CourseHeader,
     SectionHeader, EnrollmentHeader, XlistHeader, UserCSV, AccountCSV,
-    AdminCSV, TermCSV, CourseCSV, SectionCSV, EnrollmentCSV, XlistCSV)
+    AdminCSV, TermCSV, CourseCSV, SectionCSV, EnrollmentCSV, XlistCSV,
+    CSVWriter, CSVRow)
+from sis_provisioner.dao.canvas import (
+    SIS_IMPORT_ARCHIVE, SIS_IMPORT_MANIFEST, CSV_FILES, open_import_file)
+from sis_provisioner.dao.storage import (
+    get_staging_storage, upload_staged_files)
+from sis_provisioner.models import (
+    RowFingerprint, FINGERPRINT_FILE, SNAPSHOT_FILE)
+from sis_provisioner.exceptions import MissingImportPathException
 from datetime import datetime
 from logging import getLogger
+from contextlib import ExitStack
+from itertools import chain, islice
+from operator import itemgetter
+import tempfile
+import hashlib
+import zipfile
+import json
+import shutil
+import pickle
+import csv
+import heapq
 import os
 
 logger = getLogger(__name__)
 
+# Key columns of the csv files that are de-duplicated when merged
+MERGE_KEY_COLUMNS = {
+    'users.csv': ('user_id',),
+    'terms.csv': ('term_id',),
+    'courses.csv': ('course_id',),
+    'sections.csv': ('section_id',),
+    'enrollments.csv': ('course_id', 'user_id', 'role', 'role_id',
+                        'section_id'),
+}
+
+# Low-cardinality columns of each csv type, shared between stored rows
+INTERNED_COLUMNS = {
+    'accounts': (1, 3),
+    'admins': (1, 2, 3),
+    'terms': (2,),
+    'courses': (3, 4, 5),
+    'sections': (1, 3),
+    'enrollments': (0, 3, 5, 6),
+    'users': (7,),
+    'xlists': (0, 2),
+}
+
+# CSV types whose unchanged rows can be suppressed
+FINGERPRINT_TYPES = ('users', 'courses', 'sections')
+
+# CSV types imported as a Canvas diffing data set
+DIFFING_TYPES = ('courses', 'sections', 'enrollments', 'xlists')
+
 
 class Collector(object):
-    def __init__(self):
+    """
+    Collects csv data by type. Rows are stored as compact CSVRow tuples,
+    with the values of low-cardinality columns interned.
+    """
+    def __init__(self, spill_limit=None, suppress_unchanged=False):
+        """
+        If spill_limit is a positive number of rows, collected rows are
+        written to sorted temporary files each time the limit is reached,
+        and merged when the csv files are written.
+
+        If suppress_unchanged is True, user, course and section rows that are
+        identical to the rows of a recent successful import are not written,
+        unless they were added while the force attribute is True.
+
+        If the diffing attribute is True, the collected course, section,
+        enrollment and xlist rows are complete data for a Canvas diffing data
+        set, and are archived separately from other csv types, unsharded and
+        without suppression.
+
+        Section digests added to the snapshots attribute are written with
+        the csv files, and stored as section snapshots once the import
+        succeeds.
+        """
+        if spill_limit is None:
+            spill_limit = getattr(settings, 'SIS_IMPORT_CSV_SPILL_LIMIT', 0)
+        self.spill_limit = spill_limit
+        self.suppress_unchanged = suppress_unchanged and getattr(
+            settings, 'SIS_IMPORT_FINGERPRINT_DAYS', 7) > 0
+        self.force = False
+        self.diffing = False
+        self.uploads = []
         self._init_data()
 
     def _init_data(self):
@@ -27,7 +104,8 @@ class Collector(object):
         self.courses = {}
         self.sections = {}
         self.enrollments = []
-        self.enrollment_keys = {}
+        self.enrollment_keys = set()
+        self.spilled_enrollment_keys = set()
         self.xlists = []
         self.users = {}
         self.headers = {
@@ -40,6 +118,19 @@ class Collector(object):
             'enrollments': EnrollmentHeader(),
             'xlists': XlistHeader(),
         }
+        self.interned = {}
+        self.row_count = 0
+        self.spilled_runs = dict((csv_type, []) for csv_type in self.headers)
+        self.spilled_keys = {
+            'users': set(),
+            'terms': set(),
+            'courses': set(),
+            'sections': set(),
+        }
+        self.forced_keys = dict((t, set()) for t in FINGERPRINT_TYPES)
+        self.fingerprints = dict((t, {}) for t in FINGERPRINT_TYPES)
+        self.suppressed_count = 0
+        self.snapshots = {}
 
     def add(self, formatter):
         """
@@ -47,107 +138,243 @@ class Collector(object):
         the formatter is added, False otherwise.
         """
         if isinstance(formatter, UserCSV):
-            return self._add_user(formatter)
+            added = self._add_user(formatter)
         elif isinstance(formatter, EnrollmentCSV):
-            return self._add_enrollment(formatter)
+            added = self._add_enrollment(formatter)
         elif isinstance(formatter, AccountCSV):
-            return self._add_account(formatter)
+            added = self._add_account(formatter)
         elif isinstance(formatter, AdminCSV):
-            return self._add_admin(formatter)
+            added = self._add_admin(formatter)
         elif isinstance(formatter, TermCSV):
-            return self._add_term(formatter)
+            added = self._add_term(formatter)
         elif isinstance(formatter, CourseCSV):
-            return self._add_course(formatter)
+            added = self._add_course(formatter)
         elif isinstance(formatter, SectionCSV):
-            return self._add_section(formatter)
+            added = self._add_section(formatter)
         elif isinstance(formatter, XlistCSV):
-            return self._add_xlist(formatter)
+            added = self._add_xlist(formatter)
         else:
             raise TypeError(
                 'Unknown CSVFormat class: {}'.format(type(formatter)))
 
+        if added:
+            self.row_count += 1
+            if self.spill_limit and self.row_count >= self.spill_limit:
+                self._spill()
+        return added
+
+    def _compact(self, csv_type, formatter):
+        """
+        Returns the data of the passed formatter as a CSVRow, with the values
+        of low-cardinality columns interned.
+        """
+        data = list(formatter.data)
+        for idx in INTERNED_COLUMNS[csv_type]:
+            data[idx] = self.interned.setdefault(data[idx], data[idx])
+        return CSVRow(data)
+
     def _add_account(self, formatter):
         if formatter.key not in self.account_ids:
             self.account_ids[formatter.key] = True
-            self.accounts.append(formatter)
+            self.accounts.append(self._compact('accounts', formatter))
             return True
         return False
 
     def _add_admin(self, formatter):
-        self.admins.append(formatter)
+        self.admins.append(self._compact('admins', formatter))
         return True
 
     def _add_user(self, formatter):
-        if formatter.key not in self.users:
-            self.users[formatter.key] = formatter
-            return True
-        return False
+        return self._add_keyed('users', formatter)
 
     def _add_term(self, formatter):
-        if formatter.key not in self.terms:
-            self.terms[formatter.key] = formatter
-            return True
-        return False
+        return self._add_keyed('terms', formatter)
 
     def _add_course(self, formatter):
-        if formatter.key not in self.courses:
-            self.courses[formatter.key] = formatter
-            return True
-        return False
+        return self._add_keyed('courses', formatter)
 
     def _add_section(self, formatter):
-        if formatter.key not in self.sections:
-            self.sections[formatter.key] = formatter
+        return self._add_keyed('sections', formatter)
+
+    def _add_keyed(self, csv_type, formatter):
+        if self.force and csv_type in self.forced_keys:
+            self.forced_keys[csv_type].add(formatter.key)
+
+        data = getattr(self, csv_type)
+        if (formatter.key not in data and
+                formatter.key not in self.spilled_keys[csv_type]):
+            data[formatter.key] = self._compact(csv_type, formatter)
             return True
         return False
 
     def _add_enrollment(self, formatter):
-        if formatter.key not in self.enrollment_keys:
-            self.enrollment_keys[formatter.key] = True
-            self.enrollments.append(formatter)
-            return True
-        return False
+        # The enrollment row contains all of the enrollment key values
+        row = self._compact('enrollments', formatter)
+        if row in self.enrollment_keys or (
+                len(self.spilled_enrollment_keys) and
+                _row_digest(row) in self.spilled_enrollment_keys):
+            return False
+
+        self.enrollment_keys.add(row)
+        self.enrollments.append(row)
+        return True
 
     def _add_xlist(self, formatter):
-        self.xlists.append(formatter)
+        self.xlists.append(self._compact('xlists', formatter))
         return True
 
+    def _spill(self):
+        """
+        Writes the collected rows to one temporary run file per csv type,
+        sorted the same way write_files sorts them, and releases the rows.
+        Keys of spilled rows are retained for duplicate checking, as compact
+        digests for enrollment rows.
+        """
+        spill_dir = getattr(settings, 'SIS_IMPORT_CSV_SPILL_DIR', None)
+        for csv_type in self.headers:
+            data = getattr(self, csv_type)
+            if not len(data):
+                continue
+
+            run = tempfile.TemporaryFile(dir=spill_dir)
+            for row in self._rows(csv_type):
+                pickle.dump(row, run, pickle.HIGHEST_PROTOCOL)
+            run.seek(0)
+            self.spilled_runs[csv_type].append(run)
+
+            if csv_type in self.spilled_keys:
+                self.spilled_keys[csv_type].update(data.keys())
+            elif csv_type == 'enrollments':
+                self.spilled_enrollment_keys.update(
+                    _row_digest(row) for row in self.enrollment_keys)
+                self.enrollment_keys.clear()
+            data.clear()
+
+        logger.debug('Spilled {} rows to disk'.format(self.row_count))
+        self.row_count = 0
+
+    def _rows(self, csv_type):
+        """
+        Generator returning (key, data) tuples for the in-memory rows of the
+        passed csv type, in csv file order.
+        """
+        data = getattr(self, csv_type)
+        if isinstance(data, dict):
+            for key, row in sorted(data.items()):
+                yield (key, row)
+        else:
+            for row in data:
+                yield (None, row)
+
+    def _read_run(self, run):
+        try:
+            while True:
+                yield pickle.load(run)
+        except EOFError:
+            run.close()
+
+    def _data(self, csv_type):
+        """
+        Generator returning the data rows of the passed csv type, merging any
+        spilled runs with the in-memory rows.
+        """
+        runs = [self._read_run(run) for run in self.spilled_runs[csv_type]]
+        runs.append(self._rows(csv_type))
+
+        if csv_type in self.spilled_keys:
+            rows = heapq.merge(*runs, key=itemgetter(0))
+        else:
+            rows = chain(*runs)
+
+        if csv_type in self.fingerprints:
+            rows = self._changed_rows(csv_type, rows)
+
+        for key, data in rows:
+            yield data
+
+    def _changed_rows(self, csv_type, rows, batch_size=500):
+        """
+        Generator returning the passed (key, data) rows, less those that are
+        unchanged since a recent successful import. The fingerprints of the
+        returned rows are retained for recording with the import.
+        """
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not len(batch):
+                break
+
+            digests = dict((key, hashlib.sha256(
+                str(data).encode('utf-8')).hexdigest()) for key, data in batch)
+
+            unchanged = set()
+            if self.suppress_unchanged and not self.diffing:
+                unchanged = RowFingerprint.objects.find_unchanged(
+                    csv_type, digests).difference(self.forced_keys[csv_type])
+
+            for key, data in batch:
+                if key in unchanged:
+                    self.suppressed_count += 1
+                else:
+                    self.fingerprints[csv_type][key] = digests[key]
+                    yield (key, data)
+
     def has_data(self):
         """
         Returns True if the collector contains data, False otherwise.
         """
         for csv_type in self.headers:
-            if len(getattr(self, csv_type)):
+            if (len(getattr(self, csv_type)) or
+                    len(self.spilled_runs[csv_type])):
                 return True
         return False
 
     def write_files(self):
         """
-        Writes all csv files. Returns a path to the csv files, or None
-        if no data was written.
+        Writes all csv files, and zip archives of the csv files for import.
+        The archives are compressed as the csv files are written, and a new
+        archive is started each time SIS_IMPORT_SHARD_ROWS data rows have been
+        archived. If SIS_IMPORT_CSV_STAGING_DIR is set, files are written to
+        the local staging directory, and copied to default_storage in the
+        background. Returns a path to the csv files, or None if no data was
+        written.
         """
         filepath = None
         if self.has_data():
             filepath = datetime.now().strftime('%Y/%m/%d/%H%M%S-%f')
-            for csv_type in self.headers:
-                try:
-                    data = list(getattr(self, csv_type).values())
-                    data.sort()
-                except AttributeError:
-                    data = getattr(self, csv_type)
-
-                if len(data):
-                    filename = os.path.join(filepath, csv_type + '.csv')
-                    f = default_storage.open(filename, mode='w')
-
-                    try:
-                        headers = self.headers[csv_type]
-                        f.write(str(headers))
-                        for line in data:
-                            f.write(str(line))
-                    finally:
-                        f.close()
+            staging = get_staging_storage()
+            if staging is not None:
+                os.makedirs(staging.path(filepath), exist_ok=True)
+                storage = staging
+            else:
+                storage = default_storage
+
+            archive = ShardedArchive(
+                shard_rows=0 if self.diffing else getattr(
+                    settings, 'SIS_IMPORT_SHARD_ROWS', 0),
+                temp_dir=getattr(settings, 'SIS_IMPORT_CSV_SPILL_DIR', None))
+            try:
+                for filename in CSV_FILES:
+                    csv_type = filename.replace('.csv', '')
+                    if (len(getattr(self, csv_type)) or
+                            len(self.spilled_runs[csv_type])):
+                        if self.diffing:
+                            archive.set_diffing(csv_type in DIFFING_TYPES)
+                        self._write_file(
+                            storage, filepath, csv_type, archive)
+
+                archive.save(storage, filepath)
+            finally:
+                archive.close()
+
+            self._write_fingerprints(storage, filepath)
+            if len(self.snapshots):
+                self._write_json(
+                    storage, filepath, SNAPSHOT_FILE, self.snapshots)
 
+            if staging is not None:
+                self.uploads.append(upload_staged_files(filepath))
+
+            self._close_runs()
             self._init_data()
 
         if getattr(settings, 'SIS_IMPORT_CSV_DEBUG', False):
@@ -155,3 +382,225 @@ class Collector(object):
             return None
         else:
             return filepath
+
+    def _write_file(self, storage, filepath, csv_type, archive):
+        filename = csv_type + '.csv'
+        f = storage.open(os.path.join(filepath, filename), mode='w')
+        try:
+            archive.write_file(
+                f, filename, self.headers[csv_type], self._data(csv_type))
+        finally:
+            f.close()
+
+    def _write_fingerprints(self, storage, filepath):
+        if self.suppressed_count:
+            logger.info('Suppressed {} unchanged rows in {}'.format(
+                self.suppressed_count, filepath))
+
+        fingerprints = dict((t, d) for t, d in self.fingerprints.items() if (
+            len(d)))
+        if len(fingerprints):
+            self._write_json(storage, filepath, FINGERPRINT_FILE, fingerprints)
+
+    def _write_json(self, storage, filepath, filename, data):
+        f = storage.open(os.path.join(filepath, filename), mode='w')
+        try:
+            f.write(json.dumps(data))
+        finally:
+            f.close()
+
+    def _close_runs(self):
+        for run in chain(*self.spilled_runs.values()):
+            run.close()
+
+
+def _row_digest(row):
+    return hashlib.blake2b(repr(row).encode('utf-8'), digest_size=16).digest()
+
+
+def merge_files(csv_paths):
+    """
+    Writes the csv files at each of the passed paths to a new path, as a
+    single set of csv files and archives for import. Paths are passed oldest
+    first, and only the newest of the keyed rows with the same key is kept.
+    Raises MissingImportPathException if the manifest of a passed path
+    can't be read. Returns the new path.
+    """
+    for csv_path in csv_paths:
+        f = open_import_file(os.path.join(csv_path, SIS_IMPORT_MANIFEST))
+        if f is None:
+            raise MissingImportPathException(csv_path)
+        f.close()
+
+    filepath = datetime.now().strftime('%Y/%m/%d/%H%M%S-%f')
+    archive = ShardedArchive(
+        shard_rows=getattr(settings, 'SIS_IMPORT_SHARD_ROWS', 0),
+        temp_dir=getattr(settings, 'SIS_IMPORT_CSV_SPILL_DIR', None))
+    try:
+        for filename in CSV_FILES:
+            with ExitStack() as stack:
+                header = None
+                readers = []
+                for csv_path in csv_paths:
+                    # The manifest is written after the csv files, so a
+                    # missing file is a type this import doesn't have
+                    f = open_import_file(os.path.join(csv_path, filename))
+                    if f is None:
+                        continue
+
+                    reader = csv.reader(stack.enter_context(f))
+                    header = next(reader, header)
+                    readers.append(reader)
+
+                if header is not None:
+                    rows = chain(*readers)
+                    if filename in MERGE_KEY_COLUMNS:
+                        key = itemgetter(*[header.index(c) for c in (
+                            MERGE_KEY_COLUMNS[filename])])
+                        rows = dict((key(row), row) for row in rows).values()
+
+                    f = stack.enter_context(default_storage.open(
+                        os.path.join(filepath, filename), mode='w'))
+                    archive.write_file(f, filename, CSVRow(header), rows)
+
+        archive.save(default_storage, filepath)
+    finally:
+        archive.close()
+
+    return filepath
+
+
+class ArchivedFile(object):
+    """
+    Writes csv data to a storage file and to the matching archive member,
+    updating the optional digest with the written data.
+    """
+    def __init__(self, f, archive_member, digest=None):
+        self.f = f
+        self.archive_member = archive_member
+        self.digest = digest
+
+    def write(self, data):
+        self.f.write(data)
+        data = data.encode('utf-8')
+        self.archive_member.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+
+
+class ShardedArchive(object):
+    """
+    Zip archives of csv files for import, in temporary files. Once shard_rows
+    data rows have been written to an archive, following rows are written to
+    a new archive, so csv files are split across archives in the order they
+    are written. A digest of the csv content is computed as it is written.
+    """
+    def __init__(self, shard_rows=0, temp_dir=None):
+        self.shard_rows = shard_rows
+        self.temp_dir = temp_dir
+        self.archives = []
+        self.row_counts = []
+        self.diffing = []
+        self.next_diffing = False
+        self.zip_file = None
+        self.digest = hashlib.sha256()
+
+    def set_diffing(self, diffing):
+        """
+        Sets whether following csv files are part of a diffing data set,
+        starting a new archive if the current archive differs.
+        """
+        if self.zip_file is not None and self.diffing[-1] != diffing:
+            self._close_zip()
+        self.next_diffing = diffing
+
+    def write_file(self, f, filename, header, rows):
+        """
+        Writes the header and data rows of a csv file to the passed storage
+        file, and to the archives. Each archive member gets a header.
+        """
+        f.write(str(header))
+        self.digest.update(filename.encode('utf-8'))
+        self.digest.update(str(header).encode('utf-8'))
+        rows = iter(rows)
+        row = next(rows, None)
+        while True:
+            if self.zip_file is None or (row is not None and self._is_full()):
+                self._next_archive()
+
+            member = self.zip_file.open(filename, mode='w')
+            try:
+                member.write(str(header).encode('utf-8'))
+                if row is not None:
+                    if self.shard_rows:
+                        rows_left = self.shard_rows - self.row_counts[-1]
+                        data = chain([row], islice(rows, rows_left - 1))
+                    else:
+                        data = chain([row], rows)
+
+                    self.row_counts[-1] += CSVWriter(
+                        ArchivedFile(f, member, self.digest)).writerows(data)
+            finally:
+                member.close()
+
+            row = next(rows, None)
+            if row is None:
+                break
+
+    def save(self, storage, filepath):
+        """
+        Copies the archives to the passed storage, and writes a manifest
+        listing the archives in import order, with the digest of the csv
+        content.
+        """
+        self._close_zip()
+        if len(self.archives) == 1:
+            names = [SIS_IMPORT_ARCHIVE]
+        else:
+            base, ext = os.path.splitext(SIS_IMPORT_ARCHIVE)
+            names = ['{}-{:03d}{}'.format(base, idx + 1, ext) for idx in range(
+                len(self.archives))]
+
+        for name, archive in zip(names, self.archives):
+            archive.seek(0)
+            f = storage.open(os.path.join(filepath, name), mode='wb')
+            try:
+                shutil.copyfileobj(archive, f)
+            finally:
+                f.close()
+
+        f = storage.open(
+            os.path.join(filepath, SIS_IMPORT_MANIFEST), mode='w')
+        try:
+            archives = []
+            for name, count, diffing in zip(
+                    names, self.row_counts, self.diffing):
+                archives.append({'name': name, 'rows': count})
+                if diffing:
+                    archives[-1]['diffing'] = True
+
+            f.write(json.dumps({
+                'digest': self.digest.hexdigest(), 'archives': archives}))
+        finally:
+            f.close()
+
+    def close(self):
+        self._close_zip()
+        for archive in self.archives:
+            archive.close()
+
+    def _is_full(self):
+        return (self.shard_rows and self.row_counts[-1] >= self.shard_rows)
+
+    def _next_archive(self):
+        self._close_zip()
+        archive = tempfile.TemporaryFile(dir=self.temp_dir)
+        self.archives.append(archive)
+        self.row_counts.append(0)
+        self.diffing.append(self.next_diffing)
+        self.zip_file = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+
+    def _close_zip(self):
+        if self.zip_file is not None:
+            self.zip_file.close()
+            self.zip_file = None
@@ -14,9 +14,12 @@ from sis_provisioner.dao.canvas import (
     get_student_sis_import_role, get_instructor_sis_import_role,
     get_sis_import_role)
 from sis_provisioner.exceptions import EnrollmentPolicyException
+from itertools import islice
 import csv
 import io
 
+csv.register_dialect('unix_newline', lineterminator='\n')
+
 
 class CSVFormat(object):
     def __init__(self):
@@ -33,18 +36,62 @@ class CSVFormat(object):
         """
         Creates a line of csv data from the obj data attribute
         """
-        csv.register_dialect('unix_newline', lineterminator='\n')
-
-        s = io.BytesIO()
-        try:
-            csv.writer(s, dialect='unix_newline').writerow(self.data)
-        except TypeError:
-            s = io.StringIO()
-            csv.writer(s, dialect='unix_newline').writerow(self.data)
-
-        line = s.getvalue()
-        s.close()
-        return line
+        s = io.StringIO()
+        csv.writer(s, dialect='unix_newline').writerow(self.data)
+        return s.getvalue()
+
+
+class CSVRow(tuple):
+    """
+    Compact, immutable storage for the data of a CSVFormat object.
+    """
+    __slots__ = ()
+
+    @property
+    def data(self):
+        return self
+
+    def __str__(self):
+        s = io.StringIO()
+        csv.writer(s, dialect='unix_newline').writerow(self)
+        return s.getvalue()
+
+
+class CSVWriter(object):
+    """
+    Serializes rows of csv data to the passed file object through a single
+    csv writer, writing to the file in batches of batch_size rows.
+    """
+    def __init__(self, f, batch_size=1000):
+        self.f = f
+        self.batch_size = batch_size
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, dialect='unix_newline')
+
+    def write(self, formatters):
+        """
+        Writes the data of each of the passed CSVFormat objects.
+        """
+        self.writerows(formatter.data for formatter in formatters)
+
+    def writerows(self, rows):
+        """
+        Writes each of the passed data rows, returns the number of rows
+        written.
+        """
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not len(batch):
+                break
+
+            self.writer.writerows(batch)
+            self.f.write(self.buffer.getvalue())
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            count += len(batch)
+        return count
 
 
 # CSV Header classes
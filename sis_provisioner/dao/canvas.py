@@ -10,7 +10,7 @@ from uw_canvas.admins import Admins
 from uw_canvas.courses import Courses
 from uw_canvas.sections import Sections
 from uw_canvas.enrollments import Enrollments
-from uw_canvas.reports import Reports
+from uw_canvas.reports import Reports, ReportFailureException
 from uw_canvas.roles import Roles
 from uw_canvas.users import Users
 from uw_canvas.terms import Terms
@@ -18,12 +18,14 @@ from uw_canvas.external_tools import ExternalTools
 from uw_canvas.developer_keys import DeveloperKeys
 from uw_canvas.lti_registrations import LTIRegistrations
 from uw_canvas.sis_import import SISImport, CSV_FILES
-from uw_canvas.models import CanvasEnrollment, SISImport as SISImportModel
+from uw_canvas.models import (
+    CanvasEnrollment, ReportType, SISImport as SISImportModel)
 from restclients_core.exceptions import DataFailureException
 from sis_provisioner.dao.course import (
     valid_academic_course_sis_id, valid_academic_section_sis_id,
     adhoc_course_sis_id, group_section_sis_id)
 from sis_provisioner.dao.user import user_sis_id, user_integration_id
+from sis_provisioner.dao.storage import get_staging_storage
 from sis_provisioner.exceptions import CoursePolicyException
 from urllib3.exceptions import SSLError
 from logging import getLogger
@@ -38,6 +40,8 @@ AUDITOR_ENROLLMENT = 'Auditor'
 ENROLLMENT_ACTIVE = CanvasEnrollment.STATUS_ACTIVE
 ENROLLMENT_INACTIVE = CanvasEnrollment.STATUS_INACTIVE
 ENROLLMENT_DELETED = CanvasEnrollment.STATUS_DELETED
+SIS_IMPORT_ARCHIVE = 'import.zip'
+SIS_IMPORT_MANIFEST = 'manifest.json'
 
 
 def valid_canvas_id(canvas_id):
@@ -338,6 +342,17 @@ def get_active_sis_enrollments_for_user(user_sis_id, roles=[]):
 
 
 def get_course_report_data(term_sis_id=None, account_id=None):
+    return get_provisioning_report_data(
+        term_sis_id, account_id, params={'courses': True})
+
+
+def get_section_report_data(term_sis_id=None, account_id=None):
+    return get_provisioning_report_data(
+        term_sis_id, account_id, params={'sections': True})
+
+
+def get_provisioning_report_data(term_sis_id=None, account_id=None,
+                                 params={}):
     term_id = None
     if term_sis_id:
         if term_sis_id == 'default':
@@ -350,12 +365,13 @@ def get_course_report_data(term_sis_id=None, account_id=None):
         account_id = getattr(settings, 'RESTCLIENTS_CANVAS_ACCOUNT_ID', None)
 
     reports = Reports()
-    course_report = reports.create_course_provisioning_report(
-        account_id, term_id=term_id)
+    provisioning_report = reports.create_report(
+        ReportType.PROVISIONING, account_id, term_id=term_id,
+        params=dict(params))
 
-    report_data = reports.get_report_data(course_report)
+    report_data = reports.get_report_data(provisioning_report)
 
-    reports.delete_report(course_report)
+    reports.delete_report(provisioning_report)
     return report_data
 
 
@@ -387,7 +403,82 @@ def get_unused_course_report_data(term_sis_id):
     return report_data
 
 
-def sis_import_by_path(csv_path, override_sis_stickiness=False):
+def diffing_params(diffing_data_set):
+    """
+    Returns the sis import params for posting the passed diffing data set,
+    with the configured safety thresholds.
+    """
+    params = {'diffing_data_set_identifier': diffing_data_set}
+
+    change_threshold = getattr(
+        settings, 'SIS_IMPORT_DIFFING_CHANGE_THRESHOLD', 10)
+    if change_threshold:
+        params['change_threshold'] = str(change_threshold)
+
+    row_threshold = getattr(settings, 'SIS_IMPORT_DIFFING_ROW_THRESHOLD', None)
+    if row_threshold:
+        params['diff_row_count_threshold'] = str(row_threshold)
+
+    drop_status = getattr(settings, 'SIS_IMPORT_DIFFING_DROP_STATUS', None)
+    if drop_status:
+        params['diffing_drop_status'] = drop_status
+
+    return params
+
+
+def get_sis_import_manifest(csv_path):
+    """
+    Returns the manifest written for the passed csv path, listing the
+    archives in import order, and the content digest of the csv files.
+    """
+    f = open_import_file(csv_path + '/' + SIS_IMPORT_MANIFEST)
+    if f is not None:
+        with f:
+            return json.loads(f.read())
+    return {'archives': [{'name': SIS_IMPORT_ARCHIVE}]}
+
+
+def open_import_file(path, mode='r'):
+    """
+    Opens the passed import file from the local staging directory if it is
+    staged, otherwise from default_storage. Returns None if the file does
+    not exist.
+    """
+    staging = get_staging_storage()
+    if staging is not None:
+        try:
+            return staging.open(path, mode=mode)
+        except FileNotFoundError:
+            pass
+
+    if default_storage.exists(path):
+        return default_storage.open(path, mode=mode)
+
+
+def get_sis_import_archives(csv_path):
+    """
+    Returns the names of the archives written for the passed csv path, in
+    import order.
+    """
+    return [a['name'] for a in get_sis_import_manifest(csv_path)['archives']]
+
+
+def sis_import_by_path(csv_path, override_sis_stickiness=False,
+                       archive_name=SIS_IMPORT_ARCHIVE, diffing_data_set=None):
+    params = {}
+    if override_sis_stickiness:
+        params['override_sis_stickiness'] = '1'
+        params['clear_sis_stickiness'] = '1'
+
+    if diffing_data_set is not None:
+        params.update(diffing_params(diffing_data_set))
+
+    # Post the archive written alongside the csv files as a file handle
+    archive = open_import_file(csv_path + '/' + archive_name, mode='rb')
+    if archive is not None:
+        with archive:
+            return SISImport().import_archive(archive, params=params)
+
     dirs, files = default_storage.listdir(csv_path)
 
     archive = BytesIO()
@@ -401,11 +492,6 @@ def sis_import_by_path(csv_path, override_sis_stickiness=False):
     zip_file.close()
     archive.seek(0)
 
-    params = {}
-    if override_sis_stickiness:
-        params['override_sis_stickiness'] = '1'
-        params['clear_sis_stickiness'] = '1'
-
     return SISImport().import_archive(archive, params=params)
 
 
@@ -6,14 +6,17 @@ from django.conf import settings
 from uw_sws.section import (
     get_section_by_label, get_section_by_url, get_changed_sections_by_term,
     get_sections_by_instructor_and_term)
-from uw_sws.registration import get_all_registrations_by_section
+from uw_sws.registration import (
+    get_all_registrations_by_section, registration_res_url_prefix,
+    _json_to_registrations)
+from uw_sws import get_resource
 from uw_sws.models import Section
 from uw_canvas.models import CanvasCourse, CanvasSection
 from restclients_core.exceptions import DataFailureException
 from sis_provisioner.exceptions import CoursePolicyException
 from sis_provisioner.dao import titleize
 from logging import getLogger
-from urllib.parse import unquote
+from urllib.parse import unquote, urlencode
 import re
 
 logger = getLogger(__name__)
@@ -213,9 +216,18 @@ def get_new_sections_by_term(changed_since_date, term, existing={}):
     return sections
 
 
-def get_registrations_by_section(section):
-    registrations = get_all_registrations_by_section(
-        section, transcriptable_course='all', use_pws_person=True)
+def get_registrations_by_section(section, registration_data=None):
+    """
+    Returns the unique registrations for the passed section, from the
+    passed registration search data if given.
+    """
+    if registration_data is None:
+        registrations = get_all_registrations_by_section(
+            section, transcriptable_course='all', use_pws_person=True)
+    else:
+        registrations = _json_to_registrations(
+            {'Registrations': registration_data}, section,
+            include_major_class_info=False, use_pws_person=True)
 
     # Sort by regid, is_active, duplicate code
     registrations.sort(key=lambda r: (
@@ -229,6 +241,42 @@ def get_registrations_by_section(section):
     return sorted(list(uniques.values()), key=lambda r: r.regid)
 
 
+def get_registrations_by_curriculum(curriculum_abbr, term):
+    """
+    Returns a dict of {section_label: [registration data]} for all
+    registrations in the passed curriculum and term, following the paged
+    search results.
+    """
+    params = [
+        ('curriculum_abbreviation', curriculum_abbr),
+        ('instructor_reg_id', ''),
+        ('course_number', ''),
+        ('verbose', 'true'),
+        ('year', term.year),
+        ('quarter', term.quarter),
+        ('is_active', ''),
+        ('section_id', ''),
+        ('transcriptable_course', 'all'),
+    ]
+    url = '{}?{}'.format(registration_res_url_prefix, urlencode(params))
+
+    registration_data = {}
+    while url:
+        data = get_resource(url)
+        for registration in data.get('Registrations', []):
+            section = registration.get('Section', {})
+            label = '{},{},{},{}/{}'.format(
+                section.get('Year'), str(section.get('Quarter')).lower(),
+                section.get('CurriculumAbbreviation'),
+                section.get('CourseNumber'), section.get('SectionID'))
+            registration_data.setdefault(label, []).append(registration)
+
+        url = data.get('Next')
+        if isinstance(url, dict):
+            url = url.get('Href')
+    return registration_data
+
+
 def canvas_xlist_id(section_list):
     xlist_courses = []
     for section in section_list:
@@ -0,0 +1,67 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.conf import settings
+from django.core.files.storage import default_storage, FileSystemStorage
+from logging import getLogger
+from threading import Thread
+from time import sleep
+import shutil
+import os
+
+logger = getLogger(__name__)
+
+
+def get_staging_storage():
+    """
+    Returns a storage for the local csv staging directory, or None if
+    SIS_IMPORT_CSV_STAGING_DIR is not set.
+    """
+    location = getattr(settings, 'SIS_IMPORT_CSV_STAGING_DIR', None)
+    if location:
+        return FileSystemStorage(location=location)
+
+
+def upload_staged_files(filepath):
+    """
+    Copies the files staged for the passed path to default_storage in a
+    background thread, removing the staged files once copied. A failed copy
+    is retried up to SIS_IMPORT_CSV_UPLOAD_ATTEMPTS times, after which the
+    files are left staged, where open_import_file still reads them. Returns
+    the started thread.
+    """
+    thread = Thread(target=_upload_staged_files, args=(filepath,),
+                    name='upload {}'.format(filepath))
+    thread.start()
+    return thread
+
+
+def _upload_staged_files(filepath):
+    staging = get_staging_storage()
+    attempts = getattr(settings, 'SIS_IMPORT_CSV_UPLOAD_ATTEMPTS', 3)
+    for attempt in range(1, attempts + 1):
+        try:
+            dirs, files = staging.listdir(filepath)
+
+            # The json manifests are copied last, after the files they list
+            for filename in sorted(files, key=lambda f: f.endswith('.json')):
+                path = os.path.join(filepath, filename)
+                with staging.open(path, mode='rb') as src:
+                    dst = default_storage.open(path, mode='wb')
+                    try:
+                        shutil.copyfileobj(src, dst)
+                    finally:
+                        dst.close()
+            break
+
+        except Exception as ex:
+            logger.error('Upload of staged files {} failed ({}/{}): {}'.format(
+                filepath, attempt, attempts, ex))
+            if attempt == attempts:
+                return
+            sleep(2 ** attempt)
+
+    for filename in files:
+        staging.delete(os.path.join(filepath, filename))
+    os.rmdir(staging.path(filepath))
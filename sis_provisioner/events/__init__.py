@@ -3,7 +3,11 @@
 
 
 from aws_message.processor import MessageBodyProcessor, ProcessorException
-from sis_provisioner.models.enrollment import Enrollment
+from aws_message.gather import Gather
+from aws_message.message import Message
+from aws_message.sqs import SQSQueue
+from sis_provisioner.models.enrollment import (
+    Enrollment, enrollment_event_key, enrollment_event_order)
 from sis_provisioner.cache import RestClientsCache
 from sis_provisioner.exceptions import EventException
 from restclients_core.exceptions import DataFailureException
@@ -14,6 +18,9 @@ from logging import getLogger
 from base64 import b64decode
 from time import time
 from math import floor
+import threading
+import traceback
+import signal
 import json
 import re
 
@@ -28,6 +35,9 @@ prometheus_canvas_events = Counter(
 class SISProvisionerProcessor(MessageBodyProcessor):
     _re_json_cruft = re.compile(r'[^{]*({.*})[^}]*')
 
+    # EnrollmentEventBuffer holding enrollment events for a BufferedGather
+    buffer = None
+
     def __init__(self, queue_settings_name, is_encrypted):
         super(SISProvisionerProcessor, self).__init__(
                 logger, queue_settings_name, is_encrypted=is_encrypted)
@@ -142,14 +152,29 @@ class SISProvisionerProcessor(MessageBodyProcessor):
             raise ProcessorException('Cannot read: {}'.format(ex))
 
     def load_enrollments(self, enrollments):
-        enrollment_count = len(enrollments)
+        if self.buffer is not None:
+            self.buffer.add(enrollments)
+        else:
+            self._load_enrollments(enrollments, len(enrollments))
+
+    def flush_enrollments(self):
+        """
+        Loads the enrollment events held in the buffer. The buffer is
+        cleared only after the events are loaded, so an interrupted load
+        can be retried.
+        """
+        if self.buffer is not None:
+            self._load_enrollments(
+                self.buffer.enrollments(), self.buffer.event_count)
+            self.buffer.clear()
+
+    def _load_enrollments(self, enrollments, enrollment_count):
         if enrollment_count:
-            for enrollment in enrollments:
-                try:
-                    Enrollment.objects.add_enrollment(enrollment)
-                except Exception as ex:
-                    raise ProcessorException(
-                        'Load enrollment failed: {}'.format(ex))
+            try:
+                Enrollment.objects.add_enrollments(enrollments)
+            except Exception as ex:
+                raise ProcessorException(
+                    'Load enrollment failed: {}'.format(ex))
 
             try:
                 self.record_success_to_log(event_count=enrollment_count)
@@ -173,12 +198,6 @@ class SISProvisionerProcessor(MessageBodyProcessor):
 
         e.save()
 
-        if e.event_count <= 5:
-            limit = self.settings.get(
-                'EVENT_COUNT_PRUNE_AFTER_DAY', 7) * 24 * 60
-            prune = minute - limit
-            log_model.objects.filter(minute__lt=prune).delete()
-
     def check_interval(self, acceptable_silence=6*60):
         recent = self._logModel.objects.all().order_by('-minute')[:1]
         if len(recent):
@@ -187,3 +206,121 @@ class SISProvisionerProcessor(MessageBodyProcessor):
                 raise EventException(
                     'No events in the last {} hours and {} minutes'.format(
                         int(floor(delta / 60)), (delta % 60)))
+
+
+class EnrollmentEventBuffer(object):
+    """
+    Holds enrollment events, keeping only the newest event for each
+    Enrollment key, for loading in one batch.
+    """
+    def __init__(self):
+        self.events = {}
+        self.event_count = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, enrollments):
+        for enrollment in enrollments:
+            key = enrollment_event_key(enrollment)
+            current = self.events.get(key)
+            if current is None or (enrollment_event_order(enrollment) >=
+                                   enrollment_event_order(current)):
+                self.events[key] = enrollment
+        self.event_count += len(enrollments)
+
+    def enrollments(self):
+        return list(self.events.values())
+
+    def clear(self):
+        self.events = {}
+        self.event_count = 0
+
+
+class BufferedGather(Gather):
+    """
+    Gathers event messages for window seconds, holding the enrollment events
+    in an EnrollmentEventBuffer. Messages are deleted from the queue only
+    after their events are loaded, so the buffer is flushed before half of the
+    queue VISIBILITY_TIMEOUT has passed, and when the gather ends or the
+    process is terminated.
+    """
+    def __init__(self, processor=None, window=0, **kwargs):
+        super(BufferedGather, self).__init__(processor=processor, **kwargs)
+        self._processor.buffer = EnrollmentEventBuffer()
+        self.window = window
+        self.visibility_timeout = self._settings.get(
+            'VISIBILITY_TIMEOUT', SQSQueue.DEFAULT_VISIBILITY_TIMEOUT)
+        self.pending = []
+        self.received = None
+
+    def gather_events(self):
+        started = time()
+        is_main_thread = (
+            threading.current_thread() is threading.main_thread())
+        if is_main_thread:
+            sigterm_handler = signal.signal(signal.SIGTERM, _terminate)
+
+        try:
+            while True:
+                messages = self._queue.get_messages()
+                received = time()
+                for msg in messages:
+                    if self._process_message(msg):
+                        if not len(self.pending):
+                            self.received = received
+                        self.pending.append(msg)
+
+                if self.is_flush_due():
+                    self.flush()
+
+                if not len(messages) or time() - started >= self.window:
+                    break
+        finally:
+            self.flush()
+            if is_main_thread:
+                signal.signal(signal.SIGTERM, sigterm_handler)
+
+    def is_flush_due(self):
+        return len(self.pending) > 0 and time() - self.received >= min(
+            self.window, self.visibility_timeout / 2)
+
+    def flush(self):
+        """
+        Loads the buffered enrollment events, and deletes their messages from
+        the queue. Messages are left for redelivery if the load fails. If
+        the load is interrupted, by SystemExit from SIGTERM, the buffer and
+        pending messages are kept for the flush at the end of the gather.
+        """
+        if not len(self.pending):
+            return
+
+        try:
+            self._processor.flush_enrollments()
+        except ProcessorException as err:
+            logger.error('Flush of {} messages failed: {}'.format(
+                len(self.pending), err))
+            self._processor.buffer.clear()
+        else:
+            for msg in self.pending:
+                msg.delete()
+        self.pending = []
+        self.received = None
+
+    def _process_message(self, msg):
+        try:
+            message = Message(json.loads(msg.body), self._settings)
+            if message.validate():
+                self._processor.process(message.extract())
+            else:
+                logger.debug('GATHER: Message validation failure')
+            return True
+
+        except (CryptoException, ProcessorException) as err:
+            logger.error('{}: {}'.format(
+                err, traceback.format_exc().splitlines()))
+            return False
+
+
+def _terminate(signum, frame):
+    raise SystemExit(signum)
@@ -0,0 +1,59 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import CommandError
+from sis_provisioner.management.commands import SISProvisionerCommand
+from sis_provisioner.models import Import
+from sis_provisioner.csv.data import merge_files
+from sis_provisioner.dao.canvas import SIS_IMPORT_MANIFEST
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Command(SISProvisionerCommand):
+    help = "Merges small pending imports into as few sis imports as possible."
+
+    def handle(self, *args, **options):
+        try:
+            for imports in self.coalesced_imports():
+                if len(imports) == 1:
+                    imports[0].import_csv(coalesce=False)
+                else:
+                    csv_path = merge_files([imp.csv_path for imp in imports])
+                    logger.info('Coalesced imports {} into {}'.format(
+                        ', '.join(str(imp.pk) for imp in imports), csv_path))
+                    imports[0].import_coalesced(csv_path, imports[1:])
+            self.update_job()
+        except Exception as err:
+            logger.error("{}".format(err))
+            raise CommandError(err)
+
+    def coalesced_imports(self):
+        """
+        Returns lists of pending imports with compatible import params, each
+        with fewer than SIS_IMPORT_COALESCE_ROWS rows in total, in the order
+        the imports were added. Imports whose manifest isn't yet uploaded
+        to default_storage are left for a later run.
+        """
+        ceiling = getattr(settings, 'SIS_IMPORT_COALESCE_ROWS', 0)
+        groups = {}
+        for imp in Import.objects.find_by_csv_ready():
+            if not default_storage.exists(
+                    imp.csv_path + '/' + SIS_IMPORT_MANIFEST):
+                logger.info('Import {} not yet uploaded, {}'.format(
+                    imp.pk, imp.csv_path))
+                continue
+
+            row_count = imp.csv_row_count() or 0
+            packs = groups.setdefault(imp.override_sis_stickiness, [])
+            if not len(packs) or packs[-1]['rows'] + row_count >= ceiling:
+                packs.append({'rows': 0, 'imports': []})
+            packs[-1]['rows'] += row_count
+            packs[-1]['imports'].append(imp)
+
+        return [pack['imports'] for packs in groups.values() for (
+            pack) in packs]
@@ -3,10 +3,16 @@
 
 from sis_provisioner.management.commands import SISProvisionerCommand
 from sis_provisioner.dao.term import get_current_active_term, get_term_after
+from sis_provisioner.models import Import
 from sis_provisioner.models.course import Course
+from sis_provisioner.models.user import User
 from sis_provisioner.exceptions import (
     EmptyQueueException, MissingImportPathException)
 from sis_provisioner.builders.courses import CourseBuilder
+from django.conf import settings
+from django.db import connections
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import traceback
 
 
@@ -23,6 +29,13 @@ class Command(SISProvisionerCommand):
             'term', type=str, default='current', choices=[
                 'current', 'next', 'future', 'any'],
             help='Import courses for term <term>')
+        parser.add_argument(
+            '--diffing', action='store_true', default=False,
+            help='Import all courses for term <term> as a diffing data set')
+        parser.add_argument(
+            '--defer-enrollment', action='store_true', default=False,
+            help=('Import courses and sections before building their student '
+                  'enrollments, which follow in a second import'))
 
     def get_term(self, relative):
         match relative:
@@ -39,26 +52,98 @@ class Command(SISProvisionerCommand):
     def handle(self, *args, **options):
         priority = options.get('priority')
         relative_term = options.get('term')
+        include_enrollment = relative_term != 'future'
+        defer_enrollment = options.get('defer_enrollment')
         try:
             term = self.get_term(relative_term)
-            imp = Course.objects.queue_by_priority(priority, term=term)
+            if options.get('diffing') and term is not None:
+                imports = [Course.objects.queue_by_term(
+                    term, include_enrollment=include_enrollment)]
+            elif term is None:
+                imports = Course.objects.queue_by_priority_per_term(priority)
+            else:
+                imports = [Course.objects.queue_by_priority(
+                    priority, term=term)]
         except EmptyQueueException as ex:
             self.update_job()
             return
 
-        include_enrollment = relative_term != 'future'
+        processes = getattr(settings, 'SIS_IMPORT_COURSE_TERM_PROCESSES', 2)
+        if processes > 1 and len(imports) > 1:
+            # Each term is built in its own process, with its own db
+            # connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                    max_workers=min(processes, len(imports)),
+                    mp_context=multiprocessing.get_context('fork')) as pool:
+                futures = [pool.submit(
+                    build_import, imp.pk, include_enrollment,
+                    defer_enrollment) for imp in imports]
+            for future in futures:
+                future.result()
+        else:
+            for imp in imports:
+                build_import(imp.pk, include_enrollment, defer_enrollment)
+
+        self.update_job()
+
+
+def build_import(import_id, include_enrollment=True, defer_enrollment=False):
+    """
+    Builds and posts the csv data for the courses queued by the passed
+    import. If defer_enrollment is True, the course and section data is
+    posted before the student enrollment data is built, which is posted in
+    a second import that follows the first. Neither import of the pair is
+    held for coalescing, which would reorder them.
+    """
+    imp = Import.objects.get(pk=import_id)
+    builder = CourseBuilder(imp.queued_objects())
+    try:
+        imp.csv_path = builder.build(
+            include_enrollment=include_enrollment,
+            diffing=imp.diffing_data_set is not None,
+            defer_enrollment=defer_enrollment)
+    except Exception:
+        imp.csv_errors = traceback.format_exc()
+
+    follow_up = None
+    if imp.csv_errors is None and builder.defer_enrollment:
+        # Created before the first import is posted, so that its models
+        # are not dequeued until both imports are done
+        follow_up = Import(priority=imp.priority, csv_type=imp.csv_type,
+                           follows_import_id=imp.pk)
+        follow_up.save()
+
+    imp.save()
+    post_import(imp, coalesce=follow_up is None)
+
+    if follow_up is not None:
+        if imp.pk is None:
+            # The first import was empty and deleted, its queued models are
+            # left for the follow-up, which is no longer two-phase
+            Course.objects.queued(follow_up.follows_import_id).update(
+                queue_id=follow_up.pk)
+            User.objects.queued(follow_up.follows_import_id).update(
+                queue_id=follow_up.pk)
+            follow_up.follows_import_id = None
+
         try:
-            builder = CourseBuilder(imp.queued_objects())
-            imp.csv_path = builder.build(include_enrollment=include_enrollment)
+            follow_up.csv_path = builder.build_enrollments()
         except Exception:
-            imp.csv_errors = traceback.format_exc()
+            follow_up.csv_errors = traceback.format_exc()
 
-        imp.save()
+        follow_up.save()
+        post_import(follow_up, coalesce=False)
 
-        try:
-            imp.import_csv()
-        except MissingImportPathException as ex:
-            if not imp.csv_errors:
-                imp.delete()
+    # Staged files upload in background threads, which a worker process
+    # would not wait for on exit
+    for upload in builder.data.uploads:
+        upload.join()
 
-        self.update_job()
+
+def post_import(imp, coalesce=True):
+    try:
+        imp.import_csv(coalesce=coalesce)
+    except MissingImportPathException as ex:
+        if not imp.csv_errors:
+            imp.delete()
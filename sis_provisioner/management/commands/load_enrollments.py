@@ -4,6 +4,7 @@
 
 from django.core.management.base import CommandError
 from sis_provisioner.management.commands import SISProvisionerCommand
+from sis_provisioner.events import BufferedGather
 from sis_provisioner.events.enrollment import EnrollmentProcessor
 from sis_provisioner.exceptions import EventException
 from aws_message.gather import Gather, GatherException
@@ -20,7 +21,15 @@ class Command(SISProvisionerCommand):
 
     def handle(self, *args, **options):
         try:
-            Gather(processor=EnrollmentProcessor()).gather_events()
+            processor = EnrollmentProcessor()
+            window = processor.get_queue_settings().get(
+                'EVENT_BUFFER_WINDOW', 0)
+            if window:
+                gather = BufferedGather(processor=processor, window=window)
+            else:
+                gather = Gather(processor=processor)
+
+            gather.gather_events()
             self.update_job()
         except GatherException as err:
             raise CommandError(err)
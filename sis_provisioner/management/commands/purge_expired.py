@@ -0,0 +1,28 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.core.management.base import CommandError
+from sis_provisioner.management.commands import SISProvisionerCommand
+from sis_provisioner.models.retention import purge_expired
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Command(SISProvisionerCommand):
+    help = "Deletes expired rows following the RETENTION_POLICIES setting."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'policy', nargs='*', help='Retention policy names to purge')
+
+    def handle(self, *args, **options):
+        try:
+            deleted = purge_expired(names=options['policy'])
+            logger.info('Purged {} expired rows'.format(
+                sum(deleted.values())))
+            self.update_job()
+        except Exception as err:
+            logger.error("{}".format(err))
+            raise CommandError(err)
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis_provisioner', '0027_override_sis_stickiness'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RowFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('csv_type', models.SlugField(max_length=20)),
+                ('sis_id', models.CharField(max_length=80)),
+                ('digest', models.CharField(max_length=64)),
+                ('imported_date', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('csv_type', 'sis_id')},
+            },
+        ),
+    ]
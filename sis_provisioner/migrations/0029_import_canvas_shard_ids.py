@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis_provisioner', '0028_rowfingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='import',
+            name='canvas_shard_ids',
+            field=models.TextField(null=True),
+        ),
+    ]
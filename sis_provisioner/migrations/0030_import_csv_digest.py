@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis_provisioner', '0029_import_canvas_shard_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='import',
+            name='csv_digest',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
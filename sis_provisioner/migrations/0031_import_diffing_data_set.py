@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis_provisioner', '0030_import_csv_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='import',
+            name='diffing_data_set',
+            field=models.CharField(max_length=80, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis_provisioner', '0031_import_diffing_data_set'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SectionSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('section_id', models.CharField(max_length=80, unique=True)),
+                ('digest', models.CharField(max_length=64)),
+                ('provisioned_date', models.DateTimeField()),
+            ],
+        ),
+    ]
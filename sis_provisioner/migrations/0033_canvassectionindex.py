@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis_provisioner', '0032_sectionsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CanvasSectionIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term_id', models.CharField(max_length=20, unique=True)),
+                ('index_data', models.TextField()),
+                ('indexed_date', models.DateTimeField()),
+            ],
+        ),
+    ]
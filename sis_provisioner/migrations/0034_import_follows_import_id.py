@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sis_provisioner', '0033_canvassectionindex'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='import',
+            name='follows_import_id',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -2,21 +2,26 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
+from django.conf import settings
 from django.db import models
 from django.db.models import Q
 from django.utils.timezone import localtime
 from sis_provisioner.dao.canvas import (
-    sis_import_by_path, get_sis_import_status, delete_sis_import)
+    sis_import_by_path, get_sis_import_manifest, get_sis_import_status,
+    delete_sis_import, open_import_file)
 from sis_provisioner.exceptions import MissingImportPathException
 from restclients_core.exceptions import DataFailureException
 from importlib import import_module
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from logging import getLogger
 import json
 import re
 
 logger = getLogger(__name__)
 
+FINGERPRINT_FILE = 'fingerprints.json'
+SNAPSHOT_FILE = 'snapshots.json'
+
 
 class Job(models.Model):
     """ Represents provisioning commands.
@@ -73,6 +78,47 @@ class ImportManager(models.Manager):
             canvas_id__isnull=False,
             post_status=200)
 
+    def find_by_csv_ready(self):
+        """
+        Returns imports whose csv files were deferred for coalescing, in
+        the order they were added.
+        """
+        return super(ImportManager, self).get_queryset().filter(
+            csv_path__isnull=False,
+            csv_digest__isnull=False,
+            csv_errors__isnull=True,
+            post_status__isnull=True,
+            canvas_id__isnull=True
+        ).order_by('added_date', 'pk')
+
+    def find_by_csv_digest(self, sis_import):
+        """
+        Returns the most recently posted import if it has the same csv
+        content and params as the passed import, and is pending or imported
+        in Canvas, or None. An import posted in between, of any type, may
+        have changed the same rows, so older matches are not returned.
+        """
+        minutes = getattr(settings, 'SIS_IMPORT_DEDUP_MINUTES', 10)
+        if not sis_import.csv_digest or not minutes:
+            return None
+
+        added_dt = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+        latest = super(ImportManager, self).get_queryset().filter(
+            added_date__gte=added_dt,
+            canvas_id__isnull=False,
+            post_status=200
+        ).exclude(
+            pk=sis_import.pk
+        ).order_by('-added_date', '-pk').first()
+
+        if (latest is not None and
+                latest.csv_digest == sis_import.csv_digest and
+                latest.override_sis_stickiness == (
+                    sis_import.override_sis_stickiness) and
+                latest.canvas_errors is None and
+                not re.match(r'^(failed|aborted)', latest.canvas_state or '')):
+            return latest
+
 
 class Import(models.Model):
     """ Represents a set of files that have been queued for import.
@@ -93,6 +139,8 @@ class Import(models.Model):
     csv_type = models.SlugField(max_length=20, choices=CSV_TYPE_CHOICES)
     csv_path = models.CharField(max_length=80, null=True)
     csv_errors = models.TextField(null=True)
+    csv_digest = models.CharField(max_length=64, null=True)
+    diffing_data_set = models.CharField(max_length=80, null=True)
     added_date = models.DateTimeField(auto_now_add=True)
     priority = models.SmallIntegerField(
         default=ImportResource.PRIORITY_DEFAULT,
@@ -102,10 +150,12 @@ class Import(models.Model):
     monitor_date = models.DateTimeField(null=True)
     monitor_status = models.SmallIntegerField(null=True)
     canvas_id = models.CharField(max_length=30, null=True)
+    canvas_shard_ids = models.TextField(null=True)
     canvas_state = models.CharField(max_length=80, null=True)
     canvas_progress = models.SmallIntegerField(default=0)
     canvas_warnings = models.TextField(null=True)
     canvas_errors = models.TextField(null=True)
+    follows_import_id = models.IntegerField(null=True)
 
     objects = ImportManager()
 
@@ -134,54 +184,172 @@ class Import(models.Model):
             "canvas_id": self.canvas_id,
         }
 
-    def import_csv(self):
+    def import_csv(self, coalesce=True):
         """
-        Imports all csv files for the passed import object, as a zipped
-        archive.
+        Imports all csv files for the passed import object, as one or more
+        zipped archives. Archives are posted in order, and the Canvas id of
+        each is stored. If identical csv content was recently posted, the
+        import is attached to the existing Canvas import, and None is returned.
+        Small imports are left for coalesce_imports to post, unless coalesce
+        is False, and None is returned.
         """
         if not self.csv_path:
             raise MissingImportPathException()
 
+        manifest = get_sis_import_manifest(self.csv_path)
+        self.csv_digest = manifest.get('digest')
+
+        duplicate = Import.objects.find_by_csv_digest(self)
+        if duplicate is not None:
+            logger.info('Import {} matches import {}, canvas_id {}'.format(
+                self.pk, duplicate.pk, duplicate.canvas_id))
+            self.attach_to(duplicate)
+            return None
+
+        if coalesce and self.is_coalescable(manifest):
+            logger.info('Import {} deferred for coalescing'.format(self.pk))
+            self.save()
+            return None
+
+        return self._post_archives(self.csv_path, manifest)
+
+    def import_coalesced(self, csv_path, imports):
+        """
+        Imports the csv files at the passed path, merged from the csv files
+        of this import and the passed imports. The passed imports are
+        attached to the resulting Canvas import.
+        """
+        sis_import = self._post_archives(
+            csv_path, get_sis_import_manifest(csv_path))
+        for imp in imports:
+            imp.attach_to(self)
+        return sis_import
+
+    def attach_to(self, sis_import):
+        """
+        Shares the Canvas import of the passed import.
+        """
+        self.post_status = sis_import.post_status
+        self.canvas_id = sis_import.canvas_id
+        self.canvas_shard_ids = sis_import.canvas_shard_ids
+        self.canvas_state = sis_import.canvas_state
+        self.canvas_progress = sis_import.canvas_progress
+        self.canvas_errors = sis_import.canvas_errors
+        self.save()
+
+    def is_coalescable(self, manifest):
+        ceiling = getattr(settings, 'SIS_IMPORT_COALESCE_ROWS', 0)
+        row_count = self.csv_row_count(manifest)
+        return (ceiling > 0 and
+                self.priority < ImportResource.PRIORITY_IMMEDIATE and
+                self.diffing_data_set is None and
+                len(manifest['archives']) == 1 and
+                row_count is not None and row_count < ceiling)
+
+    def csv_row_count(self, manifest=None):
+        """
+        Returns the number of data rows in the csv files of this import, or
+        None if the count is unknown.
+        """
+        if manifest is None:
+            manifest = get_sis_import_manifest(self.csv_path)
+        try:
+            return sum(archive['rows'] for archive in manifest['archives'])
+        except KeyError:
+            return None
+
+    def _post_archives(self, csv_path, manifest):
         sis_import = None
+        canvas_ids = []
         try:
-            sis_import = sis_import_by_path(self.csv_path,
-                                            self.override_sis_stickiness)
+            for archive in manifest['archives']:
+                sis_import = self._post_archive(csv_path, archive)
+                canvas_ids.append(sis_import.import_id)
+
             self.post_status = 200
-            self.canvas_id = sis_import.import_id
             self.canvas_state = sis_import.workflow_state
         except DataFailureException as ex:
             self.post_status = ex.status
             self.canvas_errors = ex
 
+        if len(canvas_ids):
+            self.canvas_id = canvas_ids[0]
+        if len(canvas_ids) > 1:
+            self.canvas_shard_ids = json.dumps(canvas_ids)
+
         self.save()
 
         return sis_import
 
+    def _post_archive(self, csv_path, archive):
+        """
+        Posts the passed archive, as part of the import's diffing data set
+        if the archive contains diffing data. If the diffing import is not
+        accepted, the archive is posted as a full import.
+        """
+        if self.diffing_data_set and archive.get('diffing'):
+            try:
+                return sis_import_by_path(
+                    csv_path, self.override_sis_stickiness, archive['name'],
+                    diffing_data_set=self.diffing_data_set)
+            except DataFailureException as ex:
+                logger.info('Diffing import {} failed: {}'.format(
+                    self.diffing_data_set, ex))
+
+        return sis_import_by_path(
+            csv_path, self.override_sis_stickiness, archive['name'])
+
+    def shard_ids(self):
+        """
+        Returns the Canvas ids of all archives posted for this import.
+        """
+        if self.canvas_shard_ids:
+            return json.loads(self.canvas_shard_ids)
+        return [self.canvas_id]
+
     def update_import_status(self):
         """
-        Updates import attributes, based on the sis import resource.
+        Updates import attributes, based on the sis import resources. A
+        sharded import is complete when all of its archives are complete.
         """
         try:
-            sis_import = get_sis_import_status(self.canvas_id)
+            sis_imports = [
+                get_sis_import_status(canvas_id) for canvas_id in (
+                    self.shard_ids())]
             self.monitor_status = 200
             self.monitor_date = datetime.now(timezone.utc)
-            self.canvas_state = sis_import.workflow_state
-            self.canvas_progress = sis_import.progress
+
+            # The state of the first archive not cleanly imported
+            states = [sis_import.workflow_state for sis_import in sis_imports]
+            self.canvas_state = next(
+                (s for s in states if s != 'imported'), states[-1])
+            self.canvas_progress = min(
+                sis_import.progress for sis_import in sis_imports)
             self.canvas_warnings = None
             self.canvas_errors = None
 
-            warnings = self._process_warnings(sis_import.processing_warnings)
+            warnings = []
+            errors = []
+            for sis_import in sis_imports:
+                warnings.extend(self._process_warnings(
+                    sis_import.processing_warnings))
+                errors.extend(sis_import.processing_errors)
+
             if len(warnings):
                 self.canvas_warnings = json.dumps(warnings)
 
-            if len(sis_import.processing_errors):
-                self.canvas_errors = json.dumps(sis_import.processing_errors)
+            if len(errors):
+                self.canvas_errors = json.dumps(errors)
 
         except (DataFailureException, KeyError) as ex:
             logger.info('Monitor error: {}'.format(ex))
             return
 
         if self.is_cleanly_imported():
+            RowFingerprint.objects.record_import(self)
+            linked = self.linked_import()
+            if linked is None or linked.is_imported():
+                SectionSnapshot.objects.record_import(self)
             self.delete()
         else:
             self.save()
@@ -202,6 +370,27 @@ class Import(models.Model):
                 self.canvas_state is not None and
                 re.match(r'^imported', self.canvas_state) is not None)
 
+    def is_failed(self):
+        return (self.csv_errors is not None or
+                self.post_status not in (None, 200) or
+                (self.is_completed() and not self.is_imported()))
+
+    def is_done(self):
+        return self.is_failed() or self.is_imported()
+
+    def is_empty(self):
+        return (self.csv_path is None and self.csv_errors is None and
+                self.canvas_id is None)
+
+    def linked_import(self):
+        """
+        Returns the other import of a two-phase import, or None if this is
+        not a two-phase import, or the other import is done and deleted.
+        """
+        if self.follows_import_id is not None:
+            return Import.objects.filter(pk=self.follows_import_id).first()
+        return Import.objects.filter(follows_import_id=self.pk).first()
+
     def dependent_model(self):
         model_cls = self.get_csv_type_display()
         try:
@@ -215,17 +404,177 @@ class Import(models.Model):
         return self.dependent_model().objects.queued(self.pk)
 
     def dequeue_dependent_models(self):
-        self.dependent_model().objects.dequeue(self)
+        """
+        Dequeues the models queued for this import. The models of a
+        two-phase import are queued for the first import, and dequeued once
+        both imports are done, as imported only if neither import failed.
+        """
+        linked = self.linked_import()
+        if linked is None and self.follows_import_id is None:
+            return self.dependent_model().objects.dequeue(self)
+
+        imported = self.is_imported() or self.is_empty()
+        if linked is not None and not linked.is_done() and imported:
+            return
+
+        imported = imported and (linked is None or linked.is_imported())
+        queue = Import(
+            pk=self.follows_import_id or self.pk, csv_type=self.csv_type,
+            priority=self.priority,
+            monitor_date=self.monitor_date or datetime.now(timezone.utc))
+        if imported:
+            queue.post_status = 200
+            queue.canvas_progress = 100
+            queue.canvas_state = 'imported'
+        self.dependent_model().objects.dequeue(queue)
 
     def delete(self, *args, **kwargs):
         self.dequeue_dependent_models()
-        if not self.is_completed():
-            try:
-                delete_sis_import(self.canvas_id)
-            except DataFailureException as ex:
-                logger.info('PUT sis_import failed: {}'.format(ex))
+        if not self.is_completed() and not self.shares_canvas_import():
+            for canvas_id in self.shard_ids():
+                try:
+                    delete_sis_import(canvas_id)
+                except DataFailureException as ex:
+                    logger.info('PUT sis_import failed: {}'.format(ex))
         return super(Import, self).delete(*args, **kwargs)
 
+    def shares_canvas_import(self):
+        """
+        Returns True if another import is attached to this import's Canvas
+        import, False otherwise.
+        """
+        return (self.canvas_id is not None and Import.objects.filter(
+            canvas_id=self.canvas_id).exclude(pk=self.pk).exists())
+
     def _process_warnings(self, warnings):
         return [w for w in warnings if not re.search(
             '-(MSIS|THLEAD)-(480|550|601)-', w[-1])]
+
+
+class RowFingerprintManager(models.Manager):
+    def find_unchanged(self, csv_type, digests):
+        """
+        Returns the set of SIS IDs in the passed dict of {sis_id: digest}
+        whose digest matches the row content of a recent successful import.
+        """
+        imported_dt = datetime.now(timezone.utc) - timedelta(
+            days=getattr(settings, 'SIS_IMPORT_FINGERPRINT_DAYS', 7))
+
+        unchanged = set()
+        for sis_id, digest in super().get_queryset().filter(
+                csv_type=csv_type,
+                sis_id__in=list(digests.keys()),
+                imported_date__gte=imported_dt).values_list(
+                    'sis_id', 'digest'):
+            if digests.get(sis_id) == digest:
+                unchanged.add(sis_id)
+        return unchanged
+
+    def record_import(self, sis_import):
+        """
+        Stores the row fingerprints written with the passed import.
+        """
+        data = _read_import_json(sis_import, FINGERPRINT_FILE)
+        if data is None:
+            return
+
+        imported_date = sis_import.monitor_date or datetime.now(timezone.utc)
+        fingerprints = []
+        for csv_type, rows in data.items():
+            for sis_id, digest in rows.items():
+                fingerprints.append(RowFingerprint(
+                    csv_type=csv_type, sis_id=sis_id, digest=digest,
+                    imported_date=imported_date))
+
+        super().get_queryset().bulk_create(
+            fingerprints, batch_size=500, update_conflicts=True,
+            unique_fields=['csv_type', 'sis_id'],
+            update_fields=['digest', 'imported_date'])
+
+
+class RowFingerprint(models.Model):
+    """ Represents the content of a row in the last successful import
+        containing the row's SIS ID.
+    """
+    csv_type = models.SlugField(max_length=20)
+    sis_id = models.CharField(max_length=80)
+    digest = models.CharField(max_length=64)
+    imported_date = models.DateTimeField()
+
+    objects = RowFingerprintManager()
+
+    class Meta:
+        unique_together = ('csv_type', 'sis_id')
+
+
+class SectionSnapshotManager(models.Manager):
+    def find_unchanged(self, digests):
+        """
+        Returns the set of section IDs in the passed dict of
+        {section_id: digest} whose digest matches the section data of a
+        successful import within the last SIS_IMPORT_SNAPSHOT_HOURS.
+        """
+        hours = getattr(settings, 'SIS_IMPORT_SNAPSHOT_HOURS', 24)
+        if not hours or not len(digests):
+            return set()
+
+        provisioned_dt = datetime.now(timezone.utc) - timedelta(hours=hours)
+
+        unchanged = set()
+        for section_id, digest in super().get_queryset().filter(
+                section_id__in=list(digests.keys()),
+                provisioned_date__gte=provisioned_dt).values_list(
+                    'section_id', 'digest'):
+            if digests.get(section_id) == digest:
+                unchanged.add(section_id)
+        return unchanged
+
+    def record_import(self, sis_import):
+        """
+        Stores the section snapshots written with the passed import.
+        """
+        data = _read_import_json(sis_import, SNAPSHOT_FILE)
+        if data is None:
+            return
+
+        provisioned_date = (
+            sis_import.monitor_date or datetime.now(timezone.utc))
+        super().get_queryset().bulk_create([
+            SectionSnapshot(section_id=section_id, digest=digest,
+                            provisioned_date=provisioned_date)
+            for section_id, digest in data.items()
+        ], batch_size=500, update_conflicts=True,
+            unique_fields=['section_id'],
+            update_fields=['digest', 'provisioned_date'])
+
+
+class SectionSnapshot(models.Model):
+    """ Represents the section data of the last successful import of a
+        course, including its linked and joint sections.
+    """
+    section_id = models.CharField(max_length=80, unique=True)
+    digest = models.CharField(max_length=64)
+    provisioned_date = models.DateTimeField()
+
+    objects = SectionSnapshotManager()
+
+
+def _read_import_json(sis_import, filename):
+    """
+    Returns the json data of the passed file written with the import, or
+    None if the file does not exist. Staged files are read before they are
+    uploaded.
+    """
+    if not sis_import.csv_path:
+        return
+
+    path = sis_import.csv_path + '/' + filename
+    try:
+        f = open_import_file(path)
+        if f is None:
+            return
+
+        with f:
+            return json.loads(f.read())
+    except Exception as ex:
+        logger.info('Import file read failed {}: {}'.format(path, ex))
@@ -2,7 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import F, Q
 from django.conf import settings
 from django.utils.timezone import localtime
@@ -12,13 +12,17 @@ from sis_provisioner.models.user import User
 from sis_provisioner.models.term import Term
 from sis_provisioner.dao.course import (
     valid_canvas_course_id, valid_course_sis_id, valid_canvas_section,
-    valid_academic_course_sis_id, get_new_sections_by_term)
-from sis_provisioner.dao.canvas import create_course, delete_course
+    valid_academic_course_sis_id, valid_academic_section_sis_id,
+    get_new_sections_by_term)
+from sis_provisioner.dao.canvas import (
+    create_course, delete_course, get_section_report_data)
 from sis_provisioner.dao.term import get_current_active_term
 from sis_provisioner.exceptions import (
     CoursePolicyException, EmptyQueueException)
 from restclients_core.exceptions import DataFailureException
 from datetime import datetime, timedelta, timezone
+from csv import DictReader
+import json
 
 
 class CourseManager(models.Manager):
@@ -88,8 +92,52 @@ class CourseManager(models.Manager):
             xlist_id=course_id).exclude(course_id=course_id).values_list(
                 'course_id', flat=True)
 
+    def get_related_course_ids(self, course_ids):
+        """
+        Returns dicts of the linked and joint course ids for each of the
+        passed course ids, in two queries.
+        """
+        linked = dict((course_id, []) for course_id in course_ids)
+        joint = dict((course_id, []) for course_id in course_ids)
+
+        for primary_id, course_id in super().get_queryset().filter(
+                primary_id__in=course_ids).values_list(
+                    'primary_id', 'course_id'):
+            linked[primary_id].append(course_id)
+
+        for xlist_id, course_id in super().get_queryset().filter(
+                xlist_id__in=course_ids).values_list('xlist_id', 'course_id'):
+            if course_id != xlist_id:
+                joint[xlist_id].append(course_id)
+
+        return linked, joint
+
     def queue_by_priority(self, priority, term=None):
-        filter_limit = settings.SIS_IMPORT_LIMIT['course']['default']
+        return self._queue_by_priority(
+            priority, term.canvas_sis_id() if term is not None else None)
+
+    def queue_by_priority_per_term(self, priority):
+        """
+        Queues the courses with the passed priority in one import per term,
+        each limited to SIS_IMPORT_LIMIT courses, so that a backlog in one
+        term does not hold back the courses of another.
+        """
+        term_ids = self._queueable(priority).values_list(
+            'term_id', flat=True).order_by('term_id').distinct()
+
+        imports = []
+        for term_id in term_ids:
+            try:
+                imports.append(self._queue_by_priority(priority, term_id))
+            except EmptyQueueException:
+                pass
+
+        if not len(imports):
+            raise EmptyQueueException()
+
+        return imports
+
+    def _queueable(self, priority, term_id=None):
         kwargs = {
             'priority': priority,
             'course_type': Course.SDB_TYPE,
@@ -97,10 +145,14 @@ class CourseManager(models.Manager):
             'provisioned_error__isnull': True,
             'archived_date__isnull': True
         }
-        if term is not None:
-            kwargs['term_id'] = term.canvas_sis_id()
+        if term_id is not None:
+            kwargs['term_id'] = term_id
 
-        pks = super().get_queryset().filter(**kwargs).order_by(
+        return super().get_queryset().filter(**kwargs)
+
+    def _queue_by_priority(self, priority, term_id=None):
+        filter_limit = settings.SIS_IMPORT_LIMIT['course']['default']
+        pks = self._queueable(priority, term_id).order_by(
             F('provisioned_date').asc(nulls_first=True)
         ).values_list('pk', flat=True)[:filter_limit]
 
@@ -115,6 +167,41 @@ class CourseManager(models.Manager):
 
         return imp
 
+    def queue_by_term(self, term, include_enrollment=True):
+        """
+        Queues all active sdb courses for the passed term, as complete term
+        data. The import is given a diffing data set for the term only when
+        it queues every sdb course for the term, as Canvas drops anything
+        missing from a diffing data set.
+        """
+        term_id = term.canvas_sis_id()
+        term_courses = super().get_queryset().filter(
+            course_type=Course.SDB_TYPE,
+            term_id=term_id)
+
+        courses = term_courses.filter(
+            priority__gt=Course.PRIORITY_NONE,
+            provisioned_error__isnull=True,
+            archived_date__isnull=True)
+
+        pks = courses.filter(queue_id__isnull=True).values_list(
+            'pk', flat=True)
+
+        if not len(pks):
+            raise EmptyQueueException()
+
+        imp = Import(priority=Course.PRIORITY_DEFAULT, csv_type='course')
+        if term_courses.count() == len(pks):
+            imp.diffing_data_set = '{}-{}'.format(
+                'course-enrollment' if include_enrollment else 'course',
+                term_id)
+        imp.save()
+
+        super().get_queryset().filter(pk__in=list(pks)).update(
+            queue_id=imp.pk)
+
+        return imp
+
     def queued(self, queue_id):
         return super().get_queryset().filter(queue_id=queue_id)
 
@@ -129,65 +216,20 @@ class CourseManager(models.Manager):
         self.queued(sis_import.pk).update(**kwargs)
 
     def add_to_queue(self, section, queue_id):
-        if section.is_primary_section:
-            course_id = section.canvas_course_sis_id()
-        else:
-            course_id = section.canvas_section_sis_id()
-
-        try:
-            course = Course.objects.get(course_id=course_id)
-        except Course.DoesNotExist:
-            if section.is_primary_section:
-                primary_id = None
-            else:
-                primary_id = section.canvas_course_sis_id()
-
-            course = Course(course_id=course_id,
-                            course_type=Course.SDB_TYPE,
-                            term_id=section.term.canvas_sis_id(),
-                            primary_id=primary_id)
-
-        if course.archived_date is not None:
-            raise CoursePolicyException
-
-        course.queue_id = queue_id
-        course.save()
+        batch = CourseBatch()
+        course = batch.add_to_queue(section, queue_id)
+        batch.flush()
         return course
 
     def remove_from_queue(self, course_id, error=None):
-        try:
-            course = Course.objects.get(course_id=course_id)
-            course.queue_id = None
-            if error is not None:
-                course.provisioned_error = True
-                course.provisioned_status = error
-            course.save()
-
-        except Course.DoesNotExist:
-            pass
+        batch = CourseBatch()
+        batch.remove_from_queue(course_id, error)
+        batch.flush()
 
     def update_status(self, section):
-        if section.is_primary_section:
-            course_id = section.canvas_course_sis_id()
-        else:
-            course_id = section.canvas_section_sis_id()
-
-        try:
-            course = Course.objects.get(course_id=course_id)
-            try:
-                valid_canvas_section(section)
-                course.provisioned_status = None
-
-            except CoursePolicyException as err:
-                course.provisioned_status = 'Primary LMS: {} ({})'.format(
-                    section.primary_lms, err)
-
-            if section.is_withdrawn():
-                course.priority = Course.PRIORITY_NONE
-
-            course.save()
-        except Course.DoesNotExist:
-            pass
+        batch = CourseBatch()
+        batch.update_status(section)
+        batch.flush()
 
     def add_all_courses_for_term(self, term):
         term_id = term.canvas_sis_id()
@@ -387,6 +429,145 @@ class Course(ImportResource):
         }
 
 
+class CourseBatch(object):
+    """
+    Build-scoped cache of Course models, buffering queue, status and error
+    changes until flush().
+    """
+    def __init__(self):
+        self.courses = {}
+        self.changed = {}
+
+    def preload(self, course_ids, courses=[]):
+        """
+        Caches the passed Course models, and loads the Course models for
+        the passed course ids in batches.
+        """
+        for course in courses:
+            self.courses.setdefault(course.course_id, course)
+
+        course_ids = [c for c in dict.fromkeys(course_ids) if (
+            c is not None and c not in self.courses)]
+        for i in range(0, len(course_ids), 1000):
+            batch_ids = course_ids[i:i + 1000]
+            for course in Course.objects.filter(course_id__in=batch_ids):
+                self.courses.setdefault(course.course_id, course)
+            for course_id in batch_ids:
+                self.courses.setdefault(course_id, None)
+
+    def get(self, course_id):
+        """
+        Returns the Course model for the passed course id, or None.
+        """
+        if course_id not in self.courses:
+            try:
+                self.courses[course_id] = Course.objects.get(
+                    course_id=course_id)
+            except Course.DoesNotExist:
+                self.courses[course_id] = None
+        return self.courses[course_id]
+
+    def update(self, course, **kwargs):
+        """
+        Sets the passed field values on the course, to be saved by flush().
+        """
+        for field, value in kwargs.items():
+            setattr(course, field, value)
+        self.courses[course.course_id] = course
+        self.changed.setdefault(course.course_id, set()).update(kwargs)
+
+    def add_to_queue(self, section, queue_id):
+        if section.is_primary_section:
+            course_id = section.canvas_course_sis_id()
+        else:
+            course_id = section.canvas_section_sis_id()
+
+        course = self.get(course_id)
+        if course is None:
+            if section.is_primary_section:
+                primary_id = None
+            else:
+                primary_id = section.canvas_course_sis_id()
+
+            course = Course(course_id=course_id,
+                            course_type=Course.SDB_TYPE,
+                            term_id=section.term.canvas_sis_id(),
+                            primary_id=primary_id)
+
+        if course.archived_date is not None:
+            raise CoursePolicyException
+
+        self.update(course, queue_id=queue_id)
+        return course
+
+    def remove_from_queue(self, course_id, error=None):
+        course = self.get(course_id)
+        if course is not None:
+            if error is not None:
+                self.update(course, queue_id=None, provisioned_error=True,
+                            provisioned_status=error)
+            else:
+                self.update(course, queue_id=None)
+
+    def mark_provisioned(self, course):
+        """
+        Dequeues the passed course as provisioned, without importing it. Used
+        for courses whose import data is unchanged since the last import.
+        """
+        self.update(course, queue_id=None,
+                    provisioned_date=datetime.now(timezone.utc),
+                    priority=Course.PRIORITY_DEFAULT)
+
+    def update_status(self, section):
+        if section.is_primary_section:
+            course_id = section.canvas_course_sis_id()
+        else:
+            course_id = section.canvas_section_sis_id()
+
+        course = self.get(course_id)
+        if course is not None:
+            try:
+                valid_canvas_section(section)
+                self.update(course, provisioned_status=None)
+
+            except CoursePolicyException as err:
+                self.update(course, provisioned_status=(
+                    'Primary LMS: {} ({})'.format(section.primary_lms, err)))
+
+            if section.is_withdrawn():
+                self.update(course, priority=Course.PRIORITY_NONE)
+
+    def flush(self):
+        """
+        Saves the buffered changes in one transaction, creating new courses
+        with one bulk_create, and updating changed courses with one
+        bulk_update for each set of changed fields.
+        """
+        if not len(self.changed):
+            return
+
+        created = []
+        updated = {}
+        for course_id, fields in self.changed.items():
+            course = self.courses[course_id]
+            if course.pk is None:
+                created.append(course)
+            else:
+                updated.setdefault(tuple(sorted(fields)), []).append(course)
+
+        with transaction.atomic():
+            if len(created):
+                Course.objects.bulk_create(created, batch_size=500)
+            for fields, courses in updated.items():
+                Course.objects.bulk_update(courses, fields, batch_size=500)
+
+        # Created courses are reloaded if needed again
+        for course in created:
+            if course.pk is None:
+                self.courses.pop(course.course_id, None)
+        self.changed = {}
+
+
 class UnusedCourseManager(models.Manager):
     def queue_unused_courses(self, term_id):
         try:
@@ -468,3 +649,56 @@ class ExpiredCourse(ImportResource):
 
     class Meta:
         managed = False
+
+
+class CanvasSectionIndexManager(models.Manager):
+    def get_index(self, term_id):
+        """
+        Returns a dict of {course_sis_id: [section_sis_id]} for the active
+        academic Canvas sections of the passed term, rebuilt from a sections
+        provisioning report once older than
+        SIS_IMPORT_CANVAS_SECTION_INDEX_MINUTES. Returns None if the index
+        is disabled.
+        """
+        minutes = getattr(
+            settings, 'SIS_IMPORT_CANVAS_SECTION_INDEX_MINUTES', 60)
+        if not minutes:
+            return
+
+        indexed_dt = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+        try:
+            section_index = super().get_queryset().get(
+                term_id=term_id, indexed_date__gte=indexed_dt)
+            return json.loads(section_index.index_data)
+        except CanvasSectionIndex.DoesNotExist:
+            return self.index_term(term_id)
+
+    def index_term(self, term_id):
+        """
+        Builds and stores the section index for the passed term.
+        """
+        index = {}
+        for row in DictReader(get_section_report_data(term_id) or []):
+            try:
+                valid_academic_section_sis_id(row.get('section_id'))
+                if row.get('status') == 'active' and row.get('course_id'):
+                    index.setdefault(row['course_id'], []).append(
+                        row['section_id'])
+            except CoursePolicyException:
+                pass
+
+        super().get_queryset().update_or_create(term_id=term_id, defaults={
+            'index_data': json.dumps(index),
+            'indexed_date': datetime.now(timezone.utc)})
+        return index
+
+
+class CanvasSectionIndex(models.Model):
+    """ Represents the Canvas courses and sections of a term, from a
+        sections provisioning report.
+    """
+    term_id = models.CharField(max_length=20, unique=True)
+    index_data = models.TextField()
+    indexed_date = models.DateTimeField()
+
+    objects = CanvasSectionIndexManager()
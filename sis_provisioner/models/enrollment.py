@@ -2,8 +2,8 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
-from django.db import models, IntegrityError
-from django.db.models import F
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count
 from django.conf import settings
 from django.utils.timezone import localtime
 from sis_provisioner.models import Import, ImportResource
@@ -14,22 +14,85 @@ from sis_provisioner.dao.canvas import (
     get_instructor_sis_import_role, ENROLLMENT_ACTIVE)
 from sis_provisioner.exceptions import EmptyQueueException
 from restclients_core.exceptions import DataFailureException
-from datetime import datetime, timedelta, timezone
+from datetime import timezone
 from logging import getLogger
 
 logger = getLogger(__name__)
 enrollment_log_prefix = 'ADD ENROLLMENT:'
 
 
+def _enrollment_values(enrollment_data):
+    section = enrollment_data.get('Section')
+    instructor_reg_id = enrollment_data.get('InstructorUWRegID', None)
+    course_id = '-'.join([section.term.canvas_sis_id(),
+                          section.curriculum_abbr.upper(),
+                          section.course_number,
+                          section.section_id.upper()])
+
+    if section.is_primary_section:
+        primary_course_id = None
+    else:
+        primary_course_id = section.canvas_course_sis_id()
+
+    return {
+        'section': section,
+        'course_id': course_id,
+        'full_course_id': '-'.join([course_id, instructor_reg_id]) if (
+            instructor_reg_id is not None) else course_id,
+        'reg_id': enrollment_data.get('UWRegID'),
+        'role': enrollment_data.get('Role'),
+        'status': enrollment_data.get('Status').lower(),
+        'last_modified': enrollment_data.get('LastModified').replace(
+            tzinfo=timezone.utc),
+        'request_date': enrollment_data.get('RequestDate'),
+        'duplicate_code': enrollment_data.get('DuplicateCode', ''),
+        'primary_course_id': primary_course_id,
+        'instructor_reg_id': instructor_reg_id,
+    }
+
+
+def enrollment_event_key(enrollment_data):
+    """
+    Returns the Enrollment unique key (course_id, reg_id, role) for the
+    passed enrollment event.
+    """
+    values = _enrollment_values(enrollment_data)
+    return (values['course_id'], values['reg_id'], values['role'])
+
+
+def enrollment_event_order(enrollment_data):
+    """
+    Returns a sort key for enrollment events with the same Enrollment key,
+    in the order add_enrollment applies them.
+    """
+    return (enrollment_data.get('DuplicateCode', ''),
+            enrollment_data.get('LastModified').replace(tzinfo=timezone.utc))
+
+
+def _log_enrollment(outcome, status, full_course_id, reg_id, duplicate_code,
+                    role, last_modified, queue_id=''):
+    logger.info((
+        '{} {} status: {}, regid: {}, section: {}, '
+        'duplicate_code: {}, role: {}, last_modified {}, '
+        'queue_id: {}').format(
+            enrollment_log_prefix,
+            outcome,
+            status,
+            reg_id,
+            full_course_id,
+            duplicate_code,
+            role,
+            last_modified,
+            queue_id))
+
+
 class EnrollmentManager(models.Manager):
     def queue_by_priority(self, priority=ImportResource.PRIORITY_DEFAULT):
         filter_limit = settings.SIS_IMPORT_LIMIT['enrollment']['default']
 
-        pks = super(EnrollmentManager, self).get_queryset().filter(
-            priority=priority, queue_id__isnull=True
-        ).order_by(
-            'last_modified'
-        ).values_list('pk', flat=True)[:filter_limit]
+        pks = self._section_grouped_pks(
+            super(EnrollmentManager, self).get_queryset().filter(
+                priority=priority, queue_id__isnull=True), filter_limit)
 
         if not len(pks):
             raise EmptyQueueException()
@@ -42,6 +105,41 @@ class EnrollmentManager(models.Manager):
 
         return imp
 
+    def _section_grouped_pks(self, queryset, limit):
+        """
+        Returns the pks of up to limit enrollments in the passed queryset,
+        grouped by course. Only the courses of the limit oldest enrollments
+        are eligible, and they are taken in the order of their oldest
+        enrollment, so the oldest enrollment always leads the batch.
+        """
+        course_ids = list(dict.fromkeys(queryset.order_by(
+            'last_modified').values_list('course_id', flat=True)[:limit]))
+        if not len(course_ids):
+            return []
+
+        counts = dict(queryset.filter(course_id__in=course_ids).values(
+            'course_id').annotate(count=Count('pk')).values_list(
+                'course_id', 'count'))
+
+        grouped_ids = []
+        total = 0
+        for course_id in course_ids:
+            if total + counts[course_id] > limit:
+                break
+            grouped_ids.append(course_id)
+            total += counts[course_id]
+
+        pks = list(queryset.filter(course_id__in=grouped_ids).values_list(
+            'pk', flat=True))
+
+        if len(grouped_ids) < len(course_ids):
+            # Oldest enrollments of the next course fill the batch
+            pks.extend(queryset.filter(
+                course_id=course_ids[len(grouped_ids)]).order_by(
+                    'last_modified').values_list(
+                        'pk', flat=True)[:limit - total])
+        return pks
+
     def queued(self, queue_id):
         return super(EnrollmentManager, self).get_queryset().filter(
             queue_id=queue_id)
@@ -57,55 +155,19 @@ class EnrollmentManager(models.Manager):
         else:
             self.queued(sis_import.pk).update(queue_id=None)
 
-        self.purge_expired()
-
-    def purge_expired(self):
-        retention_dt = datetime.now(timezone.utc) - timedelta(
-            days=getattr(settings, 'ENROLLMENT_EVENT_RETENTION_DAYS', 180))
-        return super(EnrollmentManager, self).get_queryset().filter(
-            priority=Enrollment.PRIORITY_NONE,
-            last_modified__lt=retention_dt).delete()
-
     def add_enrollment(self, enrollment_data):
-        def _log(outcome, status, full_course_id, reg_id, duplicate_code, role,
-                 last_modified, queue_id=''):
-            logger.info((
-                '{} {} status: {}, regid: {}, section: {}, '
-                'duplicate_code: {}, role: {}, last_modified {}, '
-                'queue_id: {}').format(
-                    enrollment_log_prefix,
-                    outcome,
-                    status,
-                    reg_id,
-                    full_course_id,
-                    duplicate_code,
-                    role,
-                    last_modified,
-                    queue_id))
-
-        section = enrollment_data.get('Section')
-        reg_id = enrollment_data.get('UWRegID')
-        role = enrollment_data.get('Role')
-        status = enrollment_data.get('Status').lower()
-        last_modified = enrollment_data.get('LastModified').replace(
-            tzinfo=timezone.utc)
-        request_date = enrollment_data.get('RequestDate')
-        duplicate_code = enrollment_data.get('DuplicateCode', '')
-        instructor_reg_id = enrollment_data.get('InstructorUWRegID', None)
-
-        course_id = '-'.join([section.term.canvas_sis_id(),
-                              section.curriculum_abbr.upper(),
-                              section.course_number,
-                              section.section_id.upper()])
-
-        primary_course_id = None
-        if section.is_primary_section:
-            primary_course_id = None
-        else:
-            primary_course_id = section.canvas_course_sis_id()
-
-        full_course_id = '-'.join([course_id, instructor_reg_id]) if (
-            instructor_reg_id is not None) else course_id
+        values = _enrollment_values(enrollment_data)
+        section = values['section']
+        course_id = values['course_id']
+        full_course_id = values['full_course_id']
+        reg_id = values['reg_id']
+        role = values['role']
+        status = values['status']
+        last_modified = values['last_modified']
+        request_date = values['request_date']
+        duplicate_code = values['duplicate_code']
+        primary_course_id = values['primary_course_id']
+        instructor_reg_id = values['instructor_reg_id']
 
         try:
             course = Course.objects.get(course_id=full_course_id)
@@ -127,20 +189,23 @@ class EnrollmentManager(models.Manager):
                         enrollment.priority = enrollment.PRIORITY_DEFAULT
                     else:
                         enrollment.priority = enrollment.PRIORITY_HIGH
-                        _log('IN QUEUE', status, full_course_id, reg_id,
-                             duplicate_code, role, last_modified,
-                             queue_id=enrollment.queue_id)
+                        _log_enrollment(
+                            'IN QUEUE', status, full_course_id, reg_id,
+                            duplicate_code, role, last_modified,
+                            queue_id=enrollment.queue_id)
 
                     enrollment.save()
-                    _log('UPDATE EXISTING', status, full_course_id, reg_id,
-                         duplicate_code, role, last_modified)
+                    _log_enrollment(
+                        'UPDATE EXISTING', status, full_course_id, reg_id,
+                        duplicate_code, role, last_modified)
                 else:
-                    _log('IGNORE (Out of order: {})'.format(
-                         enrollment.last_modified), status, full_course_id,
-                         reg_id, duplicate_code, role, last_modified)
+                    _log_enrollment('IGNORE (Out of order: {})'.format(
+                        enrollment.last_modified), status, full_course_id,
+                        reg_id, duplicate_code, role, last_modified)
             else:
-                _log('IGNORE (Unprovisioned course)', status, full_course_id,
-                     reg_id, duplicate_code, role, last_modified)
+                _log_enrollment(
+                    'IGNORE (Unprovisioned course)', status, full_course_id,
+                    reg_id, duplicate_code, role, last_modified)
                 if course.priority < course.PRIORITY_IMMEDIATE:
                     course.priority = course.PRIORITY_IMMEDIATE
                     course.save()
@@ -154,8 +219,8 @@ class EnrollmentManager(models.Manager):
                                     instructor_reg_id=instructor_reg_id)
             try:
                 enrollment.save()
-                _log('ADD', status, full_course_id, reg_id, duplicate_code,
-                     role, last_modified)
+                _log_enrollment('ADD', status, full_course_id, reg_id,
+                                duplicate_code, role, last_modified)
             except IntegrityError:
                 self.add_enrollment(enrollment_data)  # Try again
         except Course.DoesNotExist:
@@ -168,14 +233,135 @@ class EnrollmentManager(models.Manager):
                                 priority=Course.PRIORITY_IMMEDIATE)
                 try:
                     course.save()
-                    _log('IGNORE (Unprovisioned course)', status,
-                         full_course_id, reg_id, duplicate_code, role,
-                         last_modified)
+                    _log_enrollment('IGNORE (Unprovisioned course)', status,
+                                    full_course_id, reg_id, duplicate_code,
+                                    role, last_modified)
                 except IntegrityError:
                     self.add_enrollment(enrollment_data)  # Try again
             else:
-                _log('IGNORE (Inactive section)', status, full_course_id,
-                     reg_id, duplicate_code, role, last_modified)
+                _log_enrollment(
+                    'IGNORE (Inactive section)', status, full_course_id,
+                    reg_id, duplicate_code, role, last_modified)
+
+    def add_enrollments(self, enrollments_data):
+        """
+        Adds the passed list of enrollment events, with the outcomes of
+        add_enrollment applied in order. Existing courses and enrollments are
+        loaded in one query each, and changes are written in bulk in one
+        transaction. If the writes conflict with a concurrent event, the
+        events are added individually.
+        """
+        events = [_enrollment_values(data) for data in enrollments_data]
+        if not len(events):
+            return
+
+        courses = dict((c.course_id, c) for c in Course.objects.filter(
+            course_id__in=set(e['full_course_id'] for e in events)))
+
+        enrollments = {}
+        for enrollment in super(EnrollmentManager, self).get_queryset().filter(
+                course_id__in=set(e['course_id'] for e in events),
+                reg_id__in=set(e['reg_id'] for e in events)):
+            enrollments[(enrollment.course_id, enrollment.reg_id,
+                         enrollment.role)] = enrollment
+
+        new_courses = {}
+        updated_courses = {}
+        new_enrollments = {}
+        updated_enrollments = {}
+        active_terms = {}
+        logs = []
+        for event in events:
+            log_args = [
+                event['status'], event['full_course_id'], event['reg_id'],
+                event['duplicate_code'], event['role'],
+                event['last_modified']]
+
+            course = courses.get(event['full_course_id'])
+            if course is None:
+                term = event['section'].term
+                term_id = term.canvas_sis_id()
+                if term_id not in active_terms:
+                    active_terms[term_id] = is_active_term(term)
+
+                if active_terms[term_id]:
+                    # Initial course provisioning effectively picks up event
+                    course = Course(course_id=event['full_course_id'],
+                                    course_type=Course.SDB_TYPE,
+                                    term_id=term_id,
+                                    primary_id=event['primary_course_id'],
+                                    priority=Course.PRIORITY_IMMEDIATE)
+                    courses[course.course_id] = course
+                    new_courses[course.course_id] = course
+                    logs.append(['IGNORE (Unprovisioned course)'] + log_args)
+                else:
+                    logs.append(['IGNORE (Inactive section)'] + log_args)
+                continue
+
+            if not course.provisioned_date:
+                logs.append(['IGNORE (Unprovisioned course)'] + log_args)
+                if course.priority < course.PRIORITY_IMMEDIATE:
+                    course.priority = course.PRIORITY_IMMEDIATE
+                    if course.course_id not in new_courses:
+                        updated_courses[course.course_id] = course
+                continue
+
+            key = (event['course_id'], event['reg_id'], event['role'])
+            enrollment = enrollments.get(key)
+            if enrollment is None:
+                enrollment = Enrollment(
+                    course_id=event['course_id'], reg_id=event['reg_id'],
+                    role=event['role'], status=event['status'],
+                    duplicate_code=event['duplicate_code'],
+                    last_modified=event['last_modified'],
+                    primary_course_id=event['primary_course_id'],
+                    instructor_reg_id=event['instructor_reg_id'])
+                enrollments[key] = enrollment
+                new_enrollments[key] = enrollment
+                logs.append(['ADD'] + log_args)
+
+            elif ((event['duplicate_code'] > enrollment.duplicate_code) or
+                    (event['duplicate_code'] == enrollment.duplicate_code and
+                        event['last_modified'] >= enrollment.last_modified)):
+                enrollment.status = event['status']
+                enrollment.last_modified = event['last_modified']
+                enrollment.request_date = event['request_date']
+                enrollment.primary_course_id = event['primary_course_id']
+                enrollment.instructor_reg_id = event['instructor_reg_id']
+                enrollment.duplicate_code = event['duplicate_code']
+
+                if enrollment.queue_id is None:
+                    enrollment.priority = enrollment.PRIORITY_DEFAULT
+                else:
+                    enrollment.priority = enrollment.PRIORITY_HIGH
+                    logs.append(['IN QUEUE'] + log_args + [
+                        enrollment.queue_id])
+
+                if key not in new_enrollments:
+                    updated_enrollments[key] = enrollment
+                logs.append(['UPDATE EXISTING'] + log_args)
+            else:
+                logs.append(['IGNORE (Out of order: {})'.format(
+                    enrollment.last_modified)] + log_args)
+
+        try:
+            with transaction.atomic():
+                Course.objects.bulk_create(new_courses.values())
+                Course.objects.bulk_update(
+                    updated_courses.values(), ['priority'])
+                self.bulk_create(new_enrollments.values())
+                self.bulk_update(
+                    updated_enrollments.values(), [
+                        'status', 'last_modified', 'request_date',
+                        'primary_course_id', 'instructor_reg_id',
+                        'duplicate_code', 'priority'])
+        except IntegrityError:
+            for data in enrollments_data:
+                self.add_enrollment(data)  # Try again
+            return
+
+        for log in logs:
+            _log_enrollment(*log)
 
 
 class Enrollment(ImportResource):
@@ -0,0 +1,204 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.conf import settings
+from sis_provisioner.models import Import, ImportResource
+from sis_provisioner.models.enrollment import Enrollment, InvalidEnrollment
+from sis_provisioner.models.group import GroupMemberGroup
+from sis_provisioner.models.events import (
+    EnrollmentLog, GroupLog, InstructorLog, PersonLog)
+from prometheus_client import Counter
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from abc import ABC, abstractmethod
+from math import floor
+from time import sleep
+
+logger = getLogger(__name__)
+prometheus_purged_rows = Counter(
+    'canvas_retention_purged_rows',
+    'Expired Rows Purged',
+    ['table'])
+
+
+class RetentionPolicy(ABC):
+    """
+    Deletes the expired rows of a model in chunks of up to chunk_size rows,
+    by pk range. The days and chunk_size for each policy name can be set in
+    the RETENTION_POLICIES setting, and days set to None disables the policy.
+    """
+    name = None
+    model = None
+    days = None
+
+    def __init__(self, now=None):
+        config = getattr(settings, 'RETENTION_POLICIES', {}).get(
+            self.name, {})
+        self.days = config.get('days', self.default_days())
+        self.chunk_size = config.get('chunk_size', getattr(
+            settings, 'RETENTION_CHUNK_SIZE', 1000))
+        self.pause = getattr(settings, 'RETENTION_CHUNK_PAUSE', 0)
+        self.now = now or datetime.now(timezone.utc)
+
+    def default_days(self):
+        return self.days
+
+    def table(self):
+        return self.model._meta.db_table
+
+    def retention_date(self):
+        return self.now - timedelta(days=self.days)
+
+    @abstractmethod
+    def expired(self):
+        """
+        Returns the queryset of expired rows.
+        """
+
+    def delete(self, queryset):
+        """
+        Deletes a chunk of expired rows, returning the number deleted.
+        """
+        count, _ = queryset.delete()
+        return count
+
+    def purge(self):
+        """
+        Deletes the expired rows, pausing RETENTION_CHUNK_PAUSE seconds
+        between chunks. Returns the number of rows deleted.
+        """
+        queryset = self.expired()
+        deleted = 0
+        chunks = 0
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(
+                pk__gt=last_pk)
+            pks = list(chunk.order_by('pk').values_list(
+                'pk', flat=True)[:self.chunk_size])
+            if not len(pks):
+                break
+
+            count = self.delete(chunk.filter(pk__lte=pks[-1]))
+            deleted += count
+            chunks += 1
+            last_pk = pks[-1]
+
+            if len(pks) < self.chunk_size:
+                break
+            if self.pause:
+                sleep(self.pause)
+
+        prometheus_purged_rows.labels(self.table()).inc(deleted)
+        logger.info('Purged {} expired rows from {} in {} chunks'.format(
+            deleted, self.table(), chunks))
+        return deleted
+
+
+class EnrollmentRetention(RetentionPolicy):
+    """
+    Enrollment events that are no longer queued for import.
+    """
+    name = 'enrollment'
+    model = Enrollment
+
+    def default_days(self):
+        return getattr(settings, 'ENROLLMENT_EVENT_RETENTION_DAYS', 180)
+
+    def expired(self):
+        return Enrollment.objects.filter(
+            priority=ImportResource.PRIORITY_NONE,
+            last_modified__lt=self.retention_date())
+
+
+class InvalidEnrollmentRetention(RetentionPolicy):
+    """
+    Invalid enrollments that have been restored.
+    """
+    name = 'invalid_enrollment'
+    model = InvalidEnrollment
+    days = 365
+
+    def expired(self):
+        return InvalidEnrollment.objects.filter(
+            priority=ImportResource.PRIORITY_NONE, queue_id__isnull=True,
+            restored_date__lt=self.retention_date())
+
+
+class GroupMemberGroupRetention(RetentionPolicy):
+    """
+    Deleted member group relationships. These have no date, so any deleted
+    relationship is expired; a member group that returns is added again.
+    """
+    name = 'group_member_group'
+    model = GroupMemberGroup
+    days = 0
+
+    def expired(self):
+        return GroupMemberGroup.objects.filter(is_deleted=True)
+
+
+class EventLogRetention(RetentionPolicy):
+    """
+    Per-minute event counts of an event log model.
+    """
+    name = 'event_log'
+    days = 7
+
+    def __init__(self, model, now=None):
+        super(EventLogRetention, self).__init__(now=now)
+        self.model = model
+
+    def expired(self):
+        minute = int(floor(self.now.timestamp() / 60))
+        return self.model.objects.filter(
+            minute__lt=minute - self.days * 24 * 60)
+
+
+class ImportRetention(RetentionPolicy):
+    """
+    Completed imports. QuerySet.delete() does not call Import.delete(), so
+    the models still queued for a failed import are dequeued first.
+    """
+    name = 'import'
+    model = Import
+    days = 90
+
+    def expired(self):
+        return Import.objects.filter(
+            post_status=200, canvas_progress=100,
+            monitor_date__lt=self.retention_date())
+
+    def delete(self, queryset):
+        for imp in queryset:
+            imp.dequeue_dependent_models()
+        return super(ImportRetention, self).delete(queryset)
+
+
+def retention_policies(now=None):
+    return [
+        EnrollmentRetention(now=now),
+        InvalidEnrollmentRetention(now=now),
+        GroupMemberGroupRetention(now=now),
+        EventLogRetention(EnrollmentLog, now=now),
+        EventLogRetention(GroupLog, now=now),
+        EventLogRetention(InstructorLog, now=now),
+        EventLogRetention(PersonLog, now=now),
+        ImportRetention(now=now),
+    ]
+
+
+def purge_expired(names=None):
+    """
+    Purges the expired rows of the enabled retention policies, or of the
+    passed policy names. Returns the number of rows deleted from each table.
+    """
+    deleted = {}
+    for policy in retention_policies():
+        if names and policy.name not in names:
+            continue
+        if policy.days is None:
+            continue
+        deleted[policy.table()] = policy.purge()
+    return deleted
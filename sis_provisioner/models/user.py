@@ -109,6 +109,36 @@ class UserManager(models.Manager):
 
         return user
 
+    def get_users(self, persons):
+        """
+        Returns a dict of {reg_id: User} for the passed persons, from one
+        query. Persons without a User are mapped to a new, unsaved User.
+        Persons matching more than one User are omitted.
+        """
+        persons = dict((p.uwregid, p) for p in persons if (
+            p.uwnetid is not None))
+        if not len(persons):
+            return {}
+
+        net_ids = dict((p.uwnetid, reg_id) for reg_id, p in persons.items())
+        matches = dict((reg_id, []) for reg_id in persons)
+        for user in super().get_queryset().filter(
+                Q(reg_id__in=list(persons.keys())) |
+                Q(net_id__in=list(net_ids.keys()))):
+            for reg_id in {user.reg_id, net_ids.get(user.net_id)}:
+                if reg_id in matches:
+                    matches[reg_id].append(user)
+
+        users = {}
+        for reg_id, found in matches.items():
+            if len(found) == 1:
+                users[reg_id] = found[0]
+            elif not len(found):
+                users[reg_id] = User(reg_id=reg_id,
+                                     net_id=persons[reg_id].uwnetid,
+                                     priority=User.PRIORITY_HIGH)
+        return users
+
     def update_priority(self, person, priority):
         user = self._find_existing(person.uwnetid, person.uwregid)
 
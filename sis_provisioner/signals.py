@@ -55,8 +55,9 @@ def priority_user_import(sender, **kwargs):
 
             if imp.csv_path:
                 sis_import = imp.import_csv()
-                logger.info(f'SIS Import URL: {sis_import.post_url}, '
-                            f'Headers: {sis_import.post_headers}')
+                if sis_import is not None:
+                    logger.info(f'SIS Import URL: {sis_import.post_url}, '
+                                f'Headers: {sis_import.post_headers}')
             else:
                 user.queue_id = None
                 user.priority = user.PRIORITY_HIGH
@@ -7,9 +7,15 @@ from uw_sws.util import fdao_sws_override
 from uw_pws.util import fdao_pws_override
 from sis_provisioner.builders import Builder
 from sis_provisioner.csv.data import Collector
+from sis_provisioner.models.user import User
+from sis_provisioner.dao.course import get_registrations_by_section
 from sis_provisioner.exceptions import CoursePolicyException
 from restclients_core.exceptions import DataFailureException
 from uw_sws.exceptions import InvalidCanvasIndependentStudyCourse
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import threading
+import mock
 
 
 @fdao_sws_override
@@ -24,6 +30,41 @@ class BuilderTest(TestCase):
         self.assertEqual(builder.build(), None)
         self.assertRaises(NotImplementedError, builder._process, True)
 
+    def test_prefetch_sections(self):
+        builder = Builder()
+        builder.prefetch_sections([
+            '2013-winter-DROP_T-100-B', '2013-winter-FAKE-999-A',
+            '2013-winter-DROP_T-100-B', None])
+        self.assertEqual(sorted(builder.sections.sections.keys()), [
+            '2013-winter-DROP_T-100-B', '2013-winter-FAKE-999-A'])
+
+        section = builder.sections.sections['2013-winter-DROP_T-100-B']
+        self.assertIs(builder.get_section_resource_by_id(
+            '2013-winter-DROP_T-100-B'), section)
+        self.assertRaises(DataFailureException,
+                          builder.get_section_resource_by_id,
+                          '2013-winter-FAKE-999-A')
+        self.assertEqual(builder.sections.hits, 2)
+        self.assertEqual(builder.sections.misses, 2)
+
+        builder = Builder()
+        with self.settings(SIS_IMPORT_SECTION_PREFETCH_THREADS=0):
+            builder.prefetch_sections(['2013-winter-DROP_T-100-B'])
+            self.assertEqual(len(builder.sections), 0)
+
+    @mock.patch('sis_provisioner.builders.get_section_by_id')
+    def test_section_memo(self, mock_get_section):
+        mock_get_section.side_effect = DataFailureException('', 404, '')
+
+        builder = Builder()
+        for i in range(3):
+            self.assertRaises(DataFailureException,
+                              builder.get_section_resource_by_id,
+                              '2013-winter-FAKE-999-A')
+        mock_get_section.assert_called_once_with('2013-winter-FAKE-999-A')
+        self.assertEqual(builder.sections.hits, 2)
+        self.assertEqual(builder.sections.misses, 1)
+
     def test_get_section_resource_by_id(self):
         builder = Builder()
 
@@ -63,6 +104,99 @@ class BuilderTest(TestCase):
             '2013-winter-DROP_T-100-B')
         self.assertEqual(builder.add_registrations_by_section(section), None)
 
+    def test_prefetch_registrations(self):
+        builder = Builder()
+        section = builder.get_section_resource_by_id(
+            '2013-winter-DROP_T-100-B')
+        fake = copy.deepcopy(section)
+        fake.course_number = 999
+
+        builder.prefetch_registrations([section, fake, section])
+        self.assertEqual(sorted(builder.registrations.keys()), [
+            '2013,winter,DROP_T,100/B', '2013,winter,DROP_T,999/B'])
+        self.assertIsInstance(builder.registrations[
+            '2013,winter,DROP_T,999/B'], DataFailureException)
+
+        builder.add_registrations_by_section(section)
+        builder.add_registrations_by_section(fake)
+        self.assertEqual(len(builder.registrations), 0)
+        self.assertEqual(len(builder.data.enrollments), 2)
+        self.assertEqual(builder.registration_errors, 1)
+
+    @mock.patch('sis_provisioner.builders.ThreadPoolExecutor',
+                wraps=ThreadPoolExecutor)
+    @mock.patch('sis_provisioner.builders.get_registrations_by_section')
+    def test_prefetch_registrations_pool(self, mock_get_registrations,
+                                         mock_executor):
+        section = Builder().get_section_resource_by_id(
+            '2013-winter-DROP_T-100-B')
+        registrations = get_registrations_by_section(section)
+        threads = []
+
+        def thread_get_registrations(section):
+            threads.append(threading.current_thread())
+            section_registrations = copy.deepcopy(registrations)
+            for registration in section_registrations:
+                registration.section = section
+            return section_registrations
+
+        mock_get_registrations.side_effect = thread_get_registrations
+        sections = []
+        for i in range(16):
+            sections.append(copy.deepcopy(section))
+            sections[-1].section_id = 'B{}'.format(i)
+
+        enrollments = {}
+        for pool_size in [0, 8]:
+            mock_executor.reset_mock()
+            mock_get_registrations.reset_mock()
+            threads.clear()
+            with self.settings(
+                    SIS_IMPORT_REGISTRATION_PREFETCH_THREADS=pool_size):
+                builder = Builder()
+                builder.prefetch_registrations(sections)
+                for s in sections:
+                    builder.add_registrations_by_section(s)
+                enrollments[pool_size] = [
+                    str(e) for e in builder.data.enrollments]
+
+            # Each section fetched once, through the pool if enabled
+            self.assertEqual(mock_get_registrations.call_count, len(sections))
+            if pool_size:
+                mock_executor.assert_called_once_with(max_workers=pool_size)
+                self.assertNotIn(threading.main_thread(), threads)
+            else:
+                mock_executor.assert_not_called()
+                self.assertEqual(set(threads), {threading.main_thread()})
+
+        # Added in processing order either way
+        self.assertEqual(len(enrollments[0]), len(sections) * 2)
+        self.assertEqual(enrollments[8], enrollments[0])
+
+    def test_resolve_users(self):
+        builder = Builder()
+        builder.queue_id = '1'
+        section = builder.get_section_resource_by_id(
+            '2013-winter-DROP_T-100-B')
+        persons = [r.person for r in get_registrations_by_section(section)]
+        User.objects.create(net_id=persons[0].uwnetid,
+                            reg_id=persons[0].uwregid)
+
+        with self.assertNumQueries(1):
+            builder.resolve_users(persons + [None])
+        self.assertEqual(len(builder.users), 2)
+
+        with self.assertNumQueries(0):
+            for person in persons:
+                self.assertEqual(
+                    builder.add_user_data_for_person(person), True)
+
+        self.assertEqual(len(builder.new_users), 1)
+        self.assertEqual(len(builder.updated_users), 1)
+        builder.save_users()
+        self.assertEqual(User.objects.filter(queue_id='1').count(), 2)
+        self.assertEqual(len(builder.data.users), 2)
+
     def test_add_group_enrollment_data(self):
         builder = Builder()
         builder.add_group_enrollment_data(
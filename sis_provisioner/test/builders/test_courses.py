@@ -3,8 +3,30 @@
 
 
 from django.test import TestCase
+from django.core.files.storage import FileSystemStorage
 from sis_provisioner.builders.courses import CourseBuilder, UnusedCourseBuilder
+from sis_provisioner.models import Import, SectionSnapshot
+from sis_provisioner.models.course import Course
+from sis_provisioner.models.account import Curriculum
+from sis_provisioner.dao.course import (
+    get_section_by_label, get_registrations_by_section)
+from uw_sws import get_resource
+from restclients_core.exceptions import DataFailureException
+from uw_canvas.reports import ReportFailureException
+from uw_canvas.sis_import import SISImport
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import threading
+import tempfile
+import copy
 import mock
+import os
+
+
+class LocalStorage(FileSystemStorage):
+    def _open(self, name, mode='rb'):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        return super()._open(name, mode)
 
 
 class CourseBuilderTest(TestCase):
@@ -17,6 +39,339 @@ class CourseBuilderTest(TestCase):
         self.assertEqual(builder.build(include_enrollment=False), None)
         self.assertEqual(builder.include_enrollment, False)
 
+    @mock.patch('sis_provisioner.builders.ThreadPoolExecutor',
+                wraps=ThreadPoolExecutor)
+    @mock.patch('sis_provisioner.builders.get_section_by_id')
+    def test_course_builder_prefetch(self, mock_get_section, mock_executor):
+        threads = []
+
+        def get_section(section_id):
+            threads.append(threading.current_thread())
+            raise DataFailureException(section_id, 404, 'Not Found')
+
+        mock_get_section.side_effect = get_section
+        courses = [Course(course_id='2013-spring-TRAIN-{}-A'.format(i),
+                          course_type=Course.SDB_TYPE) for i in range(16)]
+
+        # Prefetched once through the pool, including failed fetches
+        with self.settings(SIS_IMPORT_SECTION_PREFETCH_THREADS=8):
+            CourseBuilder(courses).build()
+        mock_executor.assert_called_once_with(max_workers=8)
+        self.assertEqual(mock_get_section.call_count, len(courses))
+        self.assertNotIn(threading.main_thread(), threads)
+
+        # Sequential without a pool
+        mock_executor.reset_mock()
+        mock_get_section.reset_mock()
+        threads.clear()
+        with self.settings(SIS_IMPORT_SECTION_PREFETCH_THREADS=0):
+            CourseBuilder(courses).build()
+        mock_executor.assert_not_called()
+        self.assertEqual(mock_get_section.call_count, len(courses))
+        self.assertEqual(set(threads), {threading.main_thread()})
+
+    @mock.patch('sis_provisioner.builders.get_section_by_id')
+    def test_resolve_section_graph(self, mock_get_section):
+        def url(section_id):
+            return '/student/v5/course/2013,spring,TRAIN,{}.json'.format(
+                section_id.replace('2013-spring-TRAIN-', '').replace('-', '/'))
+
+        graph = {
+            '2013-spring-TRAIN-100-A': (['100-AA'], ['200-A']),
+            '2013-spring-TRAIN-200-A': (['200-AA'], []),
+            '2013-spring-TRAIN-300-A': ([], []),
+        }
+
+        def get_section(section_id):
+            section = mock.Mock(is_independent_study=False)
+            section.get_instructors.return_value = []
+            section.is_primary_section = section_id in graph
+            linked, joint = graph.get(section_id, ([], []))
+            section.linked_section_urls = [
+                url('2013-spring-TRAIN-' + s) for s in linked]
+            section.joint_section_urls = [
+                url('2013-spring-TRAIN-' + s) for s in joint]
+            return section
+
+        mock_get_section.side_effect = get_section
+        Course.objects.create(course_id='2013-spring-TRAIN-300-A',
+                              course_type=Course.SDB_TYPE,
+                              xlist_id='2013-spring-TRAIN-100-A')
+        Course.objects.create(course_id='2013-spring-TRAIN-100-AB',
+                              course_type=Course.SDB_TYPE,
+                              primary_id='2013-spring-TRAIN-100-A')
+
+        builder = CourseBuilder([Course(course_id='2013-spring-TRAIN-100-A',
+                                        course_type=Course.SDB_TYPE)])
+        with mock.patch.object(builder, 'prefetch_sections',
+                               wraps=builder.prefetch_sections) as mock_wave:
+            builder._init_build()
+
+        # One fetch wave per graph level
+        self.assertEqual([sorted(c.args[0]) for c in (
+            mock_wave.call_args_list)], [
+                ['2013-spring-TRAIN-100-A'],
+                ['2013-spring-TRAIN-100-AA', '2013-spring-TRAIN-100-AB',
+                 '2013-spring-TRAIN-200-A', '2013-spring-TRAIN-300-A'],
+                ['2013-spring-TRAIN-200-AA']])
+        self.assertEqual(mock_get_section.call_count, 6)
+        self.assertEqual(builder.linked_course_ids, {
+            '2013-spring-TRAIN-100-A': ['2013-spring-TRAIN-100-AB'],
+            '2013-spring-TRAIN-200-A': [],
+            '2013-spring-TRAIN-300-A': []})
+        self.assertEqual(builder.joint_course_ids, {
+            '2013-spring-TRAIN-100-A': ['2013-spring-TRAIN-300-A'],
+            '2013-spring-TRAIN-200-A': [],
+            '2013-spring-TRAIN-300-A': []})
+
+    @mock.patch('sis_provisioner.builders.get_registrations_by_section')
+    @mock.patch.object(CourseBuilder, '_process_section')
+    def test_unchanged_sections(self, mock_process, mock_registrations):
+        mock_registrations.return_value = []
+        course = Course.objects.create(course_id='2013-spring-TRAIN-101-A',
+                                       course_type=Course.SDB_TYPE,
+                                       priority=Course.PRIORITY_HIGH)
+
+        builder = CourseBuilder([course])
+        builder._init_build()
+        self.assertEqual(builder.unchanged_sections, set())
+        builder._process(course)
+        self.assertEqual(mock_process.call_count, 1)
+        digest = builder.section_digests['2013-spring-TRAIN-101-A']
+        self.assertEqual(builder.data.snapshots, {
+            '2013-spring-TRAIN-101-A': digest})
+
+        SectionSnapshot.objects.create(
+            section_id='2013-spring-TRAIN-101-A', digest=digest,
+            provisioned_date=datetime.now(timezone.utc))
+
+        builder = CourseBuilder([course])
+        builder._init_build()
+        self.assertEqual(builder.section_digests, {
+            '2013-spring-TRAIN-101-A': digest})
+        self.assertEqual(builder.unchanged_sections, {
+            '2013-spring-TRAIN-101-A'})
+        Course.objects.filter(pk=course.pk).update(queue_id='1')
+        course.refresh_from_db()
+        builder._process(course)
+        self.assertEqual(mock_process.call_count, 1)
+        self.assertEqual(builder.data.snapshots, {})
+
+        # Skipped courses are dequeued as provisioned
+        builder.courses.flush()
+        course.refresh_from_db()
+        self.assertIsNone(course.queue_id)
+        self.assertIsNotNone(course.provisioned_date)
+        self.assertEqual(course.priority, Course.PRIORITY_DEFAULT)
+        course.priority = Course.PRIORITY_HIGH
+
+        # Immediate priority and diffing builds include unchanged sections
+        course.priority = Course.PRIORITY_IMMEDIATE
+        builder._process(course)
+        self.assertEqual(mock_process.call_count, 2)
+
+        builder = CourseBuilder([course])
+        builder._init_build(diffing=True)
+        self.assertEqual(builder.unchanged_sections, set())
+
+        # Changed registrations of an unchanged section
+        mock_registrations.return_value = get_registrations_by_section(
+            get_section_by_label('2013,winter,DROP_T,100/B'))
+        builder = CourseBuilder([course])
+        builder._init_build()
+        self.assertNotEqual(builder.section_digests, {
+            '2013-spring-TRAIN-101-A': digest})
+        self.assertEqual(builder.unchanged_sections, set())
+
+        # No digest without the registrations
+        mock_registrations.side_effect = DataFailureException(
+            None, 500, None)
+        builder = CourseBuilder([course])
+        builder._init_build()
+        self.assertEqual(builder.section_digests, {})
+
+        builder = CourseBuilder([course])
+        builder._init_build(include_enrollment=False)
+        self.assertEqual(builder.section_digests, {})
+
+    @mock.patch('sis_provisioner.csv.format.account_id_for_section')
+    @mock.patch.object(CourseBuilder, '_section_digest', return_value='abc')
+    @mock.patch.object(CourseBuilder, '_write')
+    def test_defer_enrollment(self, mock_write, mock_digest, mock_account_id):
+        def rows(collector):
+            return sorted(str(row) for row in collector.enrollments)
+
+        course = Course.objects.create(course_id='2013-winter-DROP_T-100-B',
+                                       course_type=Course.SDB_TYPE,
+                                       priority=Course.PRIORITY_HIGH)
+
+        builder = CourseBuilder([course])
+        builder.build()
+        enrollments = rows(builder.data)
+        snapshots = builder.data.snapshots
+        self.assertEqual(snapshots, {'2013-winter-DROP_T-100-B': 'abc'})
+
+        builder = CourseBuilder([course])
+        builder.build(defer_enrollment=True)
+        self.assertEqual(len(builder.data.courses), 1)
+        self.assertEqual(len(builder.deferred_sections), 1)
+        self.assertEqual(builder.data.snapshots, {})
+        shell_enrollments = rows(builder.data)
+        self.assertLess(len(shell_enrollments), len(enrollments))
+
+        builder.data._init_data()
+        builder.build_enrollments()
+        self.assertEqual(len(builder.data.courses), 0)
+        self.assertEqual(
+            sorted(shell_enrollments + rows(builder.data)), enrollments)
+        self.assertEqual(builder.data.snapshots, snapshots)
+        self.assertEqual(builder.deferred_sections, [])
+
+        # Diffing builds are not split
+        builder = CourseBuilder([course])
+        builder.build(defer_enrollment=True, diffing=True)
+        self.assertFalse(builder.defer_enrollment)
+        self.assertEqual(rows(builder.data), enrollments)
+
+    @mock.patch('sis_provisioner.csv.format.account_id_for_section',
+                return_value='account_id')
+    @mock.patch('sis_provisioner.builders.get_registrations_by_section')
+    def test_incomplete_diffing_data(self, mock_registrations,
+                                     mock_account_id):
+        def stub_import_archive(archive, params={}):
+            posted.append(params)
+            return mock.Mock(import_id=str(len(posted)),
+                             workflow_state='created')
+
+        def build_and_post():
+            course = Course(course_id='2013-spring-TRAIN-101-A',
+                            course_type=Course.SDB_TYPE)
+            with tempfile.TemporaryDirectory() as location:
+                storage = LocalStorage(location=location)
+                with mock.patch('sis_provisioner.dao.canvas.default_storage',
+                                storage), \
+                        mock.patch('sis_provisioner.csv.data.default_storage',
+                                   storage), \
+                        mock.patch.object(SISImport, 'import_archive',
+                                          side_effect=stub_import_archive), \
+                        self.settings(SIS_IMPORT_CSV_DEBUG=False,
+                                      SIS_IMPORT_DEDUP_MINUTES=0):
+                    imp = Import(csv_type='course',
+                                 diffing_data_set='course-2013-spring')
+                    imp.csv_path = CourseBuilder([course]).build(diffing=True)
+                    imp.import_csv()
+
+        posted = []
+        mock_registrations.return_value = []
+        build_and_post()
+        self.assertIn('diffing_data_set_identifier', posted[-1])
+
+        # A failed registration fetch leaves the term data incomplete
+        posted = []
+        mock_registrations.side_effect = DataFailureException('', 500, '')
+        build_and_post()
+        self.assertGreater(len(posted), 0)
+        for params in posted:
+            self.assertNotIn('diffing_data_set_identifier', params)
+
+    @mock.patch(
+        'sis_provisioner.builders.courses.get_registrations_by_curriculum')
+    def test_harvest_registrations(self, mock_harvest):
+        section = get_section_by_label('2013,winter,DROP_T,100/B')
+        other = copy.deepcopy(section)
+        other.section_id = 'C'
+        sections = [section, other]
+
+        mock_harvest.return_value = {
+            '2013,winter,DROP_T,100/B': get_resource(
+                '/student/v5/registration.json?curriculum_abbreviation=DROP_T'
+                '&instructor_reg_id=&course_number=100&verbose=true'
+                '&year=2013&quarter=winter&is_active=&section_id=B'
+                '&transcriptable_course=all')['Registrations']}
+        Curriculum.objects.create(curriculum_abbr='DROP_T', full_name='Drop',
+                                  subaccount_id='uwcourse:drop_t')
+
+        # Below the curriculum threshold
+        builder = CourseBuilder()
+        self.assertEqual(builder._harvest_registrations(sections), sections)
+        self.assertEqual(mock_harvest.call_count, 0)
+
+        with self.settings(SIS_IMPORT_CURRICULUM_HARVEST_SECTIONS=2):
+            self.assertEqual(builder._harvest_registrations(sections), [])
+            mock_harvest.assert_called_once_with('DROP_T', section.term)
+            self.assertEqual(
+                len(builder.registrations['2013,winter,DROP_T,100/B']), 2)
+            self.assertEqual(
+                builder.registrations['2013,winter,DROP_T,100/C'], [])
+
+            # Failed harvest falls back to section fetches
+            mock_harvest.side_effect = DataFailureException('', 500, '')
+            builder = CourseBuilder()
+            self.assertEqual(
+                builder._harvest_registrations(sections), sections)
+            self.assertEqual(builder.registrations, {})
+
+    @mock.patch('sis_provisioner.builders.courses.get_section_by_url')
+    def test_get_section_by_url(self, mock_get_section):
+        section = mock.Mock()
+        builder = CourseBuilder()
+        builder.sections.add('2013-spring-TRAIN-100-A', section)
+
+        url = '/student/v5/course/2013,spring,TRAIN,100/A.json'
+        self.assertIs(builder.get_section_by_url(url), section)
+        self.assertIs(builder.get_section_by_url(url), section)
+        self.assertEqual(mock_get_section.call_count, 0)
+
+        url = '/student/v5/course/2013,spring,TRAIN,100/AB.json'
+        mock_get_section.return_value = section
+        self.assertIs(builder.get_section_by_url(url), section)
+        self.assertIs(builder.sections.get(
+            '2013-spring-TRAIN-100-AB', mock.Mock()), section)
+        mock_get_section.assert_called_once_with(url)
+        self.assertEqual(builder.sections.hits, 3)
+        self.assertEqual(builder.sections.misses, 2)
+
+    @mock.patch('sis_provisioner.builders.courses.get_section_by_sis_id')
+    @mock.patch(
+        'sis_provisioner.models.course.CanvasSectionIndexManager.get_index')
+    def test_canvas_section_index(self, mock_get_index, mock_get_section):
+        section = get_section_by_label('2013,spring,TRAIN,101/A')
+        course_id = '2013-spring-TRAIN-101-A'
+        mock_get_index.return_value = {
+            course_id: [course_id + '--', '2013-spring-TRAIN-101-AA']}
+
+        builder = CourseBuilder()
+        builder.build()
+        self.assertEqual(builder.get_canvas_section_ids(section), [
+            course_id + '--', '2013-spring-TRAIN-101-AA'])
+        self.assertTrue(builder.has_canvas_section(section, course_id + '--'))
+        self.assertFalse(builder.has_canvas_section(section, course_id + 'B'))
+        mock_get_index.assert_called_once_with('2013-spring')
+        self.assertEqual(mock_get_section.call_count, 0)
+
+        # Immediate priority courses are looked up in Canvas
+        builder.data.force = True
+        self.assertIsNone(builder.get_canvas_section_ids(section))
+        self.assertTrue(builder.has_canvas_section(section, course_id + 'B'))
+        mock_get_section.assert_called_once_with(course_id + 'B')
+        builder.data.force = False
+
+        # Courses missing from the index are looked up in Canvas
+        mock_get_index.return_value = {}
+        mock_get_section.side_effect = DataFailureException(
+            '', 404, 'Not Found')
+        builder = CourseBuilder()
+        builder.build()
+        self.assertIsNone(builder.get_canvas_section_ids(section))
+        self.assertFalse(builder.has_canvas_section(section, course_id + 'B'))
+        self.assertEqual(mock_get_section.call_count, 2)
+
+        mock_get_index.side_effect = ReportFailureException(mock.Mock())
+        builder = CourseBuilder()
+        builder.build()
+        self.assertIsNone(builder.get_canvas_section_ids(section))
+        self.assertIsNone(builder.canvas_indexes['2013-spring'])
+
     @mock.patch(
         'sis_provisioner.builders.courses.get_unused_course_report_data')
     def test_unused_course_builder(self, mock_report):
@@ -3,13 +3,51 @@
 
 
 from django.test import TestCase
+from uw_pws.util import fdao_pws_override
+from uw_sws.util import fdao_sws_override
 from sis_provisioner.builders.enrollments import EnrollmentBuilder
-from datetime import datetime
+from sis_provisioner.dao.course import get_section_by_id
+from sis_provisioner.dao.user import get_person_by_regid
+from sis_provisioner.models.enrollment import Enrollment
+from datetime import datetime, timezone
+import mock
 
 
+@fdao_sws_override
+@fdao_pws_override
 class EnrollmentBuilderTest(TestCase):
     def test_enrollment_builder(self):
         builder = EnrollmentBuilder()
 
         self.assertEqual(builder.build(), None)
         self.assertEqual(type(builder.retry_missing_id), datetime)
+
+    @mock.patch.object(EnrollmentBuilder, '_write')
+    @mock.patch('sis_provisioner.builders.enrollments.get_person_by_regid',
+                side_effect=get_person_by_regid)
+    @mock.patch('sis_provisioner.builders.get_section_by_id',
+                side_effect=get_section_by_id)
+    @mock.patch('sis_provisioner.csv.format.account_id_for_section',
+                return_value='account_id')
+    def test_fetch_counts(self, mock_account_id, mock_get_section,
+                          mock_get_person, mock_write):
+        now_dt = datetime(2013, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+        enrollments = []
+        for course_id in ['2013-spring-TRAIN-101-A',
+                          '2013-summer-TRAIN-101-A']:
+            for reg_id in ['9136CCB8F66711D5BE060004AC494FFE',
+                           '6DF0A9206A7D11D5A4AE0004AC494FFE',
+                           '00000000000000000000000000000000']:
+                enrollments.append(Enrollment(
+                    course_id=course_id, reg_id=reg_id, role='Student',
+                    status='active', last_modified=now_dt))
+
+        builder = EnrollmentBuilder(enrollments)
+        with mock.patch.object(Enrollment, 'save') as mock_save:
+            builder.build()
+            self.assertEqual(mock_save.call_count, 4)
+
+        self.assertEqual(mock_get_section.call_count, 2)
+        self.assertEqual(mock_get_person.call_count, 3)
+        self.assertEqual(len(builder.data.enrollments), 2)
+        self.assertEqual(len(builder.data.users), 1)
@@ -4,14 +4,21 @@
 
 from django.test import TestCase, override_settings
 from uw_pws import PWS
+from uw_pws.models import Person
 from uw_pws.util import fdao_pws_override
 from uw_sws.util import fdao_sws_override
+from sis_provisioner.models import RowFingerprint
 from sis_provisioner.models.account import Curriculum
 from sis_provisioner.dao.course import (
     get_section_by_label, get_registrations_by_section)
 from sis_provisioner.csv.data import Collector
 from sis_provisioner.csv.format import *
+from datetime import datetime, timezone
+import tracemalloc
+import hashlib
+import json
 import mock
+import os
 
 
 class InvalidFormat(CSVFormat):
@@ -129,6 +136,22 @@ class CSVDataTest(TestCase):
             course_id='course_123', section_id='section_123',
             person=user, role='Observer', status='active')), False)
 
+        # Duplicate of a spilled enrollment
+        csv = Collector(spill_limit=1)
+        self.assertEqual(csv.add(EnrollmentCSV(
+            section_id='abc', person=user, role='Student',
+            status='active')), True)
+        self.assertEqual(len(csv.enrollments), 0)
+        self.assertEqual(csv.add(EnrollmentCSV(
+            section_id='abc', person=user, role='Student',
+            status='active')), False)
+        self.assertEqual(csv.add(EnrollmentCSV(
+            section_id='abc', person=user, role='Student',
+            status='deleted')), True)
+        self.assertEqual(len(csv.enrollment_keys), 0)
+        self.assertEqual(
+            [len(k) for k in csv.spilled_enrollment_keys], [16, 16])
+
     def test_xlists(self):
         csv = Collector()
         self.assertEqual(len(csv.xlists), 0)
@@ -155,10 +178,154 @@ class CSVDataTest(TestCase):
 
         # Test with data
         csv = Collector()
-        csv.enrollments.append(1)
+        csv.add(EnrollmentCSV(
+            section_id='abc', person=PWS().get_person_by_netid('javerage'),
+            role='Student', status='active'))
         self.assertEqual(csv.has_data(), True)
+        csv.snapshots['2013-spring-TRAIN-101-A'] = 'abc'
 
         with self.settings(SIS_IMPORT_CSV_DEBUG=False):
             path = csv.write_files()
-            mock_open.assert_called_with(path + '/enrollments.csv', mode='w')
+            mock_open.assert_any_call(path + '/enrollments.csv', mode='w')
+            mock_open.assert_any_call(path + '/import.zip', mode='wb')
+            mock_open.assert_any_call(path + '/manifest.json', mode='w')
+            mock_open.assert_any_call(path + '/snapshots.json', mode='w')
+            self.assertEqual(csv.snapshots, {})
             self.assertEqual(csv.has_data(), False)
+
+    @mock.patch('sis_provisioner.csv.data.default_storage.open')
+    def test_write_files_spilled(self, mock_open):
+        def build(collector):
+            for name in ['zed', 'abc', 'mno', 'abc', 'def', 'xyz', 'ghi']:
+                collector.add(SectionCSV(
+                    section_id=name, course_id='course-' + name, name=name,
+                    status='active'))
+                collector.add(XlistCSV('xlist-' + name, name))
+                collector.add(AdminCSV(name, 'account_id', 'admin'))
+            return collector
+
+        def written_files(collector):
+            files = {}
+
+            def _open(filename, mode):
+                files[filename] = (mock.MagicMock(), mode)
+                return files[filename][0]
+
+            mock_open.side_effect = _open
+            with self.settings(SIS_IMPORT_CSV_DEBUG=False):
+                path = collector.write_files()
+
+            return dict((
+                os.path.relpath(filename, path), ''.join(
+                    c.args[0] for c in f.write.call_args_list)
+            ) for filename, (f, mode) in files.items() if mode == 'w')
+
+        expected = written_files(build(Collector(spill_limit=0)))
+
+        csv = build(Collector(spill_limit=6))
+        self.assertEqual(len(csv.sections), 0)
+        self.assertEqual(len(csv.admins), 1)
+        self.assertEqual(len(csv.spilled_runs['sections']), 3)
+        self.assertEqual(len(csv.spilled_runs['admins']), 3)
+        self.assertEqual(csv.add(SectionCSV(
+            section_id='zed', course_id='course-zed', name='zed',
+            status='active')), False)
+        self.assertEqual(csv.has_data(), True)
+
+        self.assertEqual(written_files(csv), expected)
+        self.assertEqual(csv.has_data(), False)
+
+    def test_compact_rows(self):
+        csv = Collector()
+        csv.add(XlistCSV('abc', 'def'))
+        csv.add(XlistCSV('abc', 'ghi'))
+        self.assertEqual(type(csv.xlists[0]), CSVRow)
+        self.assertEqual(str(csv.xlists[1]), 'abc,ghi,active\n')
+        self.assertIs(csv.xlists[0][0], csv.xlists[1][0])
+
+    def test_compact_rows_memory(self):
+        persons = [Person(uwregid='{:032X}'.format(i)) for i in range(20000)]
+
+        def enrollments():
+            for i, person in enumerate(persons):
+                yield EnrollmentCSV(
+                    section_id='2013-spring-TRAIN-101-{}'.format(i % 50),
+                    person=person, role='Student', status='active')
+
+        def formatter_storage():
+            # Previous storage of the formatter objects
+            rows, keys = [], {}
+            for formatter in enrollments():
+                keys[formatter.key] = True
+                rows.append(formatter)
+            return rows, keys
+
+        def collector_storage():
+            collector = Collector(spill_limit=0)
+            for formatter in enrollments():
+                collector.add(formatter)
+            return collector
+
+        usage = {}
+        for storage in [formatter_storage, collector_storage]:
+            tracemalloc.start()
+            data = storage()
+            usage[storage.__name__], peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del data
+
+        self.assertGreater(
+            usage['formatter_storage'] / usage['collector_storage'], 2)
+
+    @mock.patch('sis_provisioner.csv.data.default_storage.open')
+    def test_suppress_unchanged(self, mock_open):
+        files = {}
+
+        def _open(filename, mode):
+            files[os.path.basename(filename)] = mock.MagicMock()
+            return files[os.path.basename(filename)]
+
+        def written(filename):
+            return ''.join(
+                c.args[0] for c in files[filename].write.call_args_list)
+
+        def add_sections(collector):
+            for name in ['abc', 'def', 'ghi']:
+                collector.add(SectionCSV(
+                    section_id=name, course_id='course', name=name,
+                    status='active'))
+
+        for name in ['abc', 'def']:
+            row = CSVRow([name, 'course', name, 'active', None, None])
+            RowFingerprint.objects.create(
+                csv_type='sections', sis_id=name,
+                digest=hashlib.sha256(str(row).encode('utf-8')).hexdigest(),
+                imported_date=datetime.now(timezone.utc))
+
+        mock_open.side_effect = _open
+        with self.settings(SIS_IMPORT_CSV_DEBUG=False):
+            # Suppression not requested
+            csv = Collector()
+            add_sections(csv)
+            csv.write_files()
+            self.assertEqual(len(written('sections.csv').splitlines()), 4)
+            self.assertEqual(len(json.loads(
+                written('fingerprints.json'))['sections']), 3)
+
+            csv = Collector(suppress_unchanged=True)
+            add_sections(csv)
+            csv.force = True
+            csv.add(SectionCSV(
+                section_id='def', course_id='course', name='def',
+                status='active'))
+            csv.write_files()
+            self.assertEqual(written('sections.csv'), (
+                'section_id,course_id,name,status,start_date,end_date\n'
+                'def,course,def,active,,\n'
+                'ghi,course,ghi,active,,\n'))
+            self.assertEqual(sorted(json.loads(
+                written('fingerprints.json'))['sections']), ['def', 'ghi'])
+
+            with self.settings(SIS_IMPORT_FINGERPRINT_DAYS=0):
+                csv = Collector(suppress_unchanged=True)
+                self.assertEqual(csv.suppress_unchanged, False)
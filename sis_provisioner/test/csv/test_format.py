@@ -12,6 +12,8 @@ from sis_provisioner.dao.course import (
 from sis_provisioner.exceptions import (
     CoursePolicyException, EnrollmentPolicyException, AccountPolicyException)
 from sis_provisioner.csv.format import *
+import csv
+import io
 
 
 class CSVHeaderTest(TestCase):
@@ -281,3 +283,40 @@ class XlistCSVTest(TestCase):
             str(XlistCSV('abc', 'def', 'deleted')), 'abc,def,deleted\n')
         self.assertEqual(
             str(XlistCSV('abc', 'def')), 'abc,def,active\n')
+
+
+class CSVWriterTest(TestCase):
+    def _rows(self, count):
+        context = Curriculum(full_name='CSV Test')
+        rows = []
+        for i in range(count):
+            rows.append(AccountCSV('account-{}'.format(i), 'def', context))
+            rows.append(SectionCSV(
+                section_id='section-{}'.format(i), course_id='course',
+                name='Name, "{}"'.format(i), status='active'))
+            rows.append(XlistCSV('xlist', 'section-{}'.format(i)))
+        return rows
+
+    def test_writer(self):
+        rows = self._rows(25)
+
+        f = io.StringIO()
+        writer = CSVWriter(f, batch_size=10)
+        writer.write([SectionHeader()])
+        writer.write(rows)
+        writer.writerows([])
+        self.assertEqual(f.getvalue(), str(SectionHeader()) + ''.join(
+            str(row) for row in rows))
+
+    def test_writer_per_row(self):
+        rows = self._rows(100)
+
+        # Matches the previous per-row serialization
+        csv.register_dialect('unix_newline', lineterminator='\n')
+        per_row = io.StringIO()
+        for row in rows:
+            csv.writer(per_row, dialect='unix_newline').writerow(row.data)
+
+        batched = io.StringIO()
+        CSVWriter(batched).write(rows)
+        self.assertEqual(batched.getvalue(), per_row.getvalue())
@@ -3,15 +3,21 @@
 
 
 from django.test import TestCase, override_settings
+from django.core.files.storage import FileSystemStorage
 from sis_provisioner.dao.canvas import *
 from sis_provisioner.dao.course import get_section_by_label
+from sis_provisioner.exceptions import MissingImportPathException
 from uw_pws import PWS
 from uw_pws.util import fdao_pws_override
 from uw_sws.util import fdao_sws_override
 from uw_sws.models import Registration
 from datetime import datetime
 from unittest.mock import ANY
+import tracemalloc
+import tempfile
+import zipfile
 import mock
+import os
 
 
 class CanvasIDTest(TestCase):
@@ -227,6 +233,12 @@ class CanvasReportsTest(TestCase):
         pass
 
 
+class LocalStorage(FileSystemStorage):
+    def _open(self, name, mode='rb'):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        return super()._open(name, mode)
+
+
 class CanvasSISImportsTest(TestCase):
     @mock.patch('sis_provisioner.dao.canvas.default_storage.listdir')
     @mock.patch.object(SISImport, 'import_archive')
@@ -241,6 +253,336 @@ class CanvasSISImportsTest(TestCase):
             ANY, params={
                 'override_sis_stickiness': '1', 'clear_sis_stickiness': '1'})
 
+    def test_sis_import_by_path_archive(self):
+        from sis_provisioner.csv.data import Collector
+        from sis_provisioner.csv.format import SectionCSV, XlistCSV
+
+        def stub_import_archive(archive, params={}):
+            # Stub Canvas endpoint, reads the posted body in chunks
+            self.assertFalse(isinstance(archive, bytes))
+            with zipfile.ZipFile(archive) as zip_file:
+                for name in zip_file.namelist():
+                    with zip_file.open(name) as f:
+                        while f.read(65536):
+                            pass
+                return zip_file.namelist()
+
+        def upload_peak(storage, row_count):
+            collector = Collector()
+            for i in range(row_count):
+                section_id = '{}-{}'.format(os.urandom(8).hex(), i)
+                collector.add(SectionCSV(
+                    section_id=section_id, course_id=section_id,
+                    name=section_id, status='active'))
+                collector.add(XlistCSV('abc', section_id))
+
+            with self.settings(SIS_IMPORT_CSV_DEBUG=False):
+                path = collector.write_files()
+
+            self.assertEqual(sorted(storage.listdir(path)[1]), [
+                'fingerprints.json', 'import.zip', 'manifest.json',
+                'sections.csv', 'xlists.csv'])
+
+            with zipfile.ZipFile(storage.open(path + '/import.zip')) as zf:
+                for name in ['sections.csv', 'xlists.csv']:
+                    with storage.open(path + '/' + name, mode='rb') as f:
+                        self.assertEqual(zf.read(name), f.read())
+
+            tracemalloc.start()
+            with mock.patch.object(SISImport, 'import_archive',
+                                   side_effect=stub_import_archive):
+                self.assertEqual(sis_import_by_path(path), [
+                    'sections.csv', 'xlists.csv'])
+            size, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return peak
+
+        with tempfile.TemporaryDirectory() as location:
+            storage = LocalStorage(location=location)
+            with mock.patch('sis_provisioner.dao.canvas.default_storage',
+                            storage), \
+                    mock.patch('sis_provisioner.csv.data.default_storage',
+                               storage):
+                small_peak = upload_peak(storage, 1000)
+                large_peak = upload_peak(storage, 20000)
+
+        # Upload memory does not grow with the size of the csv files
+        self.assertLess(large_peak, small_peak * 2)
+
+    def test_sis_import_by_path_sharded(self):
+        from sis_provisioner.csv.data import Collector
+        from sis_provisioner.csv.format import CourseCSV, SectionCSV
+
+        def stub_import_archive(archive, params={}):
+            with zipfile.ZipFile(archive) as zip_file:
+                return dict((name, zip_file.read(name).decode('utf-8')) for (
+                    name) in zip_file.namelist())
+
+        collector = Collector()
+        for i in range(3):
+            collector.add(CourseCSV(
+                course_id='course-{}'.format(i), short_name='abc',
+                long_name='abc', account_id='acct', term_id='term'))
+        for i in range(5):
+            collector.add(SectionCSV(
+                section_id='section-{}'.format(i), course_id='course-0',
+                name='abc'))
+
+        with tempfile.TemporaryDirectory() as location:
+            storage = LocalStorage(location=location)
+            with mock.patch('sis_provisioner.dao.canvas.default_storage',
+                            storage), \
+                    mock.patch('sis_provisioner.csv.data.default_storage',
+                               storage), \
+                    mock.patch.object(SISImport, 'import_archive',
+                                      side_effect=stub_import_archive), \
+                    self.settings(SIS_IMPORT_CSV_DEBUG=False,
+                                  SIS_IMPORT_SHARD_ROWS=4):
+                path = collector.write_files()
+                archives = get_sis_import_archives(path)
+                self.assertEqual(archives, [
+                    'import-001.zip', 'import-002.zip'])
+
+                shards = [sis_import_by_path(path, archive_name=name) for (
+                    name) in archives]
+                with storage.open(path + '/sections.csv', mode='r') as f:
+                    sections = f.read().splitlines()
+
+        # Courses land before sections, each member has a header
+        self.assertEqual(sorted(shards[0].keys()), [
+            'courses.csv', 'sections.csv'])
+        self.assertEqual(len(shards[0]['courses.csv'].splitlines()), 4)
+        self.assertEqual(shards[0]['sections.csv'].splitlines(),
+                         sections[:2])
+        self.assertEqual(sorted(shards[1].keys()), ['sections.csv'])
+        self.assertEqual(shards[1]['sections.csv'].splitlines(),
+                         sections[:1] + sections[2:])
+
+        self.assertEqual(get_sis_import_archives('abc'), ['import.zip'])
+
+    def test_sis_import_manifest_digest(self):
+        from sis_provisioner.csv.data import Collector
+        from sis_provisioner.csv.format import SectionCSV
+
+        def write_digest(collector, shard_rows, names):
+            for name in names:
+                collector.add(SectionCSV(
+                    section_id=name, course_id='course', name=name))
+            with self.settings(SIS_IMPORT_CSV_DEBUG=False,
+                               SIS_IMPORT_SHARD_ROWS=shard_rows):
+                path = collector.write_files()
+            return get_sis_import_manifest(path)['digest']
+
+        with tempfile.TemporaryDirectory() as location:
+            storage = LocalStorage(location=location)
+            with mock.patch('sis_provisioner.dao.canvas.default_storage',
+                            storage), \
+                    mock.patch('sis_provisioner.csv.data.default_storage',
+                               storage):
+                digest = write_digest(Collector(), 0, ['abc', 'def'])
+                self.assertEqual(len(digest), 64)
+                self.assertEqual(
+                    write_digest(Collector(), 0, ['def', 'abc']), digest)
+                self.assertEqual(
+                    write_digest(Collector(), 1, ['abc', 'def']), digest)
+                self.assertNotEqual(
+                    write_digest(Collector(), 0, ['abc', 'ghi']), digest)
+
+    def test_sis_import_merged_files(self):
+        from sis_provisioner.csv.data import Collector, merge_files
+        from sis_provisioner.csv.format import SectionCSV, XlistCSV
+
+        with tempfile.TemporaryDirectory() as location:
+            storage = LocalStorage(location=location)
+            with mock.patch('sis_provisioner.dao.canvas.default_storage',
+                            storage), \
+                    mock.patch('sis_provisioner.csv.data.default_storage',
+                               storage), \
+                    self.settings(SIS_IMPORT_CSV_DEBUG=False):
+                collector = Collector()
+                collector.add(SectionCSV(
+                    section_id='abc', course_id='course', name='abc'))
+                path1 = collector.write_files()
+
+                collector.add(SectionCSV(
+                    section_id='def', course_id='course', name='def'))
+                collector.add(XlistCSV('course', 'def'))
+                path2 = collector.write_files()
+
+                collector.add(SectionCSV(
+                    section_id='abc', course_id='course', name='abc',
+                    status='deleted'))
+                path3 = collector.write_files()
+
+                path = merge_files([path1, path2, path3])
+                manifest = get_sis_import_manifest(path)
+                self.assertEqual(manifest['archives'], [
+                    {'name': 'import.zip', 'rows': 3}])
+
+                with zipfile.ZipFile(storage.open(path + '/import.zip')) as zf:
+                    self.assertEqual(zf.namelist(), [
+                        'sections.csv', 'xlists.csv'])
+                    self.assertEqual(zf.read('sections.csv').decode(), (
+                        'section_id,course_id,name,status,start_date,'
+                        'end_date\nabc,course,abc,deleted,,\n'
+                        'def,course,def,active,,\n'))
+
+                # A path without a readable manifest fails the merge
+                self.assertRaises(MissingImportPathException, merge_files,
+                                  [path1, '2026/01/01/000000-000000'])
+
+    def test_sis_import_diffing(self):
+        from sis_provisioner.csv.data import Collector
+        from sis_provisioner.csv.format import UserCSV, CourseCSV, SectionCSV
+        from sis_provisioner.models import Import
+
+        posted = []
+
+        def stub_import_archive(archive, params={}):
+            # Stub Canvas endpoint, rejects the first diffing import
+            with zipfile.ZipFile(archive) as zip_file:
+                posted.append((zip_file.namelist(), params))
+            if (params.get('diffing_data_set_identifier') and
+                    len(posted) == 2):
+                raise DataFailureException('/sis_imports', 400, 'invalid')
+            return mock.Mock(import_id=str(len(posted)),
+                             workflow_state='created')
+
+        collector = Collector(suppress_unchanged=True)
+        collector.diffing = True
+        collector.add(UserCSV(PWS().get_person_by_netid('javerage')))
+        collector.add(CourseCSV(
+            course_id='course', short_name='abc', long_name='abc',
+            account_id='acct', term_id='term'))
+        collector.add(SectionCSV(
+            section_id='section', course_id='course', name='abc'))
+
+        with tempfile.TemporaryDirectory() as location:
+            storage = LocalStorage(location=location)
+            with mock.patch('sis_provisioner.dao.canvas.default_storage',
+                            storage), \
+                    mock.patch('sis_provisioner.csv.data.default_storage',
+                               storage), \
+                    mock.patch.object(SISImport, 'import_archive',
+                                      side_effect=stub_import_archive), \
+                    self.settings(SIS_IMPORT_CSV_DEBUG=False,
+                                  SIS_IMPORT_SHARD_ROWS=1,
+                                  SIS_IMPORT_DIFFING_ROW_THRESHOLD=500):
+                path = collector.write_files()
+                self.assertEqual(get_sis_import_manifest(path)['archives'], [
+                    {'name': 'import-001.zip', 'rows': 1},
+                    {'name': 'import-002.zip', 'rows': 2, 'diffing': True}])
+
+                imp = Import(csv_type='course', csv_path=path,
+                             diffing_data_set='course-2013-spring')
+                imp.import_csv()
+
+        diffing = {'diffing_data_set_identifier': 'course-2013-spring',
+                   'change_threshold': '10',
+                   'diff_row_count_threshold': '500'}
+        self.assertEqual(posted, [
+            (['users.csv'], {}),
+            (['courses.csv', 'sections.csv'], diffing),
+            (['courses.csv', 'sections.csv'], {})])
+        self.assertEqual(imp.post_status, 200)
+        self.assertEqual(imp.shard_ids(), ['1', '3'])
+
+        self.assertEqual(diffing_params('abc'), {
+            'diffing_data_set_identifier': 'abc', 'change_threshold': '10'})
+
+    def test_sis_import_staged(self):
+        from sis_provisioner.csv.data import Collector, merge_files
+        from sis_provisioner.csv.format import SectionCSV
+        from sis_provisioner.dao.storage import upload_staged_files
+
+        def stub_import_archive(archive, params={}):
+            with zipfile.ZipFile(archive) as zip_file:
+                return zip_file.namelist()
+
+        collector = Collector()
+        collector.add(SectionCSV(
+            section_id='abc', course_id='course', name='abc'))
+
+        with tempfile.TemporaryDirectory() as location, \
+                tempfile.TemporaryDirectory() as staging_dir:
+            storage = LocalStorage(location=location)
+            with mock.patch('sis_provisioner.dao.canvas.default_storage',
+                            storage), \
+                    mock.patch('sis_provisioner.csv.data.default_storage',
+                               storage), \
+                    mock.patch('sis_provisioner.dao.storage.default_storage',
+                               storage), \
+                    mock.patch('sis_provisioner.csv.data.upload_staged_files'
+                               ) as mock_upload, \
+                    mock.patch.object(SISImport, 'import_archive',
+                                      side_effect=stub_import_archive), \
+                    self.settings(SIS_IMPORT_CSV_DEBUG=False,
+                                  SIS_IMPORT_CSV_STAGING_DIR=staging_dir):
+                path = collector.write_files()
+                mock_upload.assert_called_once_with(path)
+                self.assertFalse(storage.exists(path))
+
+                # Posted and merged from the staging directory, before upload
+                self.assertEqual(sis_import_by_path(path), ['sections.csv'])
+                self.assertEqual(get_sis_import_manifest(merge_files(
+                    [path]))['archives'], [{'name': 'import.zip', 'rows': 1}])
+
+                # Upload retried after a failed copy
+                with mock.patch.object(
+                        storage, 'open',
+                        side_effect=self._fail_once(storage.open)), \
+                        mock.patch('sis_provisioner.dao.storage.sleep'
+                                   ) as mock_sleep:
+                    upload_staged_files(path).join()
+                    mock_sleep.assert_called_once_with(2)
+                self.assertEqual(sorted(storage.listdir(path)[1]), [
+                    'fingerprints.json', 'import.zip', 'manifest.json',
+                    'sections.csv'])
+                self.assertFalse(os.path.exists(
+                    os.path.join(staging_dir, path)))
+
+                # Posted from default_storage, after upload
+                self.assertEqual(sis_import_by_path(path), ['sections.csv'])
+                self.assertIsNone(open_import_file(path + '/users.csv'))
+
+    def _fail_once(self, func):
+        calls = []
+
+        def wrapper(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise IOError('failed')
+            return func(*args, **kwargs)
+        return wrapper
+
+    def test_sis_import_staged_failed(self):
+        from sis_provisioner.dao.storage import upload_staged_files
+
+        with tempfile.TemporaryDirectory() as staging_dir:
+            path = '2026/01/01/000000-000000'
+            os.makedirs(os.path.join(staging_dir, path))
+            with open(os.path.join(staging_dir, path, 'manifest.json'),
+                      'w') as f:
+                f.write('{"archives": [{"name": "import.zip"}]}')
+
+            storage = mock.MagicMock()
+            storage.open.side_effect = IOError('failed')
+            with mock.patch('sis_provisioner.dao.storage.default_storage',
+                            storage), \
+                    mock.patch('sis_provisioner.dao.storage.sleep'
+                               ) as mock_sleep, \
+                    self.settings(SIS_IMPORT_CSV_STAGING_DIR=staging_dir,
+                                  SIS_IMPORT_CSV_UPLOAD_ATTEMPTS=3):
+                upload_staged_files(path).join()
+                self.assertEqual(storage.open.call_count, 3)
+                self.assertEqual(mock_sleep.call_count, 2)
+
+                # Left staged, and still read from the staging directory
+                self.assertTrue(os.path.exists(
+                    os.path.join(staging_dir, path, 'manifest.json')))
+                self.assertEqual(get_sis_import_manifest(path), {
+                    'archives': [{'name': 'import.zip'}]})
+
     @mock.patch('sis_provisioner.dao.canvas.SISImportModel')
     @mock.patch.object(SISImport, 'get_import_status')
     def test_get_sis_import_status(self, mock_method, mock_model):
@@ -9,6 +9,7 @@ from uw_pws.util import fdao_pws_override
 from restclients_core.exceptions import DataFailureException
 from sis_provisioner.exceptions import CoursePolicyException
 from sis_provisioner.dao.course import *
+from uw_sws import get_resource as sws_get_resource
 from datetime import datetime
 import mock
 
@@ -334,6 +335,37 @@ class RegistrationsBySectionTest(TestCase):
         registrations = get_registrations_by_section(section)
         self.assertEqual(len(registrations), 2)
 
+    @mock.patch('sis_provisioner.dao.course.get_resource')
+    def test_get_registrations_by_curriculum(self, mock_get_resource):
+        section = get_section_by_label('2013,winter,DROP_T,100/B')
+        registrations = sws_get_resource(
+            '/student/v5/registration.json?curriculum_abbreviation=DROP_T'
+            '&instructor_reg_id=&course_number=100&verbose=true&year=2013'
+            '&quarter=winter&is_active=&section_id=B'
+            '&transcriptable_course=all')['Registrations']
+        other = dict(registrations[0], Section=dict(
+            registrations[0]['Section'], SectionID='A'))
+        mock_get_resource.side_effect = [
+            {'Registrations': registrations[:1],
+             'Next': {'Href': '/student/v5/registration.json?page=2'}},
+            {'Registrations': registrations[1:] + [other], 'Next': ''},
+        ]
+
+        data = get_registrations_by_curriculum('DROP_T', section.term)
+        self.assertEqual(mock_get_resource.call_count, 2)
+        url = mock_get_resource.call_args_list[0].args[0]
+        self.assertIn('curriculum_abbreviation=DROP_T', url)
+        self.assertIn('course_number=&', url)
+        self.assertEqual(mock_get_resource.call_args_list[1].args[0],
+                         '/student/v5/registration.json?page=2')
+        self.assertEqual(sorted(data.keys()), [
+            '2013,winter,DROP_T,100/A', '2013,winter,DROP_T,100/B'])
+
+        self.assertEqual(
+            [r.regid for r in get_registrations_by_section(
+                section, data['2013,winter,DROP_T,100/B'])],
+            [r.regid for r in get_registrations_by_section(section)])
+
 
 @fdao_sws_override
 @fdao_pws_override
@@ -0,0 +1,145 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.test import TestCase
+from aws_message.processor import ProcessorException
+from sis_provisioner.events import EnrollmentEventBuffer, BufferedGather
+from sis_provisioner.events.enrollment import EnrollmentProcessor
+from sis_provisioner.dao.course import get_section_by_id
+from uw_sws.util import fdao_sws_override
+from datetime import datetime, timedelta
+import mock
+
+SQS_SETTINGS = {
+    'QUEUE_ARN': 'arn:aws:sqs:us-east-1:123456789012:enrollment',
+    'KEY_ID': 'key_id',
+    'KEY': 'key',
+    'VISIBILITY_TIMEOUT': 60,
+}
+
+
+@fdao_sws_override
+class EnrollmentEventBufferTest(TestCase):
+    def event(self, reg_id, status, minutes, duplicate_code='A'):
+        return {
+            'Section': get_section_by_id('2013-summer-TRAIN-101-A'),
+            'UWRegID': reg_id,
+            'Role': 'Student',
+            'Status': status,
+            'LastModified': datetime(2013, 1, 1) + timedelta(
+                minutes=minutes),
+            'DuplicateCode': duplicate_code,
+            'InstructorUWRegID': None}
+
+    def test_add(self):
+        buffer = EnrollmentEventBuffer()
+        buffer.add([self.event('A' * 32, 'Active', 0),
+                    self.event('A' * 32, 'Deleted', 2),
+                    self.event('B' * 32, 'Active', 1)])
+        buffer.add([self.event('A' * 32, 'Active', 1),
+                    self.event('B' * 32, 'Deleted', 5, duplicate_code='')])
+        self.assertEqual(len(buffer), 2)
+
+        self.assertEqual(buffer.event_count, 5)
+        self.assertEqual(sorted((e['UWRegID'][0], e['Status']) for e in (
+            buffer.enrollments())), [('A', 'Deleted'), ('B', 'Active')])
+
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.event_count, 0)
+        self.assertEqual(buffer.enrollments(), [])
+
+    @mock.patch('sis_provisioner.events.Enrollment.objects.add_enrollments')
+    def test_processor(self, mock_add_enrollments):
+        processor = EnrollmentProcessor()
+        processor.load_enrollments([self.event('A' * 32, 'Active', 0)])
+        self.assertEqual(mock_add_enrollments.call_count, 1)
+
+        processor.buffer = EnrollmentEventBuffer()
+        processor.load_enrollments([self.event('A' * 32, 'Active', 0)])
+        processor.load_enrollments([self.event('A' * 32, 'Deleted', 1)])
+        self.assertEqual(mock_add_enrollments.call_count, 1)
+
+        processor.flush_enrollments()
+        self.assertEqual(mock_add_enrollments.call_count, 2)
+        self.assertEqual(mock_add_enrollments.call_args.args[0][0]['Status'],
+                         'Deleted')
+        self.assertEqual(len(processor.buffer), 0)
+
+    @mock.patch('sis_provisioner.events.Enrollment.objects.add_enrollments')
+    def test_shutdown_during_flush(self, mock_add_enrollments):
+        message = mock.MagicMock()
+        processor = EnrollmentProcessor()
+        gather = BufferedGather(
+            processor=processor, window=0, sqs_settings=SQS_SETTINGS)
+        gather._queue = mock.MagicMock()
+        gather._queue.get_messages.side_effect = [[message]]
+        gather._process_message = mock.MagicMock(
+            side_effect=lambda msg: processor.load_enrollments(
+                [self.event('A' * 32, 'Active', 0)]) or True)
+
+        # SIGTERM during the load, events kept for the final flush
+        mock_add_enrollments.side_effect = [SystemExit(), None]
+        self.assertRaises(SystemExit, gather.gather_events)
+        self.assertEqual(mock_add_enrollments.call_count, 2)
+        self.assertEqual(mock_add_enrollments.call_args_list[0],
+                         mock_add_enrollments.call_args_list[1])
+        self.assertEqual(message.delete.call_count, 1)
+        self.assertEqual(len(processor.buffer), 0)
+
+        # SIGTERM during both loads, message left for redelivery
+        message = mock.MagicMock()
+        gather._queue.get_messages.side_effect = [[message]]
+        mock_add_enrollments.reset_mock()
+        mock_add_enrollments.side_effect = [SystemExit(), SystemExit()]
+        self.assertRaises(SystemExit, gather.gather_events)
+        self.assertEqual(mock_add_enrollments.call_count, 2)
+        self.assertEqual(message.delete.call_count, 0)
+
+
+class BufferedGatherTest(TestCase):
+    def gather(self, window, polls, processed=True):
+        processor = mock.MagicMock()
+        gather = BufferedGather(
+            processor=processor, window=window, sqs_settings=SQS_SETTINGS)
+        gather._queue = mock.MagicMock()
+        gather._queue.get_messages.side_effect = polls
+        gather._process_message = mock.MagicMock(return_value=processed)
+        return gather
+
+    @mock.patch('sis_provisioner.events.time')
+    def test_gather_events(self, mock_time):
+        messages = [mock.MagicMock() for i in range(3)]
+
+        # Empty poll ends the gather, buffered events flushed at the end
+        mock_time.return_value = 100
+        gather = self.gather(300, [messages[:2], []])
+        gather.gather_events()
+        self.assertEqual(gather._queue.get_messages.call_count, 2)
+        self.assertEqual(gather._processor.flush_enrollments.call_count, 1)
+        self.assertEqual(messages[0].delete.call_count, 1)
+        self.assertEqual(gather.pending, [])
+
+        # Flushed before half of the visibility timeout
+        mock_time.side_effect = [0, 0, 10, 10, 20, 35, 35, 40, 40, 301]
+        gather = self.gather(300, [messages[:1], messages[1:2], messages[2:]])
+        gather.gather_events()
+        self.assertEqual(gather._queue.get_messages.call_count, 3)
+        self.assertEqual(gather._processor.flush_enrollments.call_count, 2)
+        self.assertEqual(messages[2].delete.call_count, 1)
+
+    def test_flush_failure(self):
+        message = mock.MagicMock()
+        gather = self.gather(0, [[message]])
+        gather._processor.flush_enrollments.side_effect = ProcessorException()
+        gather.gather_events()
+        self.assertEqual(message.delete.call_count, 0)
+        self.assertEqual(gather.pending, [])
+
+    def test_shutdown(self):
+        message = mock.MagicMock()
+        gather = self.gather(300, [[message], SystemExit()])
+        self.assertRaises(SystemExit, gather.gather_events)
+        self.assertEqual(gather._processor.flush_enrollments.call_count, 1)
+        self.assertEqual(message.delete.call_count, 1)
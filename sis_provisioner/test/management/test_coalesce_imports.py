@@ -0,0 +1,32 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.test import TestCase
+from sis_provisioner.management.commands.coalesce_imports import Command
+from sis_provisioner.models import Import, Job
+from datetime import datetime, timezone
+import mock
+
+
+class CoalesceImportsCommandTest(TestCase):
+    @mock.patch.object(Import, 'csv_row_count', return_value=10)
+    @mock.patch('sis_provisioner.management.commands.coalesce_imports.'
+                'default_storage')
+    @mock.patch('sys.argv', ['manage.py', 'coalesce_imports'])
+    def test_coalesced_imports(self, mock_storage, mock_row_count):
+        Job.objects.create(name='coalesce_imports',
+                           title='Coalesce Imports', is_active=True,
+                           changed_date=datetime.now(timezone.utc))
+        for path in ['path1', 'path2', 'staged', 'path3']:
+            Import.objects.create(csv_type='user', csv_path=path,
+                                  csv_digest=path)
+
+        # The staged import is left until its manifest is uploaded
+        mock_storage.exists.side_effect = lambda p: not p.startswith('staged')
+        with self.settings(SIS_IMPORT_COALESCE_ROWS=25):
+            imports = Command().coalesced_imports()
+
+        self.assertEqual([[imp.csv_path for imp in pack] for (
+            pack) in imports], [['path1', 'path2'], ['path3']])
+        mock_storage.exists.assert_any_call('staged/manifest.json')
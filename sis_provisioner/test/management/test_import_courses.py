@@ -0,0 +1,110 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.test import TestCase
+from sis_provisioner.management.commands.import_courses import (
+    Command, build_import)
+from sis_provisioner.models import Import, Job
+from sis_provisioner.models.course import Course
+from sis_provisioner.models.user import User
+from sis_provisioner.exceptions import MissingImportPathException
+from datetime import datetime, timezone
+import mock
+
+
+class ImportCoursesCommandTest(TestCase):
+    @mock.patch.object(Import, 'import_csv', autospec=True)
+    @mock.patch(
+        'sis_provisioner.management.commands.import_courses.CourseBuilder')
+    @mock.patch('sys.argv', ['manage.py', 'import_courses', '3', 'any'])
+    def test_import_per_term(self, mock_builder, mock_import_csv):
+        Job.objects.create(name='import_courses:3:any',
+                           title='Import Courses (3, any)', is_active=True,
+                           changed_date=datetime.now(timezone.utc))
+        for course_id in ['2013-spring-TRAIN-100-A',
+                          '2013-spring-TRAIN-101-A',
+                          '2013-summer-TRAIN-100-A']:
+            Course.objects.create(
+                course_id=course_id, course_type=Course.SDB_TYPE,
+                term_id=course_id[:11], priority=Course.PRIORITY_IMMEDIATE)
+
+        built = {}
+
+        def builder(queued_objects):
+            courses = list(queued_objects)
+            instance = mock.MagicMock(defer_enrollment=False)
+            instance.data.uploads = []
+            instance.build.return_value = 'path-' + courses[0].term_id
+            built[instance.build.return_value] = sorted(
+                c.course_id for c in courses)
+            return instance
+
+        mock_builder.side_effect = builder
+        with self.settings(SIS_IMPORT_COURSE_TERM_PROCESSES=1):
+            Command().handle(priority=Course.PRIORITY_IMMEDIATE, term='any')
+
+        # One import built and posted per queued term
+        self.assertEqual(built, {
+            'path-2013-spring': [
+                '2013-spring-TRAIN-100-A', '2013-spring-TRAIN-101-A'],
+            'path-2013-summer': ['2013-summer-TRAIN-100-A']})
+        posted = [c.args[0] for c in mock_import_csv.call_args_list]
+        self.assertEqual(sorted(imp.csv_path for imp in posted), [
+            'path-2013-spring', 'path-2013-summer'])
+        self.assertEqual(len(set(imp.pk for imp in posted)), 2)
+        for imp in posted:
+            self.assertEqual(imp.priority, Course.PRIORITY_IMMEDIATE)
+            self.assertEqual(len(imp.queued_objects()), len(
+                built[imp.csv_path]))
+
+        self.assertIsNotNone(
+            Job.objects.get(name='import_courses:3:any').last_run_date)
+
+    @mock.patch.object(Import, 'import_csv', autospec=True)
+    @mock.patch(
+        'sis_provisioner.management.commands.import_courses.CourseBuilder')
+    def test_import_two_phase(self, mock_builder, mock_import_csv):
+        def import_csv(imp, coalesce=True):
+            if not imp.csv_path:
+                raise MissingImportPathException()
+
+        def queue():
+            imp = Import(csv_type='course')
+            imp.save()
+            Course.objects.filter(pk=course.pk).update(queue_id=imp.pk)
+            User.objects.filter(pk=user.pk).update(queue_id=imp.pk)
+            return imp
+
+        mock_import_csv.side_effect = import_csv
+        builder = mock_builder.return_value
+        builder.defer_enrollment = True
+        builder.data.uploads = []
+        builder.build_enrollments.return_value = 'path-enrollments'
+        course = Course.objects.create(
+            course_id='2013-spring-TRAIN-101-A', course_type=Course.SDB_TYPE,
+            term_id='2013-spring')
+        user = User.objects.create(net_id='javerage', reg_id='A' * 32)
+
+        # Neither import is held for coalescing
+        builder.build.return_value = 'path-courses'
+        imp = queue()
+        build_import(imp.pk, defer_enrollment=True)
+        self.assertEqual([(c.args[0].csv_path, c.kwargs) for c in (
+            mock_import_csv.call_args_list)], [
+                ('path-courses', {'coalesce': False}),
+                ('path-enrollments', {'coalesce': False})])
+        follow_up = Import.objects.get(csv_path='path-enrollments')
+        self.assertEqual(follow_up.follows_import_id, imp.pk)
+
+        # Empty first import deleted, its models queued for the follow-up
+        builder.build.return_value = None
+        imp = queue()
+        build_import(imp.pk, defer_enrollment=True)
+        self.assertFalse(Import.objects.filter(pk=imp.pk).exists())
+        follow_up = Import.objects.filter(
+            csv_path='path-enrollments').order_by('pk').last()
+        self.assertIsNone(follow_up.follows_import_id)
+        self.assertEqual(list(follow_up.queued_objects()), [course])
+        self.assertEqual(User.objects.get(pk=user.pk).queue_id,
+                         str(follow_up.pk))
@@ -4,12 +4,15 @@
 
 from django.test import TestCase
 from django.db.models.query import QuerySet
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from sis_provisioner.dao.course import get_section_by_id
 from sis_provisioner.models import Import
-from sis_provisioner.models.course import Course
-from sis_provisioner.exceptions import CoursePolicyException
+from sis_provisioner.models.course import (
+    Course, CourseBatch, CanvasSectionIndex)
+from sis_provisioner.exceptions import (
+    CoursePolicyException, EmptyQueueException)
 from uw_sws.util import fdao_sws_override
+from uw_sws.term import get_term_by_year_and_quarter
 from uw_pws.util import fdao_pws_override
 import mock
 
@@ -85,6 +88,41 @@ class CourseModelTest(TestCase):
 
         Course.objects.all().delete()
 
+    def test_course_batch(self):
+        sections = [get_section_by_id(course_id) for course_id in [
+            '2013-summer-TRAIN-101-A', '2013-spring-TRAIN-101-A',
+            '2013-winter-DROP_T-100-B']]
+        for section in sections[:2]:
+            Course.objects.create(course_id=section.canvas_course_sis_id(),
+                                  course_type=Course.SDB_TYPE,
+                                  term_id=section.term.canvas_sis_id())
+        course_ids = [s.canvas_course_sis_id() for s in sections]
+
+        batch = CourseBatch()
+        with self.assertNumQueries(1):
+            batch.preload(course_ids + ['2013-summer-TRAIN-999-A'])
+
+        with self.assertNumQueries(0):
+            for section in sections:
+                batch.add_to_queue(section, '5')
+                batch.update_status(section)
+            batch.remove_from_queue(course_ids[1], error='oops')
+            batch.remove_from_queue('2013-summer-TRAIN-999-A')
+            self.assertIsNone(batch.get('2013-summer-TRAIN-999-A'))
+
+        # One create, one update for each set of changed fields
+        with self.assertNumQueries(5):
+            batch.flush()
+
+        self.assertEqual(Course.objects.filter(queue_id='5').count(), 2)
+        course = Course.objects.get(course_id=course_ids[1])
+        self.assertEqual(course.queue_id, None)
+        self.assertEqual(course.provisioned_error, True)
+        self.assertEqual(course.provisioned_status, 'oops')
+
+        with self.assertNumQueries(0):
+            batch.flush()
+
     def test_update_status(self):
         course_id = '2013-summer-TRAIN-101-A'
 
@@ -169,3 +207,131 @@ class CourseModelTest(TestCase):
 
         r = Course.objects.dequeue(Import(pk=1, priority=Course.PRIORITY_HIGH))
         mock_update.assert_called_with(queue_id=None)
+
+    def test_queue_by_term(self):
+        term = get_term_by_year_and_quarter(2013, 'spring')
+        self.assertRaises(
+            EmptyQueueException, Course.objects.queue_by_term, term)
+
+        for course_id, priority in [('2013-spring-TRAIN-100-A', 1),
+                                    ('2013-spring-TRAIN-101-A', 2),
+                                    ('2013-summer-TRAIN-100-A', 1)]:
+            Course.objects.create(
+                course_id=course_id, course_type=Course.SDB_TYPE,
+                term_id=course_id[:11], priority=priority)
+
+        imp = Course.objects.queue_by_term(term)
+        self.assertEqual(imp.diffing_data_set,
+                         'course-enrollment-2013-spring')
+        self.assertEqual(sorted(imp.queued_objects().values_list(
+            'course_id', flat=True)), [
+                '2013-spring-TRAIN-100-A', '2013-spring-TRAIN-101-A'])
+
+        Course.objects.filter(course_id='2013-spring-TRAIN-101-A').update(
+            queue_id=None)
+        imp = Course.objects.queue_by_term(term, include_enrollment=False)
+        self.assertIsNone(imp.diffing_data_set)
+        self.assertEqual(len(imp.queued_objects()), 1)
+
+    def test_queue_by_term_excluded_courses(self):
+        term = get_term_by_year_and_quarter(2013, 'spring')
+        for course_id, priority in [('2013-spring-TRAIN-100-A', 1),
+                                    ('2013-spring-TRAIN-101-A', 0)]:
+            Course.objects.create(
+                course_id=course_id, course_type=Course.SDB_TYPE,
+                term_id=course_id[:11], priority=priority)
+
+        imp = Course.objects.queue_by_term(term)
+        self.assertIsNone(imp.diffing_data_set)
+        self.assertEqual(list(imp.queued_objects().values_list(
+            'course_id', flat=True)), ['2013-spring-TRAIN-100-A'])
+
+        Course.objects.all().update(queue_id=None)
+        Course.objects.filter(course_id='2013-spring-TRAIN-101-A').update(
+            priority=Course.PRIORITY_DEFAULT, provisioned_error=True)
+        imp = Course.objects.queue_by_term(term)
+        self.assertIsNone(imp.diffing_data_set)
+        self.assertEqual(len(imp.queued_objects()), 1)
+
+        Course.objects.all().update(queue_id=None, provisioned_error=None)
+        imp = Course.objects.queue_by_term(term)
+        self.assertEqual(imp.diffing_data_set,
+                         'course-enrollment-2013-spring')
+        self.assertEqual(len(imp.queued_objects()), 2)
+
+    def test_queue_by_priority_per_term(self):
+        self.assertRaises(
+            EmptyQueueException, Course.objects.queue_by_priority_per_term,
+            Course.PRIORITY_IMMEDIATE)
+
+        for course_id, priority in [('2013-spring-TRAIN-100-A', 3),
+                                    ('2013-spring-TRAIN-101-A', 3),
+                                    ('2013-spring-TRAIN-102-A', 3),
+                                    ('2013-spring-TRAIN-103-A', 1),
+                                    ('2013-summer-TRAIN-100-A', 3)]:
+            Course.objects.create(
+                course_id=course_id, course_type=Course.SDB_TYPE,
+                term_id=course_id[:11], priority=priority)
+
+        with self.settings(SIS_IMPORT_LIMIT={'course': {'default': 2}}):
+            imports = Course.objects.queue_by_priority_per_term(
+                Course.PRIORITY_IMMEDIATE)
+
+        self.assertEqual(len(imports), 2)
+        self.assertEqual(
+            [imp.priority for imp in imports], [Course.PRIORITY_IMMEDIATE] * 2)
+        self.assertEqual(len(imports[0].queued_objects()), 2)
+        self.assertEqual(list(imports[1].queued_objects().values_list(
+            'course_id', flat=True)), ['2013-summer-TRAIN-100-A'])
+
+        imports = Course.objects.queue_by_priority_per_term(
+            Course.PRIORITY_IMMEDIATE)
+        self.assertEqual(len(imports), 1)
+        self.assertEqual(imports[0].queued_objects()[0].term_id,
+                         '2013-spring')
+        self.assertRaises(
+            EmptyQueueException, Course.objects.queue_by_priority_per_term,
+            Course.PRIORITY_IMMEDIATE)
+
+
+class CanvasSectionIndexModelTest(TestCase):
+    @mock.patch('sis_provisioner.models.course.get_section_report_data')
+    def test_get_index(self, mock_report):
+        mock_report.return_value = [
+            'canvas_section_id,section_id,canvas_course_id,course_id,'
+            'integration_id,name,status,start_date,end_date',
+            '1,2013-spring-TRAIN-101-A--,11,2013-spring-TRAIN-101-A,,'
+            'TRAIN 101 A,active,,',
+            '2,2013-spring-TRAIN-101-AA,11,2013-spring-TRAIN-101-A,,'
+            'TRAIN 101 AA,active,,',
+            '3,2013-spring-TRAIN-101-AB,11,2013-spring-TRAIN-101-A,,'
+            'TRAIN 101 AB,deleted,,',
+            '4,,12,course_12,,Manual,active,,',
+            '']
+        index = {'2013-spring-TRAIN-101-A': [
+            '2013-spring-TRAIN-101-A--', '2013-spring-TRAIN-101-AA']}
+
+        self.assertEqual(
+            CanvasSectionIndex.objects.get_index('2013-spring'), index)
+        mock_report.assert_called_once_with('2013-spring')
+
+        # Stored index is used until it expires
+        self.assertEqual(
+            CanvasSectionIndex.objects.get_index('2013-spring'), index)
+        self.assertEqual(mock_report.call_count, 1)
+
+        CanvasSectionIndex.objects.filter(term_id='2013-spring').update(
+            indexed_date=datetime.now(timezone.utc) - timedelta(minutes=61))
+        self.assertEqual(
+            CanvasSectionIndex.objects.get_index('2013-spring'), index)
+        self.assertEqual(mock_report.call_count, 2)
+        self.assertEqual(CanvasSectionIndex.objects.count(), 1)
+
+        mock_report.return_value = None
+        self.assertEqual(
+            CanvasSectionIndex.objects.get_index('2013-autumn'), {})
+
+        with self.settings(SIS_IMPORT_CANVAS_SECTION_INDEX_MINUTES=0):
+            self.assertIsNone(
+                CanvasSectionIndex.objects.get_index('2013-spring'))
+        self.assertEqual(mock_report.call_count, 3)
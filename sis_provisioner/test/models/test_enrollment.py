@@ -3,8 +3,9 @@
 
 
 from django.test import TestCase, override_settings
+from django.db import IntegrityError
 from django.db.models.query import QuerySet
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from sis_provisioner.dao.course import get_section_by_id
 from sis_provisioner.models import Import
 from sis_provisioner.models.enrollment import (
@@ -189,9 +190,112 @@ class EnrollmentModelTest(TestCase):
         Course.objects.all().delete()
         Enrollment.objects.all().delete()
 
+    @mock.patch('sis_provisioner.models.enrollment.is_active_term',
+                return_value=True)
+    @mock.patch('sis_provisioner.models.enrollment.logger')
+    def test_add_enrollments(self, mock_logger, mock_is_active_term):
+        now_dt = datetime(2013, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+        section = get_section_by_id('2013-summer-TRAIN-101-A')
+
+        def event(reg_id, status='Active', duplicate_code='A',
+                  last_modified=now_dt):
+            return {'Section': section, 'UWRegID': reg_id,
+                    'Role': 'Student', 'Status': status,
+                    'LastModified': last_modified,
+                    'DuplicateCode': duplicate_code,
+                    'InstructorUWRegID': None}
+
+        def outcomes():
+            return [c.args[0].split(' status:')[0].replace(
+                'ADD ENROLLMENT: ', '') for c in (
+                    mock_logger.info.call_args_list)]
+
+        Enrollment.objects.add_enrollments([])
+        self.assertEqual(mock_logger.info.call_count, 0)
+
+        # Section not in course table, course created once
+        Enrollment.objects.add_enrollments([event('A' * 32), event('B' * 32)])
+        self.assertEqual(outcomes(), ['IGNORE (Unprovisioned course)'] * 2)
+        course = Course.objects.get(course_id='2013-summer-TRAIN-101-A')
+        self.assertEqual(course.priority, Course.PRIORITY_IMMEDIATE)
+        self.assertEqual(course.term_id, '2013-summer')
+        self.assertEqual(mock_is_active_term.call_count, 1)
+
+        course.provisioned_date = now_dt
+        course.save()
+        Enrollment.objects.create(
+            course_id='2013-summer-TRAIN-101-A', reg_id='C' * 32,
+            role='Student', status='active', duplicate_code='A',
+            last_modified=now_dt, queue_id='1')
+
+        mock_logger.reset_mock()
+        with self.assertNumQueries(6):
+            Enrollment.objects.add_enrollments([
+                event('A' * 32),
+                event('A' * 32, status='Deleted'),
+                event('A' * 32, status='Active', duplicate_code=''),
+                event('C' * 32, status='Deleted'),
+            ])
+        self.assertEqual(outcomes(), [
+            'ADD', 'UPDATE EXISTING',
+            'IGNORE (Out of order: 2013-01-01 00:00:00+00:00)',
+            'IN QUEUE', 'UPDATE EXISTING'])
+
+        enrollment = Enrollment.objects.get(reg_id='A' * 32)
+        self.assertEqual(enrollment.status, 'deleted')
+        self.assertEqual(enrollment.priority, Enrollment.PRIORITY_DEFAULT)
+        enrollment = Enrollment.objects.get(reg_id='C' * 32)
+        self.assertEqual(enrollment.status, 'deleted')
+        self.assertEqual(enrollment.priority, Enrollment.PRIORITY_HIGH)
+
+        # Conflicting writes fall back to add_enrollment
+        mock_logger.reset_mock()
+        with mock.patch.object(
+                EnrollmentManager, 'bulk_create',
+                side_effect=IntegrityError()):
+            Enrollment.objects.add_enrollments([event('D' * 32)])
+        self.assertEqual(outcomes(), ['ADD'])
+        self.assertEqual(Enrollment.objects.filter(
+            reg_id='D' * 32).count(), 1)
+
+        Course.objects.all().delete()
+        Enrollment.objects.all().delete()
+
+    @override_settings(SIS_IMPORT_LIMIT={'enrollment': {'default': 5}})
+    def test_queue_by_priority(self):
+        self.assertRaises(
+            EmptyQueueException, Enrollment.objects.queue_by_priority)
+
+        now_dt = datetime(2013, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+        for i, (course, reg_id) in enumerate([
+                ('A', '1'), ('B', '1'), ('A', '2'), ('C', '1'), ('D', '1'),
+                ('B', '2'), ('A', '3'), ('D', '2'), ('E', '1'),
+                ('B', '3'), ('A', '4'), ('D', '3')]):
+            Enrollment.objects.create(
+                course_id='2013-spring-TRAIN-101-' + course,
+                reg_id=reg_id * 32, role='Student', status='active',
+                last_modified=now_dt + timedelta(minutes=i))
+
+        def queued_courses(imp):
+            return sorted(e.course_id[-1] + e.reg_id[0] for e in (
+                Enrollment.objects.queued(imp.pk)))
+
+        # All of course A, then the oldest of course B
+        imp = Enrollment.objects.queue_by_priority()
+        self.assertEqual(queued_courses(imp), ['A1', 'A2', 'A3', 'A4', 'B1'])
+
+        # Courses C and D, then the oldest of course B
+        imp = Enrollment.objects.queue_by_priority()
+        self.assertEqual(queued_courses(imp), ['B2', 'C1', 'D1', 'D2', 'D3'])
+
+        imp = Enrollment.objects.queue_by_priority()
+        self.assertEqual(queued_courses(imp), ['B3', 'E1'])
+
+        self.assertRaises(
+            EmptyQueueException, Enrollment.objects.queue_by_priority)
+
     @mock.patch.object(QuerySet, 'filter')
-    @mock.patch.object(EnrollmentManager, 'purge_expired')
-    def test_dequeue_imported(self, mock_purge, mock_filter):
+    def test_dequeue_imported(self, mock_filter):
         dt = datetime.now()
         r = Enrollment.objects.dequeue(Import(
             pk=1,
@@ -210,18 +314,6 @@ class EnrollmentModelTest(TestCase):
             Import(pk=1, priority=Enrollment.PRIORITY_HIGH))
         mock_update.assert_called_with(queue_id=None)
 
-    @mock.patch.object(QuerySet, 'filter')
-    @mock.patch('sis_provisioner.models.enrollment.datetime')
-    @override_settings(ENROLLMENT_EVENT_RETENTION_DAYS=3)
-    def test_purge_expired(self, mock_datetime, mock_filter):
-        mock_now = datetime(2013, 1, 4, 0, 0, 0, tzinfo=timezone.utc)
-        mock_datetime.now.return_value = mock_now
-        r = Enrollment.objects.purge_expired()
-        mock_filter.assert_called_with(
-            priority=Enrollment.PRIORITY_NONE,
-            last_modified__lt=datetime(
-                2013, 1, 1, 0, 0, 0, tzinfo=timezone.utc))
-
 
 class InvalidEnrollmentModelTest(TestCase):
     @mock.patch.object(QuerySet, 'filter')
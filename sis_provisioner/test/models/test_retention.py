@@ -0,0 +1,117 @@
+# Copyright 2026 UW-IT, University of Washington
+# SPDX-License-Identifier: Apache-2.0
+
+
+from django.test import TestCase, override_settings
+from sis_provisioner.models import Import
+from sis_provisioner.models.course import Course
+from sis_provisioner.models.enrollment import Enrollment
+from sis_provisioner.models.events import EnrollmentLog
+from sis_provisioner.models.group import GroupMemberGroup
+from sis_provisioner.models.retention import (
+    RetentionPolicy, EnrollmentRetention, EventLogRetention, ImportRetention,
+    purge_expired)
+from datetime import datetime, timedelta, timezone
+import mock
+
+
+class RetentionPolicyTest(TestCase):
+    def setUp(self):
+        self.now = datetime(2013, 6, 1, 0, 0, 0, tzinfo=timezone.utc)
+        for i in range(7):
+            Enrollment.objects.create(
+                course_id='2013-spring-TRAIN-101-A', reg_id=str(i) * 32,
+                role='Student', status='active',
+                priority=Enrollment.PRIORITY_NONE if (
+                    i < 6) else Enrollment.PRIORITY_DEFAULT,
+                last_modified=self.now - timedelta(days=10 - i))
+
+    def test_expired_required(self):
+        class NamedRetention(RetentionPolicy):
+            name = 'named'
+            model = Enrollment
+
+        self.assertRaises(TypeError, RetentionPolicy)
+        self.assertRaises(TypeError, NamedRetention, now=self.now)
+
+    @override_settings(ENROLLMENT_EVENT_RETENTION_DAYS=5,
+                       RETENTION_CHUNK_SIZE=2, RETENTION_CHUNK_PAUSE=0.1)
+    @mock.patch('sis_provisioner.models.retention.sleep')
+    def test_purge(self, mock_sleep):
+        policy = EnrollmentRetention(now=self.now)
+        self.assertEqual(policy.days, 5)
+        self.assertEqual(policy.expired().count(), 5)
+
+        with mock.patch('sis_provisioner.models.retention.logger') as log:
+            self.assertEqual(policy.purge(), 5)
+            log.info.assert_called_with(
+                'Purged 5 expired rows from sis_provisioner_enrollment '
+                'in 3 chunks')
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(sorted(e.reg_id[0] for e in (
+            Enrollment.objects.all())), ['5', '6'])
+
+        self.assertEqual(policy.purge(), 0)
+
+    @override_settings(RETENTION_POLICIES={'enrollment': {'days': 8}})
+    def test_settings(self):
+        policy = EnrollmentRetention(now=self.now)
+        self.assertEqual(policy.days, 8)
+        self.assertEqual(policy.expired().count(), 2)
+
+    def test_event_log(self):
+        minute = int(self.now.timestamp() / 60)
+        for days in [1, 6, 8]:
+            EnrollmentLog.objects.create(
+                minute=minute - days * 24 * 60, event_count=1)
+
+        policy = EventLogRetention(EnrollmentLog, now=self.now)
+        self.assertEqual(policy.table(), 'events_enrollmentlog')
+        self.assertEqual(policy.expired().count(), 1)
+
+    def test_import(self):
+        Import.objects.create(
+            csv_type='enrollment', post_status=200, canvas_progress=100,
+            monitor_date=self.now - timedelta(days=91))
+        Import.objects.create(
+            csv_type='enrollment', post_status=200, canvas_progress=50,
+            monitor_date=self.now - timedelta(days=91))
+        Import.objects.create(
+            csv_type='enrollment', post_status=200, canvas_progress=100,
+            monitor_date=self.now - timedelta(days=10))
+
+        self.assertEqual(ImportRetention(now=self.now).expired().count(), 1)
+
+    def test_import_failed(self):
+        imp = Import.objects.create(
+            csv_type='course', post_status=200, canvas_progress=100,
+            canvas_state='failed_with_messages',
+            monitor_date=self.now - timedelta(days=91))
+        Course.objects.create(
+            course_id='2013-spring-TRAIN-101-A', course_type='sdb',
+            term_id='2013,spring', priority=Course.PRIORITY_HIGH,
+            queue_id=imp.pk)
+
+        self.assertEqual(ImportRetention(now=self.now).purge(), 1)
+        self.assertEqual(Import.objects.count(), 0)
+
+        course = Course.objects.get(course_id='2013-spring-TRAIN-101-A')
+        self.assertIsNone(course.queue_id)
+        self.assertEqual(course.priority, Course.PRIORITY_HIGH)
+        self.assertIsNone(course.provisioned_date)
+
+    @override_settings(RETENTION_POLICIES={
+        'enrollment': {'days': None}, 'group_member_group': {'days': 0}})
+    def test_purge_expired(self):
+        GroupMemberGroup.objects.create(
+            group_id='u_member', root_group_id='u_root', is_deleted=True)
+        GroupMemberGroup.objects.create(
+            group_id='u_member2', root_group_id='u_root')
+
+        deleted = purge_expired()
+        self.assertNotIn('sis_provisioner_enrollment', deleted)
+        self.assertEqual(deleted['sis_provisioner_groupmembergroup'], 1)
+        self.assertEqual(GroupMemberGroup.objects.count(), 1)
+
+        deleted = purge_expired(names=['import'])
+        self.assertEqual(list(deleted.keys()), ['sis_provisioner_import'])
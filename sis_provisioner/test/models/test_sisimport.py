@@ -3,8 +3,9 @@
 
 
 from django.test import TestCase
-from sis_provisioner.models import Import, ImportResource
-from datetime import datetime, timezone
+from sis_provisioner.models import (
+    Import, ImportResource, RowFingerprint, SectionSnapshot)
+from datetime import datetime, timedelta, timezone
 import mock
 
 
@@ -109,6 +110,290 @@ class ImportModelTest(TestCase):
         mock_dequeue.assert_called_once()
         mock_delete.assert_not_called()
 
+    @mock.patch.object(SectionSnapshot.objects, "record_import")
+    @mock.patch.object(RowFingerprint.objects, "record_import")
+    @mock.patch.object(Import, "dequeue_dependent_models")
+    @mock.patch("sis_provisioner.models.get_sis_import_status")
+    def test_update_import_status_snapshots(
+            self, mock_status, mock_dequeue, mock_fingerprints,
+            mock_snapshots):
+        mock_status.return_value = mock.Mock(
+            workflow_state="imported", progress=100, processing_warnings=[],
+            processing_errors=[])
+
+        imp = Import(csv_type="course", canvas_id="1", post_status=200)
+        imp.save()
+        follow_up = Import(csv_type="course", canvas_id="2", post_status=200,
+                           follows_import_id=imp.pk)
+        follow_up.save()
+
+        # Not recorded before the linked import is imported
+        imp.canvas_progress = 50
+        imp.save()
+        follow_up.update_import_status()
+        mock_fingerprints.assert_called_once_with(follow_up)
+        mock_snapshots.assert_not_called()
+
+        follow_up.pk = None
+        follow_up.save()
+        imp.canvas_progress = 100
+        imp.canvas_state = "imported"
+        imp.save()
+        follow_up.update_import_status()
+        mock_snapshots.assert_called_once_with(follow_up)
+
+        # Import without a linked import
+        mock_snapshots.reset_mock()
+        imp.update_import_status()
+        mock_snapshots.assert_called_once_with(imp)
+
+    @mock.patch("sis_provisioner.models.delete_sis_import")
+    def test_dequeue_two_phase(self, mock_delete):
+        from sis_provisioner.models.course import Course
+
+        def queue(state=None):
+            imp = Import(csv_type="course")
+            imp.save()
+            follow_up = Import(csv_type="course", follows_import_id=imp.pk)
+            follow_up.save()
+            Course.objects.filter(pk=course.pk).update(
+                queue_id=imp.pk, provisioned_date=None)
+            return imp, follow_up
+
+        def imported(imp, state="imported"):
+            imp.post_status = 200
+            imp.canvas_progress = 100
+            imp.canvas_state = state
+            imp.canvas_id = "1"
+            imp.monitor_date = datetime.now(timezone.utc)
+            imp.save()
+            return imp
+
+        course = Course.objects.create(
+            course_id="2013-spring-TRAIN-101-A", course_type=Course.SDB_TYPE)
+
+        # Models stay queued until the follow-up import is done
+        imp, follow_up = queue()
+        self.assertEqual(follow_up.linked_import(), imp)
+        self.assertEqual(imp.linked_import(), follow_up)
+        queue_id = str(imp.pk)
+        imported(imp).delete()
+        course.refresh_from_db()
+        self.assertEqual(course.queue_id, queue_id)
+
+        self.assertIsNone(follow_up.linked_import())
+        imported(follow_up).delete()
+        course.refresh_from_db()
+        self.assertIsNone(course.queue_id)
+        self.assertIsNotNone(course.provisioned_date)
+
+        # Follow-up import done first
+        imp, follow_up = queue()
+        imported(follow_up).dequeue_dependent_models()
+        course.refresh_from_db()
+        self.assertEqual(course.queue_id, str(imp.pk))
+        imported(imp).dequeue_dependent_models()
+        course.refresh_from_db()
+        self.assertIsNone(course.queue_id)
+        self.assertIsNotNone(course.provisioned_date)
+        Import.objects.all().delete()
+
+        # Failed follow-up import
+        imp, follow_up = queue()
+        imported(imp).dequeue_dependent_models()
+        imported(follow_up, state="failed_with_messages").delete()
+        course.refresh_from_db()
+        self.assertIsNone(course.queue_id)
+        self.assertIsNone(course.provisioned_date)
+
+        # Failed first import dequeues without waiting
+        imp, follow_up = queue()
+        imported(imp, state="failed").dequeue_dependent_models()
+        course.refresh_from_db()
+        self.assertIsNone(course.queue_id)
+        self.assertIsNone(course.provisioned_date)
+
+    @mock.patch("sis_provisioner.models.get_sis_import_manifest")
+    @mock.patch("sis_provisioner.models.sis_import_by_path")
+    def test_import_csv_sharded(self, mock_import, mock_manifest):
+        mock_manifest.return_value = {"archives": [
+            {"name": "import-001.zip"}, {"name": "import-002.zip"}]}
+        mock_import.side_effect = [
+            mock.Mock(import_id="1", workflow_state="created"),
+            mock.Mock(import_id="2", workflow_state="created")]
+
+        imp = Import(csv_type="course", csv_path="abc")
+        imp.import_csv()
+        mock_import.assert_called_with("abc", False, "import-002.zip")
+        self.assertEqual(imp.post_status, 200)
+        self.assertEqual(imp.canvas_id, "1")
+        self.assertEqual(imp.shard_ids(), ["1", "2"])
+
+        imp = Import(csv_type="course", canvas_id="3")
+        self.assertEqual(imp.shard_ids(), ["3"])
+
+    @mock.patch("sis_provisioner.models.get_sis_import_manifest")
+    @mock.patch("sis_provisioner.models.sis_import_by_path")
+    def test_import_csv_duplicate(self, mock_import, mock_manifest):
+        mock_manifest.return_value = {
+            "digest": "abc", "archives": [{"name": "import.zip"}]}
+        mock_import.return_value = mock.Mock(
+            import_id="1", workflow_state="created")
+
+        imp1 = Import(csv_type="user", csv_path="abc")
+        imp1.save()
+        self.assertIsNotNone(imp1.import_csv())
+        self.assertEqual(imp1.csv_digest, "abc")
+
+        # Identical content attaches to the pending import
+        imp2 = Import(csv_type="user", csv_path="def")
+        imp2.save()
+        self.assertIsNone(imp2.import_csv())
+        self.assertEqual(mock_import.call_count, 1)
+        self.assertEqual(imp2.post_status, 200)
+        self.assertEqual(imp2.canvas_id, "1")
+        self.assertTrue(imp1.shares_canvas_import())
+
+        # Different stickiness, or a failed import, is posted
+        imp3 = Import(csv_type="user", csv_path="ghi",
+                      override_sis_stickiness=True)
+        imp3.save()
+        self.assertIsNotNone(imp3.import_csv())
+        self.assertEqual(mock_import.call_count, 2)
+
+        Import.objects.filter(canvas_id="1").update(canvas_state="failed")
+        imp4 = Import(csv_type="user", csv_path="jkl")
+        imp4.save()
+        self.assertIsNotNone(imp4.import_csv())
+        self.assertEqual(mock_import.call_count, 3)
+
+        with self.settings(SIS_IMPORT_DEDUP_MINUTES=0):
+            self.assertIsNone(Import.objects.find_by_csv_digest(imp2))
+
+    @mock.patch("sis_provisioner.models.get_sis_import_manifest")
+    @mock.patch("sis_provisioner.models.sis_import_by_path")
+    def test_import_csv_duplicate_latest(self, mock_import, mock_manifest):
+        def post(csv_type, digest):
+            mock_manifest.return_value = {
+                "digest": digest, "archives": [{"name": "import.zip"}]}
+            mock_import.return_value = mock.Mock(
+                import_id=str(mock_import.call_count + 1),
+                workflow_state="created")
+            imp = Import(csv_type=csv_type, csv_path=digest)
+            imp.save()
+            imp.import_csv()
+            return imp
+
+        # Add, drop and re-add: the re-add is posted
+        imp1 = post("enrollment", "abc")
+        post("enrollment", "def")
+        imp3 = post("enrollment", "abc")
+        self.assertEqual(mock_import.call_count, 3)
+        self.assertNotEqual(imp3.canvas_id, imp1.canvas_id)
+
+        # Attached only to the most recent post
+        imp4 = post("enrollment", "abc")
+        self.assertEqual(mock_import.call_count, 3)
+        self.assertEqual(imp4.canvas_id, imp3.canvas_id)
+
+        # An import of another type posted in between
+        post("course", "ghi")
+        post("enrollment", "abc")
+        self.assertEqual(mock_import.call_count, 5)
+
+    @mock.patch("sis_provisioner.models.get_sis_import_manifest")
+    @mock.patch("sis_provisioner.models.sis_import_by_path")
+    def test_import_csv_coalesced(self, mock_import, mock_manifest):
+        mock_import.return_value = mock.Mock(
+            import_id="1", workflow_state="created")
+
+        imports = []
+        for digest, priority in [("abc", ImportResource.PRIORITY_DEFAULT),
+                                 ("def", ImportResource.PRIORITY_HIGH),
+                                 ("ghi", ImportResource.PRIORITY_DEFAULT)]:
+            mock_manifest.return_value = {"digest": digest, "archives": [
+                {"name": "import.zip", "rows": 10}]}
+            imp = Import(csv_type="user", csv_path=digest, priority=priority)
+            imp.save()
+            with self.settings(SIS_IMPORT_COALESCE_ROWS=100):
+                self.assertIsNone(imp.import_csv())
+            imports.append(imp)
+
+        mock_import.assert_not_called()
+        self.assertEqual(list(Import.objects.find_by_csv_ready()), imports)
+
+        mock_manifest.return_value = {"digest": "jkl", "archives": [
+            {"name": "import.zip", "rows": 30}]}
+        imports[0].import_coalesced("jkl", imports[1:])
+        mock_import.assert_called_once_with("jkl", False, "import.zip")
+        for imp in imports:
+            imp.refresh_from_db()
+            self.assertEqual(imp.post_status, 200)
+            self.assertEqual(imp.canvas_id, "1")
+            self.assertEqual(imp.canvas_state, "created")
+        self.assertEqual(len(Import.objects.find_by_csv_ready()), 0)
+
+        # Immediate, large or uncounted imports are not deferred
+        with self.settings(SIS_IMPORT_COALESCE_ROWS=100):
+            imp = Import(priority=ImportResource.PRIORITY_IMMEDIATE)
+            self.assertFalse(imp.is_coalescable(
+                {"archives": [{"name": "import.zip", "rows": 10}]}))
+            imp = Import(priority=ImportResource.PRIORITY_DEFAULT)
+            self.assertTrue(imp.is_coalescable(
+                {"archives": [{"name": "import.zip", "rows": 10}]}))
+            self.assertFalse(imp.is_coalescable(
+                {"archives": [{"name": "import.zip", "rows": 100}]}))
+            self.assertFalse(imp.is_coalescable(
+                {"archives": [{"name": "import.zip"}]}))
+        self.assertFalse(imp.is_coalescable(
+            {"archives": [{"name": "import.zip", "rows": 10}]}))
+
+    @mock.patch("sis_provisioner.models.delete_sis_import")
+    @mock.patch.object(Import, "dequeue_dependent_models")
+    def test_delete_shared(self, mock_dequeue, mock_delete):
+        imp1 = Import(canvas_id=123, post_status=200, canvas_progress=10)
+        imp1.save()
+        imp2 = Import(canvas_id=123, post_status=200, canvas_progress=10)
+        imp2.save()
+
+        imp1.delete()
+        mock_delete.assert_not_called()
+        imp2.delete()
+        mock_delete.assert_called_with(imp2.canvas_id)
+
+    @mock.patch("sis_provisioner.models.get_sis_import_status")
+    @mock.patch.object(Import, "dequeue_dependent_models")
+    def test_update_import_status_sharded(self, mock_dequeue, mock_status):
+        def sis_import(state, progress, errors=[]):
+            return mock.Mock(
+                workflow_state=state, progress=progress,
+                processing_warnings=[], processing_errors=errors)
+
+        imp = Import(csv_type="course", post_status=200, canvas_id="1",
+                     canvas_shard_ids='["1", "2"]')
+        imp.save()
+
+        mock_status.side_effect = [
+            sis_import("imported", 100), sis_import("importing", 40)]
+        imp.update_import_status()
+        self.assertEqual(imp.canvas_state, "importing")
+        self.assertEqual(imp.canvas_progress, 40)
+        self.assertFalse(imp.is_completed())
+        mock_dequeue.assert_not_called()
+
+        mock_status.side_effect = [
+            sis_import("imported", 100),
+            sis_import("failed_with_messages", 100, [["abc", "err"]])]
+        imp.update_import_status()
+        self.assertEqual(imp.canvas_state, "failed_with_messages")
+        self.assertEqual(imp.canvas_errors, '[["abc", "err"]]')
+        self.assertFalse(imp.is_imported())
+
+        mock_status.side_effect = [
+            sis_import("imported", 100), sis_import("imported", 100)]
+        imp.update_import_status()
+        self.assertEqual(Import.objects.filter(pk=imp.pk).count(), 0)
+
     def test_json_data(self):
         added_date = datetime.fromisoformat("2018-05-20T13:01:30.122394-07:00")
         kwargs = {
@@ -144,3 +429,91 @@ class ImportModelTest(TestCase):
            "type": "user",
            "type_name": "User",
         })
+
+
+class RowFingerprintModelTest(TestCase):
+    @mock.patch("sis_provisioner.dao.canvas.default_storage")
+    def test_record_import(self, mock_storage):
+        mock_storage.exists.return_value = True
+        mock_storage.open.return_value.read.\
+            return_value = '{"users": {"abc": "111", "def": "222"}}'
+
+        imp = Import(csv_path="2026/01/01/000000-000000")
+        RowFingerprint.objects.record_import(imp)
+        mock_storage.open.assert_called_with(
+            "2026/01/01/000000-000000/fingerprints.json", mode="r")
+        self.assertEqual(RowFingerprint.objects.count(), 2)
+
+        mock_storage.open.return_value.read.\
+            return_value = '{"users": {"abc": "333"}}'
+        RowFingerprint.objects.record_import(imp)
+        self.assertEqual(RowFingerprint.objects.count(), 2)
+        self.assertEqual(
+            RowFingerprint.objects.get(sis_id="abc").digest, "333")
+
+        mock_storage.reset_mock()
+        RowFingerprint.objects.record_import(Import(csv_path=None))
+        mock_storage.open.assert_not_called()
+
+    def test_find_unchanged(self):
+        now = datetime.now(timezone.utc)
+        RowFingerprint.objects.create(
+            csv_type="users", sis_id="abc", digest="111", imported_date=now)
+        RowFingerprint.objects.create(
+            csv_type="users", sis_id="def", digest="222", imported_date=now)
+        RowFingerprint.objects.create(
+            csv_type="users", sis_id="ghi", digest="333",
+            imported_date=now - timedelta(days=30))
+
+        digests = {"abc": "111", "def": "999", "ghi": "333", "jkl": "444"}
+        self.assertEqual(
+            RowFingerprint.objects.find_unchanged("users", digests), {"abc"})
+        self.assertEqual(
+            RowFingerprint.objects.find_unchanged("courses", digests), set())
+
+        with self.settings(SIS_IMPORT_FINGERPRINT_DAYS=60):
+            self.assertEqual(RowFingerprint.objects.find_unchanged(
+                "users", digests), {"abc", "ghi"})
+
+
+class SectionSnapshotModelTest(TestCase):
+    @mock.patch("sis_provisioner.dao.canvas.default_storage")
+    def test_record_import(self, mock_storage):
+        mock_storage.exists.return_value = True
+        mock_storage.open.return_value.read.\
+            return_value = '{"2013-spring-TRAIN-101-A": "111"}'
+
+        imp = Import(csv_path="2026/01/01/000000-000000")
+        SectionSnapshot.objects.record_import(imp)
+        mock_storage.open.assert_called_with(
+            "2026/01/01/000000-000000/snapshots.json", mode="r")
+        self.assertEqual(SectionSnapshot.objects.get(
+            section_id="2013-spring-TRAIN-101-A").digest, "111")
+
+        mock_storage.exists.return_value = False
+        mock_storage.reset_mock()
+        SectionSnapshot.objects.record_import(imp)
+        mock_storage.open.assert_not_called()
+        self.assertEqual(SectionSnapshot.objects.count(), 1)
+
+    def test_find_unchanged(self):
+        now = datetime.now(timezone.utc)
+        SectionSnapshot.objects.create(
+            section_id="abc", digest="111", provisioned_date=now)
+        SectionSnapshot.objects.create(
+            section_id="def", digest="222", provisioned_date=now)
+        SectionSnapshot.objects.create(
+            section_id="ghi", digest="333",
+            provisioned_date=now - timedelta(days=2))
+
+        digests = {"abc": "111", "def": "999", "ghi": "333"}
+        self.assertEqual(
+            SectionSnapshot.objects.find_unchanged(digests), {"abc"})
+
+        with self.settings(SIS_IMPORT_SNAPSHOT_HOURS=72):
+            self.assertEqual(SectionSnapshot.objects.find_unchanged(
+                digests), {"abc", "ghi"})
+
+        with self.settings(SIS_IMPORT_SNAPSHOT_HOURS=0):
+            self.assertEqual(
+                SectionSnapshot.objects.find_unchanged(digests), set())
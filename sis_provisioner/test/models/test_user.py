@@ -69,6 +69,26 @@ class UserModelTest(TestCase):
         self.assertRaises(UserPolicyException, User.objects.add_user_by_netid,
                           'javerage')
 
+    def test_get_users(self):
+        javerage = PWS().get_person_by_netid('javerage')
+        bill = PWS().get_person_by_netid('bill')
+        User.objects.create(net_id='javerage', reg_id=javerage.uwregid)
+
+        users = User.objects.get_users([javerage, bill])
+        self.assertEqual(users[javerage.uwregid].net_id, 'javerage')
+        self.assertIsNotNone(users[javerage.uwregid].pk)
+        self.assertEqual(users[bill.uwregid].net_id, 'bill')
+        self.assertIsNone(users[bill.uwregid].pk)
+        self.assertEqual(users[bill.uwregid].priority, User.PRIORITY_HIGH)
+
+        # Matches more than one user
+        User.objects.create(net_id='bill', reg_id='0' * 32)
+        User.objects.create(net_id='bill2', reg_id=bill.uwregid)
+        users = User.objects.get_users([javerage, bill])
+        self.assertEqual(list(users.keys()), [javerage.uwregid])
+
+        self.assertEqual(User.objects.get_users([]), {})
+
     def test_json_data(self):
         person = PWS().get_person_by_netid('javerage')
         user = User.objects.add_user(person)